@@ -1,14 +1,69 @@
+import hmac
 import os
+import time
 
-from flask import Flask
+from flask import Flask, Response, g, jsonify, request, session
 
 from config import load_config
-from .core import ensure_dir, ensure_feedback_state_csv, ensure_notice_file, is_nas_available_cached
+from .admission import admission_stats
+from .chat_runs import answer_cache_stats, chat_runs_stats, sse_stats
+from .core import (
+    configure_csv_cache,
+    csv_cache_stats,
+    ensure_dir,
+    ensure_feedback_state_csv,
+    ensure_notice_file,
+    history_writer_stats,
+    is_admin,
+    is_nas_available_cached,
+    md_rebuild_stats,
+    nas_health_stats,
+    nas_sync_status,
+    observe_route,
+    post_turn_stats,
+    start_md_scheduler,
+    start_nas_monitor,
+    start_nas_sync_worker,
+    storage_for,
+)
+from .dify import dify_endpoint_stats, dify_pool_stats, start_dify_pools
+from .metrics import render_metrics
 from .blueprints.auth import bp as auth_bp
 from .blueprints.api_chat import bp as api_chat_bp
 from .blueprints.api_threads import bp as api_threads_bp
 from .blueprints.api_feedback import bp as api_feedback_bp
 
+# /stats and /metrics are for operators: admins (ADMIN_USER_IDS) or a
+# direct request from the box itself; /metrics also takes METRICS_TOKEN as a
+# bearer token for a scraper. Free-text fields of /stats can carry user ids,
+# file paths or pieces of a Dify answer, so they are blanked; the counters
+# stay.
+_REDACTED_KEYS = {"last_error", "dify_last_bad"}
+
+
+def _stats_allowed(cfg) -> bool:
+    if request.remote_addr in ("127.0.0.1", "::1") and "X-Forwarded-For" not in request.headers:
+        return True
+    uid = session.get("user_id")
+    return bool(uid) and is_admin(cfg, uid)
+
+
+def _metrics_allowed(cfg) -> bool:
+    if _stats_allowed(cfg):
+        return True
+    auth = request.headers.get("Authorization") or ""
+    return bool(cfg.metrics_token) and hmac.compare_digest(auth.encode("utf-8"), f"Bearer {cfg.metrics_token}".encode("utf-8"))
+
+
+def _redact_stats(v, paths):
+    if isinstance(v, dict):
+        return {k: ("[redacted]" if k in _REDACTED_KEYS and x else _redact_stats(x, paths)) for k, x in v.items()}
+    if isinstance(v, list):
+        return [_redact_stats(x, paths) for x in v]
+    if isinstance(v, str) and any(p in v for p in paths):
+        return "[redacted]"
+    return v
+
 
 def create_app(base_dir: str | None = None) -> Flask:
     base_dir = base_dir or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -27,21 +82,68 @@ def create_app(base_dir: str | None = None) -> Flask:
     if errs:
         app.logger.warning("Config validation warnings: %s", "; ".join(errs))
 
+    configure_csv_cache(cfg)
+
     ensure_dir(cfg.users_dir)
     ensure_dir(cfg.feedback_dir_local)
     ensure_dir(cfg.backup_dir)
     ensure_notice_file(cfg)
-    ensure_feedback_state_csv(cfg.feedback_dir_local)
+    storage = storage_for(cfg)
+    start_nas_monitor(cfg)
+    ensure_feedback_state_csv(cfg.feedback_dir_local, cfg.backup_dir)
     if is_nas_available_cached(cfg):
-        ensure_feedback_state_csv(cfg.feedback_dir_nas)
+        ensure_feedback_state_csv(cfg.feedback_dir_nas, cfg.backup_dir)
+    start_nas_sync_worker(cfg)
+    start_md_scheduler(cfg)
+    start_dify_pools(cfg)
 
     app.register_blueprint(auth_bp)
     app.register_blueprint(api_chat_bp)
     app.register_blueprint(api_threads_bp)
     app.register_blueprint(api_feedback_bp)
 
+    @app.before_request
+    def _route_timer_start():
+        g.route_t0 = time.perf_counter()
+
+    @app.after_request
+    def _route_timer_observe(resp):
+        t0 = g.get("route_t0")
+        # an SSE response is timed only up to its headers, which says nothing about the stream
+        if t0 is not None and resp.mimetype != "text/event-stream":
+            rule = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+            observe_route(rule, request.method, resp.status_code, time.perf_counter() - t0)
+        return resp
+
     @app.get("/ping")
     def ping():
         return "pong"
 
+    @app.get("/stats")
+    def stats():
+        if not _stats_allowed(cfg):
+            return jsonify({"error": "forbidden"}), 403
+        paths = [p for p in (cfg.base_dir, cfg.feedback_dir_local, cfg.feedback_dir_nas) if p]
+        return jsonify(_redact_stats({
+            "storage": storage.name,
+            "csv_cache": csv_cache_stats(),
+            "history_writer": history_writer_stats(),
+            "post_turn": post_turn_stats(),
+            "nas": nas_health_stats(cfg),
+            "nas_sync": nas_sync_status(cfg),
+            "md_rebuild": md_rebuild_stats(),
+            "dify": dify_pool_stats(),
+            "dify_endpoints": dify_endpoint_stats(),
+            "admission": admission_stats(),
+            "answer_cache": answer_cache_stats(),
+            "chat_runs": chat_runs_stats(),
+            "sse": sse_stats(),
+        }, paths))
+
+    @app.get("/metrics")
+    def metrics():
+        if not _metrics_allowed(cfg):
+            return jsonify({"error": "forbidden"}), 403
+        return Response(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
     return app
\ No newline at end of file
@@ -0,0 +1,151 @@
+import math
+import os
+import time
+from collections import deque
+from threading import Event, Lock
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from config import AppConfig
+
+QUEUE_FULL_MESSAGE = "このモデルは混雑しています。しばらくしてから再度お試しください。"
+QUEUE_TIMEOUT_MESSAGE = "このモデルの順番待ちがタイムアウトしました。しばらくしてから再度お試しください。"
+
+# Per-model admission in front of Dify: at most DIFY_MAX_INFLIGHT turns
+# generate at once, up to DIFY_QUEUE_MAX more wait in FIFO order and anything
+# beyond that is turned away. A finishing turn hands its slot straight to the
+# head of the queue. Both knobs can be overridden per model with
+# DIFY_MAX_INFLIGHT_<MODEL> / DIFY_QUEUE_MAX_<MODEL>.
+_adm_guard = Lock()
+_adm: Dict[str, Dict[str, Any]] = {}
+
+
+def _model_env_int(name: str, model_key: str, default: int) -> int:
+    v = (os.environ.get(f"{name}_{model_key.upper()}") or "").strip()
+    try:
+        return int(v) if v else default
+    except ValueError:
+        return default
+
+
+def _admission_state_locked(cfg: AppConfig, model_key: str) -> Dict[str, Any]:
+    st = _adm.get(model_key)
+    if st is None:
+        limit = _model_env_int("DIFY_MAX_INFLIGHT", model_key, cfg.dify_max_inflight)
+        st = {
+            # more than the connection pool would only move the wait into dify_chat_stream
+            "limit": max(1, min(limit, cfg.dify_pool_size)),
+            "queue_max": max(0, _model_env_int("DIFY_QUEUE_MAX", model_key, cfg.dify_queue_max)),
+            "in_flight": 0,
+            "queue": deque(),
+            "ewma_sec": 0.0,
+            "stats": {
+                "admitted": 0,
+                "queued": 0,
+                "rejected": 0,
+                "timeouts": 0,
+                "peak_in_flight": 0,
+                "peak_queue": 0,
+                "wait_ms_total": 0.0,
+                "wait_ms_max": 0.0,
+            },
+        }
+        _adm[model_key] = st
+    return st
+
+
+def _admission_grant_locked(st: Dict[str, Any], ticket: Dict[str, Any]) -> None:
+    st["in_flight"] += 1
+    st["stats"]["admitted"] += 1
+    st["stats"]["peak_in_flight"] = max(st["stats"]["peak_in_flight"], st["in_flight"])
+    ticket["state"] = "admitted"
+    ticket["admitted_at"] = time.monotonic()
+    ticket["event"].set()
+    if ticket["on_admit"] is not None:
+        ticket["on_admit"]()
+
+
+def admission_enter(cfg: AppConfig, model_key: str, on_admit: Optional[Callable[[], None]] = None) -> Optional[Dict[str, Any]]:
+    # None means the queue is full; on_admit runs (under the admission lock) once the ticket gets a slot
+    ticket: Dict[str, Any] = {
+        "model_key": model_key,
+        "state": "queued",
+        "event": Event(),
+        "on_admit": on_admit,
+        "entered_at": time.monotonic(),
+        "admitted_at": 0.0,
+    }
+    with _adm_guard:
+        st = _admission_state_locked(cfg, model_key)
+        if st["in_flight"] < st["limit"] and not st["queue"]:
+            _admission_grant_locked(st, ticket)
+            return ticket
+        if len(st["queue"]) >= st["queue_max"]:
+            st["stats"]["rejected"] += 1
+            return None
+        st["queue"].append(ticket)
+        st["stats"]["queued"] += 1
+        st["stats"]["peak_queue"] = max(st["stats"]["peak_queue"], len(st["queue"]))
+    return ticket
+
+
+def admission_position(ticket: Dict[str, Any]) -> Tuple[int, Optional[float]]:
+    # (1-based queue position, estimated seconds until admitted or None without history); (0, 0.0) once admitted
+    with _adm_guard:
+        if ticket["state"] != "queued":
+            return 0, 0.0
+        st = _adm[ticket["model_key"]]
+        try:
+            pos = st["queue"].index(ticket) + 1
+        except ValueError:
+            return 0, 0.0
+        if st["ewma_sec"] <= 0:
+            return pos, None
+        return pos, round(math.ceil(pos / st["limit"]) * st["ewma_sec"], 1)
+
+
+def admission_leave(ticket: Dict[str, Any]) -> None:
+    # releases an admitted slot or drops a queued ticket; safe to call more than once
+    now = time.monotonic()
+    with _adm_guard:
+        st = _adm[ticket["model_key"]]
+        if ticket["state"] == "queued":
+            try:
+                st["queue"].remove(ticket)
+            except ValueError:
+                pass
+        elif ticket["state"] == "admitted":
+            st["in_flight"] -= 1
+            dur = now - ticket["admitted_at"]
+            st["ewma_sec"] = dur if st["ewma_sec"] <= 0 else st["ewma_sec"] * 0.8 + dur * 0.2
+            while st["queue"] and st["in_flight"] < st["limit"]:
+                nxt = st["queue"].popleft()
+                ms = (now - nxt["entered_at"]) * 1000.0
+                st["stats"]["wait_ms_total"] += ms
+                st["stats"]["wait_ms_max"] = max(st["stats"]["wait_ms_max"], ms)
+                _admission_grant_locked(st, nxt)
+        ticket["state"] = "left"
+
+
+def admission_timed_out(ticket: Dict[str, Any]) -> None:
+    with _adm_guard:
+        if ticket["state"] == "queued":
+            _adm[ticket["model_key"]]["stats"]["timeouts"] += 1
+    admission_leave(ticket)
+
+
+def admission_stats() -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    with _adm_guard:
+        for mk, st in _adm.items():
+            s = dict(st["stats"])
+            s["wait_ms_total"] = round(s["wait_ms_total"], 2)
+            s["wait_ms_max"] = round(s["wait_ms_max"], 2)
+            s.update({
+                "limit": st["limit"],
+                "queue_max": st["queue_max"],
+                "in_flight": st["in_flight"],
+                "queue_depth": len(st["queue"]),
+                "avg_turn_sec": round(st["ewma_sec"], 2),
+            })
+            out[mk] = s
+    return out
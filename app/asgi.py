@@ -0,0 +1,522 @@
+import asyncio
+import json
+import time
+from http.cookies import SimpleCookie
+from typing import Any, Dict, Optional, Set, Tuple
+from urllib.parse import parse_qs
+
+import httpx
+from a2wsgi import WSGIMiddleware
+
+from . import create_app
+from .admission import (
+    QUEUE_FULL_MESSAGE,
+    QUEUE_TIMEOUT_MESSAGE,
+    admission_enter,
+    admission_leave,
+    admission_position,
+    admission_timed_out,
+)
+from .chat_runs import (
+    begin_chat_turn,
+    cached_answer_for,
+    chat_turn_event,
+    chat_turn_flush,
+    chat_turn_flush_timeout,
+    chat_turn_meta,
+    chat_turn_queued_meta,
+    chat_turn_started,
+    chat_run_cancel,
+    chat_run_close,
+    chat_run_cursor,
+    chat_run_for,
+    chat_run_note_resume,
+    chat_run_on_cancel,
+    chat_run_push,
+    chat_run_take_locked,
+    finish_chat_turn,
+    open_chat_run,
+    provisional_chat_turn,
+    replay_cached_turn,
+)
+from .core import DEFAULT_MODEL_KEY, MODELS, create_new_thread_id, load_user, observe_route, resolve_api_key
+from .dify import (
+    SseParser,
+    dify_candidates,
+    dify_counts_as_failure,
+    dify_endpoint_failed,
+    dify_endpoint_ok,
+    dify_failover_ok,
+    dify_hedge_after_sec,
+    dify_hedge_enabled,
+    dify_note_attempt,
+    dify_remember_conversation,
+    dify_sse_events,
+)
+
+# POST /api/chat/stream is served on the event loop with httpx, so a slow
+# Dify answer costs a coroutine instead of a server thread. Everything else
+# (pages, threads, history, feedback) is the unchanged Flask app behind
+# a2wsgi's WSGIMiddleware, on its own pool of ASGI_WSGI_WORKERS threads.
+# File I/O for the turn still goes through the same core functions, on
+# worker threads. The Dify call is a task of its own writing into the core
+# chat run, so /api/chat/resume works the same here as on the WSGI path.
+
+SSE_HEADERS = [
+    (b"content-type", b"text/event-stream; charset=utf-8"),
+    (b"cache-control", b"no-cache"),
+    (b"x-accel-buffering", b"no"),
+]
+
+
+def create_asgi_app(base_dir: Optional[str] = None):
+    flask_app = create_app(base_dir)
+    cfg = flask_app.config["APP_CFG"]
+    wsgi = WSGIMiddleware(flask_app, workers=max(1, cfg.asgi_wsgi_workers))
+    clients: Dict[Tuple[str, str], httpx.AsyncClient] = {}
+
+    def client_for(model_key: str, base: str) -> httpx.AsyncClient:
+        c = clients.get((model_key, base))
+        if c is None:
+            size = max(1, cfg.dify_pool_size)
+            c = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=size, max_keepalive_connections=size),
+                timeout=httpx.Timeout(
+                    connect=cfg.dify_connect_timeout_sec,
+                    read=cfg.dify_read_timeout_sec,
+                    write=cfg.dify_connect_timeout_sec,
+                    pool=cfg.dify_connect_timeout_sec,
+                ),
+                # httpx transports only retry failed connects, same as the requests pool
+                transport=httpx.AsyncHTTPTransport(retries=cfg.dify_connect_retries),
+            )
+            clients[(model_key, base)] = c
+        return c
+
+    def session_user_id(scope: Dict[str, Any]) -> str:
+        raw = ""
+        for k, v in scope.get("headers") or []:
+            if k == b"cookie":
+                raw = v.decode("latin-1")
+                break
+        morsel = SimpleCookie(raw).get(flask_app.config["SESSION_COOKIE_NAME"])
+        if morsel is None:
+            return ""
+        s = flask_app.session_interface.get_signing_serializer(flask_app)
+        try:
+            data = s.loads(morsel.value, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+        except Exception:
+            return ""
+        return str(data.get("user_id") or "")
+
+    async def read_body(receive) -> bytes:
+        chunks = []
+        while True:
+            msg = await receive()
+            if msg["type"] == "http.disconnect":
+                break
+            chunks.append(msg.get("body", b""))
+            if not msg.get("more_body"):
+                break
+        return b"".join(chunks)
+
+    async def send_json(send, status: int, obj: Dict[str, Any]) -> None:
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+    # producer tasks outlive the request that started them
+    runs_tasks: Set[asyncio.Task] = set()
+
+    def header(scope: Dict[str, Any], name: bytes) -> str:
+        for k, v in scope.get("headers") or []:
+            if k == name:
+                return v.decode("latin-1")
+        return ""
+
+    async def follow(scope, receive, send, run: Dict[str, Any], after: int) -> None:
+        loop = asyncio.get_running_loop()
+        woke = asyncio.Event()
+
+        def waker() -> None:
+            loop.call_soon_threadsafe(woke.set)
+
+        await send({"type": "http.response.start", "status": 200, "headers": SSE_HEADERS})
+
+        async def pump() -> None:
+            nonlocal after
+            while True:
+                with run["cond"]:
+                    woke.clear()
+                    frames, after, finished = chat_run_take_locked(run, after)
+                if frames:
+                    await send({"type": "http.response.body", "body": "".join(frames).encode("utf-8"), "more_body": True})
+                if finished:
+                    return
+                if not frames:
+                    try:
+                        await asyncio.wait_for(woke.wait(), 15.0)
+                    except asyncio.TimeoutError:
+                        await send({"type": "http.response.body", "body": b": keepalive\n\n", "more_body": True})
+
+        async def wait_disconnect() -> None:
+            while (await receive())["type"] != "http.disconnect":
+                pass
+
+        with run["cond"]:
+            run["subscribers"] += 1
+            run["wakers"].add(waker)
+        # a client that goes away only stops reading; the run keeps going
+        pump_task = asyncio.ensure_future(pump())
+        gone_task = asyncio.ensure_future(wait_disconnect())
+        try:
+            await asyncio.wait({pump_task, gone_task}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            gone_task.cancel()
+            if not pump_task.done():
+                pump_task.cancel()
+            with run["cond"]:
+                run["subscribers"] -= 1
+                run["wakers"].discard(waker)
+        if not pump_task.done() or pump_task.cancelled() or pump_task.exception() is not None:
+            return
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def produce(run: Dict[str, Any], uid: str, model_key: str, thread_id: str, message: str, api_key: str) -> None:
+        loop = asyncio.get_running_loop()
+
+        def push(frame) -> None:
+            chat_run_push(run, frame)
+
+        try:
+            try:
+                cached = await asyncio.to_thread(cached_answer_for, cfg, uid, model_key, thread_id, message)
+            except Exception:
+                cached = None
+            if cached is not None:
+                turn = await asyncio.to_thread(begin_chat_turn, cfg, uid, model_key, thread_id, message)
+                frames = await asyncio.to_thread(lambda: list(replay_cached_turn(cfg, turn, cached)))
+                for frame in frames:
+                    push(frame)
+                return
+
+            admitted = asyncio.Event()
+            ticket = admission_enter(cfg, model_key, on_admit=lambda: loop.call_soon_threadsafe(admitted.set))
+            if ticket is None:
+                push(("error", {"message": QUEUE_FULL_MESSAGE, "code": "queue_full"}))
+                return
+            try:
+                await dify_turn(run, push, ticket, admitted, uid, model_key, thread_id, message, api_key)
+            finally:
+                admission_leave(ticket)
+        except asyncio.CancelledError:
+            # chat_run_cancel broke off the Dify read; anything else cancelling us is shutdown
+            if not run["cancelled"]:
+                raise
+            push(("error", {"message": "cancelled", "code": "cancelled"}))
+        except Exception as e:
+            push(("error", {"message": str(e) or type(e).__name__}))
+        finally:
+            chat_run_close(run)
+
+    async def dify_turn(run, push, ticket, admitted, uid, model_key, thread_id, message, api_key) -> None:
+        loop = asyncio.get_running_loop()
+        turn = provisional_chat_turn(uid, model_key, thread_id)
+
+        deadline = loop.time() + cfg.dify_queue_timeout_sec
+        last_pos = None
+        while not admitted.is_set():
+            if run["cancelled"]:
+                push(("error", {"message": "cancelled", "code": "cancelled"}))
+                return
+            pos, eta = admission_position(ticket)
+            if pos and pos != last_pos:
+                last_pos = pos
+                push(chat_turn_queued_meta(turn, pos, eta))
+            left = deadline - loop.time()
+            if left <= 0:
+                admission_timed_out(ticket)
+                push(("error", {"message": QUEUE_TIMEOUT_MESSAGE, "code": "queue_timeout"}))
+                return
+            try:
+                await asyncio.wait_for(admitted.wait(), min(1.0, left))
+            except asyncio.TimeoutError:
+                pass
+
+        turn = await asyncio.to_thread(begin_chat_turn, cfg, uid, model_key, thread_id, message)
+        chat_turn_started(turn)
+
+        # a cancel interrupts the Dify request or read, but never the persistence after message_end
+        task = asyncio.current_task()
+
+        def cancel_if_reading() -> None:
+            if run["abort"] is abort:
+                task.cancel()
+
+        def abort() -> None:
+            loop.call_soon_threadsafe(cancel_if_reading)
+
+        chat_run_on_cancel(run, abort)
+        try:
+            base, r, chunks, first = await open_dify(model_key, api_key, turn["payload"])
+        except httpx.HTTPStatusError as e:
+            chat_run_on_cancel(run, None)
+            push(("error", {"message": e.response.text or "Dify HTTP error"}))
+            return
+        except BaseException:
+            chat_run_on_cancel(run, None)
+            raise
+        try:
+            push(chat_turn_meta(turn))
+
+            parser = SseParser()
+            async for chunk in coalescing_chunks(prepend(first, chunks), turn):
+                if run["cancelled"]:
+                    push(("error", {"message": "cancelled", "code": "cancelled"}))
+                    return
+                if chunk is None:
+                    for frame in chat_turn_flush(turn):
+                        push(frame)
+                    continue
+                events, finished = dify_sse_events(parser, chunk)
+                for ev in events:
+                    frames, status = chat_turn_event(turn, ev)
+                    for frame in frames:
+                        push(frame)
+                    if status == "end":
+                        chat_run_on_cancel(run, None)
+                        dify_remember_conversation(turn["dify_cid"], base)
+                        push(await asyncio.to_thread(finish_chat_turn, cfg, turn))
+                        # read the chunked terminator so the connection stays pooled
+                        n = 0
+                        async for _ in chunks:
+                            n += 1
+                            if n >= 64:
+                                break
+                        return
+                    if status == "error":
+                        return
+                if finished:
+                    return
+        finally:
+            chat_run_on_cancel(run, None)
+            await r.aclose()
+
+    async def open_attempt(model_key: str, base: str, api_key: str, payload: Dict[str, Any]):
+        # -> (response, body iterator, first chunk); the response is closed on any failure
+        loop = asyncio.get_running_loop()
+        client = client_for(model_key, base)
+        t0 = loop.time()
+        req = client.build_request("POST", f"{base}/chat-messages", headers={"Authorization": f"Bearer {api_key}"}, json=payload)
+        r = await client.send(req, stream=True)
+        try:
+            if r.status_code >= 400:
+                await r.aread()
+                raise httpx.HTTPStatusError(f"{r.status_code} from {base}", request=req, response=r)
+            chunks = r.aiter_bytes()
+            try:
+                first = await chunks.__anext__()
+            except StopAsyncIteration:
+                first = b""
+        except BaseException:
+            await r.aclose()
+            raise
+        dify_endpoint_ok(model_key, base, (loop.time() - t0) * 1000.0)
+        return r, chunks, first
+
+    async def open_dify(model_key: str, api_key: str, payload: Dict[str, Any]):
+        # same endpoint policy as core.dify_chat_stream: ordered failover, optional hedge on first turns
+        loop = asyncio.get_running_loop()
+        cid = payload.get("conversation_id") or ""
+        todo = dify_candidates(cfg, model_key, cid)
+        hedge = dify_hedge_enabled(cfg, payload, todo)
+        tasks: Dict[asyncio.Future, Tuple[str, str]] = {}
+
+        def launch(kind: str = "") -> str:
+            base = todo.pop(0)
+            if kind:
+                dify_note_attempt(model_key, base, kind)
+            tasks[asyncio.ensure_future(open_attempt(model_key, base, api_key, payload))] = (base, kind)
+            return base
+
+        primary = launch()
+        hedge_at = loop.time() + dify_hedge_after_sec(cfg, model_key, primary) if hedge else None
+        try:
+            while True:
+                timeout = None
+                if hedge_at is not None and todo:
+                    timeout = max(0.0, hedge_at - loop.time())
+                done, _ = await asyncio.wait(set(tasks), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    launch("hedged_to")
+                    hedge_at = None
+                    continue
+                for t in done:
+                    base, kind = tasks.pop(t)
+                    err = t.exception()
+                    if err is None:
+                        if kind == "hedged_to":
+                            dify_note_attempt(model_key, base, "hedge_wins")
+                        return (base,) + t.result()
+                    resp = getattr(err, "response", None)
+                    status = resp.status_code if isinstance(err, httpx.HTTPStatusError) and resp is not None else None
+                    if dify_counts_as_failure(status):
+                        dify_endpoint_failed(cfg, model_key, base, err)
+                    if not dify_failover_ok(status, cid) or (not tasks and not todo):
+                        raise err
+                if not tasks:
+                    launch("failovers_to")
+        finally:
+            for t in tasks:
+                if not t.done():
+                    t.cancel()
+                elif not t.cancelled() and t.exception() is None:
+                    # lost the race in the same tick as the winner
+                    asyncio.ensure_future(t.result()[0].aclose())
+
+    async def prepend(first: bytes, chunks):
+        if first:
+            yield first
+        async for chunk in chunks:
+            yield chunk
+
+    async def coalescing_chunks(chunks, turn):
+        # yields None when pending delta text is due before Dify sends anything else;
+        # the pending read is kept across timeouts, never cancelled mid-chunk
+        nxt = None
+        try:
+            while True:
+                if nxt is None:
+                    nxt = asyncio.ensure_future(chunks.__anext__())
+                done, _ = await asyncio.wait({nxt}, timeout=chat_turn_flush_timeout(turn))
+                if not done:
+                    yield None
+                    continue
+                try:
+                    chunk = nxt.result()
+                except StopAsyncIteration:
+                    return
+                nxt = None
+                yield chunk
+        finally:
+            if nxt is not None and not nxt.done():
+                nxt.cancel()
+
+    async def chat_stream(scope, receive, send) -> None:
+        body = await read_body(receive)
+        uid = session_user_id(scope)
+        if not uid:
+            return await send_json(send, 401, {"error": "unauthorized"})
+
+        u = await asyncio.to_thread(load_user, cfg, uid)
+        if not u:
+            return await send_json(send, 401, {"error": "user not found"})
+
+        model_key = u["model_key"]
+        if model_key not in MODELS:
+            model_key = DEFAULT_MODEL_KEY
+
+        api_key = resolve_api_key(cfg, model_key)
+
+        if not cfg.dify_api_base:
+            return await send_json(send, 500, {"error": "DIFY_API_BASE not set"})
+        if not api_key:
+            return await send_json(send, 500, {"error": "API key not set"})
+
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            return await send_json(send, 400, {"error": "invalid json"})
+        message = (data.get("message") or "").strip()
+        thread_id = (data.get("thread_id") or "").strip() or None
+
+        if not message:
+            return await send_json(send, 400, {"error": "message is empty"})
+        if not thread_id:
+            thread_id = create_new_thread_id()
+
+        run = open_chat_run(cfg, u["user_id"], thread_id)
+        if run is None:
+            return await send_json(send, 409, {"error": "generation already running", "code": "busy", "thread_id": thread_id})
+        task = asyncio.ensure_future(produce(run, u["user_id"], model_key, thread_id, message, api_key))
+        runs_tasks.add(task)
+        task.add_done_callback(runs_tasks.discard)
+        await follow(scope, receive, send, run, 0)
+
+    async def chat_resume(scope, receive, send) -> None:
+        body = await read_body(receive)
+        uid = session_user_id(scope)
+        if not uid:
+            return await send_json(send, 401, {"error": "unauthorized"})
+        qs = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            data = {}
+        thread_id = ((qs.get("thread_id") or [""])[0] or data.get("thread_id") or "").strip()
+        if not thread_id:
+            return await send_json(send, 400, {"error": "thread_id is required"})
+        run = chat_run_for(uid, thread_id)
+        if run is None:
+            await send({"type": "http.response.start", "status": 204, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        last_id = header(scope, b"last-event-id") or (qs.get("last_event_id") or [""])[0] or data.get("last_event_id") or ""
+        chat_run_note_resume()
+        await follow(scope, receive, send, run, chat_run_cursor(run, last_id))
+
+    async def chat_cancel(scope, receive, send) -> None:
+        body = await read_body(receive)
+        uid = session_user_id(scope)
+        if not uid:
+            return await send_json(send, 401, {"error": "unauthorized"})
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            data = {}
+        thread_id = (data.get("thread_id") or "").strip()
+        run = chat_run_for(uid, thread_id) if thread_id else None
+        if run is None or run["done"]:
+            return await send_json(send, 200, {"ok": True, "running": False})
+        chat_run_cancel(run)
+        await send_json(send, 200, {"ok": True, "running": True})
+
+    def timed_send(scope: Dict[str, Any], send):
+        # same route latency as the Flask routes: until the response headers go out, SSE responses left out
+        t0 = time.perf_counter()
+
+        async def wrapped(msg: Dict[str, Any]) -> None:
+            if msg["type"] == "http.response.start":
+                ctype = dict(msg.get("headers") or ()).get(b"content-type", b"")
+                if not ctype.startswith(b"text/event-stream"):
+                    observe_route(scope["path"], scope["method"], msg["status"], time.perf_counter() - t0)
+            await send(msg)
+        return wrapped
+
+    async def app(scope, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            while True:
+                msg = await receive()
+                if msg["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif msg["type"] == "lifespan.shutdown":
+                    for t in list(runs_tasks):
+                        t.cancel()
+                    for c in list(clients.values()):
+                        await c.aclose()
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] == "http":
+            route = (scope["method"], scope["path"])
+            handler = None
+            if route == ("POST", "/api/chat/stream"):
+                handler = chat_stream
+            elif route in (("GET", "/api/chat/resume"), ("POST", "/api/chat/resume")):
+                handler = chat_resume
+            elif route == ("POST", "/api/chat/cancel"):
+                handler = chat_cancel
+            if handler is not None:
+                return await handler(scope, receive, timed_send(scope, send))
+        return await wsgi(scope, receive, send)
+
+    return app
\ No newline at end of file
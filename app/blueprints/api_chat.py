@@ -1,19 +1,16 @@
-import requests
-from flask import Blueprint, Response, current_app, jsonify, request, session, stream_with_context
-
-from ..core import (
-    DEFAULT_MODEL_KEY,
-    MODELS,
-    append_history,
-    create_new_thread_id,
-    get_dify_cid,
-    iter_dify_sse,
-    load_user,
-    resolve_api_key,
-    set_dify_cid,
-    sse_pack,
-    upsert_thread,
+from flask import Blueprint, Response, current_app, jsonify, request, session
+
+from ..chat_runs import (
+    answer_cache_invalidate,
+    answer_cache_stats,
+    chat_run_cancel,
+    chat_run_cursor,
+    chat_run_for,
+    chat_run_note_resume,
+    iter_chat_run,
+    start_chat_run,
 )
+from ..core import DEFAULT_MODEL_KEY, MODELS, create_new_thread_id, is_admin, load_user, resolve_api_key
 
 bp = Blueprint("api_chat", __name__)
 
@@ -32,6 +29,18 @@ def _api_login_required(fn):
     return wrapper
 
 
+def _api_admin_required(fn):
+    def wrapper(*args, **kwargs):
+        uid = session.get("user_id")
+        if not uid:
+            return jsonify({"error": "unauthorized"}), 401
+        if not is_admin(_cfg(), uid):
+            return jsonify({"error": "forbidden"}), 403
+        return fn(*args, **kwargs)
+    wrapper.__name__ = fn.__name__
+    return wrapper
+
+
 @bp.post("/api/chat/stream")
 @_api_login_required
 def api_chat_stream():
@@ -60,77 +69,65 @@ def api_chat_stream():
     if not thread_id:
         thread_id = create_new_thread_id()
 
-    dify_cid_in = get_dify_cid(_cfg(), u["user_id"], thread_id, model_key)
-
-    ts_user = append_history(_cfg(), u["user_id"], "user", model_key, thread_id, dify_cid_in, message)
-    upsert_thread(_cfg(), u["user_id"], thread_id, message[:20], ts_user)
-
-    def generate():
-        answer_acc = ""
-        dify_cid = dify_cid_in
-
-        try:
-            with requests.post(
-                f"{_cfg().dify_api_base}/chat-messages",
-                headers={
-                    "Authorization": f"Bearer {api_key}",
-                    "Content-Type": "application/json",
-                },
-                json={
-                    "inputs": {},
-                    "query": message,
-                    "response_mode": "streaming",
-                    "conversation_id": dify_cid_in or "",
-                    "user": u["user_id"],
-                },
-                stream=True,
-                timeout=180,
-            ) as r:
-                r.raise_for_status()
-                yield sse_pack("meta", {"status": "start", "model": model_key, "ts": ts_user, "thread_id": thread_id})
-
-                for ev in iter_dify_sse(r):
-                    ev_type = ev.get("event")
-                    if ev.get("conversation_id"):
-                        dify_cid = ev["conversation_id"]
-
-                    if ev_type == "message":
-                        delta = ev.get("answer") or ""
-                        if delta:
-                            answer_acc += delta
-                            yield sse_pack("delta", {"text": delta})
-
-                    elif ev_type == "message_replace":
-                        rep = ev.get("answer") or ""
-                        answer_acc = rep
-                        yield sse_pack("replace", {"text": rep})
-
-                    elif ev_type == "message_end":
-                        ts_bot = append_history(_cfg(), u["user_id"], "bot", model_key, thread_id, dify_cid, answer_acc)
-                        set_dify_cid(_cfg(), u["user_id"], thread_id, model_key, dify_cid, ts_bot)
-                        upsert_thread(_cfg(), u["user_id"], thread_id, "", ts_bot)
-                        yield sse_pack("done", {"thread_id": thread_id, "answer": answer_acc, "model": model_key, "ts": ts_bot})
-                        break
-
-                    elif ev_type == "error":
-                        yield sse_pack("error", {"message": ev.get("message") or "Dify error"})
-                        break
-
-        except requests.HTTPError:
-            try:
-                body_txt = r.text  # type: ignore[name-defined]
-            except Exception:
-                body_txt = "Dify HTTP error"
-            yield sse_pack("error", {"message": body_txt})
-        except Exception as e:
-            yield sse_pack("error", {"message": str(e)})
+    # the turn runs on its own thread; this response (and any later resume) only reads its frames
+    run = start_chat_run(_cfg(), u["user_id"], model_key, thread_id, message, api_key)
+    if run is None:
+        return jsonify({"error": "generation already running", "code": "busy", "thread_id": thread_id}), 409
+    return _sse_response(iter_chat_run(run, 0))
 
+
+@bp.route("/api/chat/resume", methods=["GET", "POST"])
+@_api_login_required
+def api_chat_resume():
+    data = request.get_json(silent=True) or {}
+    thread_id = (request.args.get("thread_id") or data.get("thread_id") or "").strip()
+    if not thread_id:
+        return jsonify({"error": "thread_id is required"}), 400
+    run = chat_run_for(session["user_id"], thread_id)
+    if run is None:
+        # nothing in flight or retained: the answer (if any) is already in /api/history
+        return Response(status=204)
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or data.get("last_event_id") or ""
+    chat_run_note_resume()
+    return _sse_response(iter_chat_run(run, chat_run_cursor(run, last_id)))
+
+
+@bp.post("/api/chat/cancel")
+@_api_login_required
+def api_chat_cancel():
+    data = request.get_json(silent=True) or {}
+    thread_id = (data.get("thread_id") or "").strip()
+    run = chat_run_for(session["user_id"], thread_id) if thread_id else None
+    if run is None or run["done"]:
+        return jsonify({"ok": True, "running": False})
+    chat_run_cancel(run)
+    return jsonify({"ok": True, "running": True})
+
+
+def _sse_response(frames):
     return Response(
-        stream_with_context(generate()),
+        frames,
         mimetype="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
             "X-Accel-Buffering": "no",
         },
-    )
\ No newline at end of file
+    )
+
+
+@bp.get("/api/admin/answer-cache")
+@_api_admin_required
+def api_admin_answer_cache():
+    return jsonify(answer_cache_stats())
+
+
+@bp.post("/api/admin/answer-cache/invalidate")
+@_api_admin_required
+def api_admin_answer_cache_invalidate():
+    data = request.get_json(silent=True) or {}
+    model_key = (data.get("model_key") or "").strip()
+    if model_key and model_key not in MODELS:
+        return jsonify({"error": "invalid model_key"}), 400
+    removed = answer_cache_invalidate(model_key or None)
+    return jsonify({"ok": True, "model_key": model_key or "all", "removed": removed})
\ No newline at end of file
@@ -7,16 +7,19 @@ from ..core import (
     MODELS,
     DEFAULT_MODEL_KEY,
     active_feedback_dir,
-    append_feedback_md,
+    feedback_rebuild_job_status,
+    get_feedback_state,
     is_nas_available_cached,
     list_feedback_state_for_user_thread,
     load_user,
     mark_dirty_month,
-    maybe_rebuild_dirty_months,
+    nas_sync_status,
+    notify_spool_changed,
+    request_nas_probe,
     rebuild_feedback_md_for_model_months_in_dir,
-    sync_local_spool_to_nas_if_possible,
-    upsert_feedback_state_to_dir,
-    load_feedback_state_merged,
+    start_feedback_rebuild_job,
+    update_feedback_md,
+    upsert_feedback_state,
 )
 
 bp = Blueprint("api_feedback", __name__)
@@ -99,21 +102,15 @@ def api_feedback():
     stored_to = "local"
 
     try:
-        sync_local_spool_to_nas_if_possible(_cfg())
-
         target_dir = active_feedback_dir(_cfg())
         stored_to = "nas" if (target_dir == _cfg().feedback_dir_nas and is_nas_available_cached(_cfg())) else "local"
 
-        prev_rows = load_feedback_state_merged(_cfg())
-        prev_kind = "none"
-        prev_saved_at = ""
-        for r in prev_rows:
-            if (r.get("user_id") or "") == u["user_id"] and (r.get("model_key") or "") == model_key and (r.get("thread_id") or "") == thread_id and (r.get("bot_ts") or "") == bot_ts:
-                prev_kind = (r.get("kind") or "none").strip().lower()
-                prev_saved_at = r.get("saved_at") or ""
-                break
+        prev = get_feedback_state(_cfg(), user_id=u["user_id"], model_key=model_key, thread_id=thread_id, bot_ts=bot_ts)
+        prev_kind = prev["kind"] if prev else "none"
+        prev_saved_at = prev["saved_at"] if prev else ""
 
-        upsert_feedback_state_to_dir(
+        upsert_feedback_state(
+            _cfg(),
             dir_path=target_dir,
             user_id=u["user_id"],
             model_key=model_key,
@@ -125,31 +122,51 @@ def api_feedback():
             answer=str(answer),
         )
 
-        if kind in ("good", "bad"):
-            ym = append_feedback_md(
+        try:
+            update_feedback_md(
                 dir_path=target_dir,
+                user_id=u["user_id"],
                 model_key=model_key,
+                thread_id=thread_id,
+                bot_ts=bot_ts,
+                prev_kind=prev_kind,
+                prev_saved_at=prev_saved_at,
                 kind=kind,
                 saved_at=saved_at,
-                user_id=u["user_id"],
                 question=str(question),
                 answer=str(answer),
             )
-            if prev_kind in ("good", "bad") and prev_kind != kind:
-                mark_dirty_month(model_key, ym)
-        else:
-            ym_prev = re.sub(r"\D", "", (prev_saved_at or ""))[:6] if prev_saved_at else ""
-            if ym_prev:
-                mark_dirty_month(model_key, ym_prev)
+        except Exception:
+            # the state is already saved; let a month rebuild repair the md files
+            for sa in (prev_saved_at, saved_at if kind != "none" else ""):
+                ym = re.sub(r"\D", "", (sa or ""))[:6]
+                if ym:
+                    mark_dirty_month(target_dir, model_key, ym)
 
-        maybe_rebuild_dirty_months(_cfg(), target_dir, model_key)
+        if stored_to == "local":
+            notify_spool_changed()
 
     except Exception as e:
+        if stored_to == "nas":
+            request_nas_probe()
         return jsonify({"error": str(e)}), 500
 
     return jsonify({"ok": True, "kind": kind, "stored_to": stored_to})
 
 
+@bp.get("/api/feedback/sync")
+@_api_login_required
+def api_feedback_sync_status():
+    return jsonify(nas_sync_status(_cfg()))
+
+
+@bp.post("/api/feedback/sync")
+@_api_login_required
+def api_feedback_sync_kick():
+    notify_spool_changed()
+    return jsonify({"ok": True, "status": nas_sync_status(_cfg())}), 202
+
+
 @bp.post("/api/feedback/rebuild")
 @_api_login_required
 def api_feedback_rebuild():
@@ -167,6 +184,8 @@ def api_feedback_rebuild():
 
     target = (data.get("target") or "").strip().lower()
     if target == "nas":
+        if not is_nas_available_cached(_cfg()):
+            return jsonify({"error": "nas unavailable"}), 503
         target_dir = _cfg().feedback_dir_nas
     elif target == "local":
         target_dir = _cfg().feedback_dir_local
@@ -174,26 +193,14 @@ def api_feedback_rebuild():
         target_dir = active_feedback_dir(_cfg())
 
     if yyyymm in ("", "all"):
-        merged = load_feedback_state_merged(_cfg())
-        mk_months = {}
-        for r in merged:
-            mk = (r.get("model_key") or "").strip()
-            kd = (r.get("kind") or "").strip().lower()
-            if kd not in ("good", "bad"):
-                continue
-            if model_key and mk != model_key:
-                continue
-            sa = (r.get("saved_at") or "").strip()
-            ym = re.sub(r"\D", "", sa)[:6]
-            if not ym:
-                continue
-            mk_months.setdefault(mk, set()).add(ym)
-
-        rebuilt = []
-        for mk, months in mk_months.items():
-            rebuild_feedback_md_for_model_months_in_dir(target_dir, mk, set(months))
-            rebuilt.append({"model_key": mk, "months": sorted(list(months))})
-        return jsonify({"ok": True, "target_dir": target_dir, "rebuilt": rebuilt})
+        job = start_feedback_rebuild_job(_cfg(), target_dir, model_key)
+        return jsonify({
+            "ok": True,
+            "target_dir": target_dir,
+            "job_id": job["job_id"],
+            "status_url": f"/api/feedback/rebuild/{job['job_id']}",
+            "job": job,
+        }), 202
 
     ym = re.sub(r"\D", "", yyyymm)[:6]
     if not ym:
@@ -203,4 +210,13 @@ def api_feedback_rebuild():
         return jsonify({"error": "model_key required when yyyymm is specified"}), 400
 
     rebuild_feedback_md_for_model_months_in_dir(target_dir, model_key, {ym})
-    return jsonify({"ok": True, "target_dir": target_dir, "rebuilt": [{"model_key": model_key, "months": [ym]}]})
\ No newline at end of file
+    return jsonify({"ok": True, "target_dir": target_dir, "rebuilt": [{"model_key": model_key, "months": [ym]}]})
+
+
+@bp.get("/api/feedback/rebuild/<job_id>")
+@_api_login_required
+def api_feedback_rebuild_status(job_id: str):
+    job = feedback_rebuild_job_status(job_id)
+    if job is None:
+        return jsonify({"error": "not found"}), 404
+    return jsonify(job)
\ No newline at end of file
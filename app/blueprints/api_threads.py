@@ -5,8 +5,10 @@ from flask import Blueprint, Response, current_app, jsonify, request, session
 from ..core import (
     MODELS,
     DEFAULT_MODEL_KEY,
+    EXPORT_FORMATS,
     ensure_notice_file,
-    export_thread_as_csv,
+    iter_account_export_zip,
+    iter_thread_export,
     list_threads,
     load_user,
     read_history,
@@ -71,7 +73,12 @@ def api_history():
         return jsonify({"error": "user not found"}), 401
 
     tid = (request.args.get("thread_id") or "").strip() or None
-    rows = read_history(_cfg(), u["user_id"], tid, limit=200)
+    before = (request.args.get("before") or "").strip() or None
+    try:
+        limit = max(1, min(200, int(request.args.get("limit") or 200)))
+    except ValueError:
+        limit = 200
+    rows = read_history(_cfg(), u["user_id"], tid, limit=limit, before=before)
     items = [{
         "role": r["role"],
         "content": r["content"],
@@ -79,7 +86,12 @@ def api_history():
         "model_key": r["model_key"],
         "thread_id": r["thread_id"],
     } for r in rows]
-    return jsonify({"items": items})
+    has_more = len(rows) >= limit
+    return jsonify({
+        "items": items,
+        "has_more": has_more,
+        "next_before": rows[0]["timestamp"] if has_more else None,
+    })
 
 
 @bp.get("/api/export")
@@ -93,14 +105,41 @@ def api_export_csv():
     tid = (request.args.get("thread_id") or "").strip()
     if not tid:
         return jsonify({"error": "thread_id is required"}), 400
+    fmt = (request.args.get("format") or "csv").strip().lower()
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "invalid format"}), 400
+
+    mimetype, ext = EXPORT_FORMATS[fmt]
+    return Response(
+        iter_thread_export(_cfg(), u["user_id"], tid, fmt),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": f'attachment; filename="chat.{ext}"',
+            "Cache-Control": "no-store",
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+
+@bp.get("/api/export/all")
+@_api_login_required
+def api_export_all():
+    u = load_user(_cfg(), session["user_id"])
+    if not u:
+        session.clear()
+        return jsonify({"error": "user not found"}), 401
+
+    fmt = (request.args.get("format") or "csv").strip().lower()
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "invalid format"}), 400
 
-    csv_text = export_thread_as_csv(_cfg(), u["user_id"], tid)
     return Response(
-        csv_text,
-        mimetype="text/csv; charset=utf-8",
+        iter_account_export_zip(_cfg(), u["user_id"], fmt),
+        mimetype="application/zip",
         headers={
-            "Content-Disposition": 'attachment; filename="chat.csv"',
+            "Content-Disposition": f'attachment; filename="chat_{u["user_id"]}.zip"',
             "Cache-Control": "no-store",
+            "X-Accel-Buffering": "no",
         },
     )
 
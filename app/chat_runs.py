@@ -0,0 +1,617 @@
+import hashlib
+import json
+import time
+import unicodedata
+import uuid
+from datetime import datetime
+from collections import OrderedDict, deque
+from threading import Condition, Lock, Thread
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import requests
+
+from config import AppConfig
+
+from . import metrics
+from .admission import (
+    QUEUE_FULL_MESSAGE,
+    QUEUE_TIMEOUT_MESSAGE,
+    admission_enter,
+    admission_leave,
+    admission_position,
+    admission_timed_out,
+)
+from .core import append_history, get_dify_cid, read_history, set_dify_cid, submit_post_turn, upsert_thread
+from .dify import dify_chat_stream, dify_remember_conversation, dify_sse_stats, iter_dify_sse
+
+# Exact-match answer cache for models listed in ANSWER_CACHE_MODELS, keyed by
+# (model, normalized question). Only first turns of a thread are looked up
+# or stored: a follow-up depends on the Dify conversation behind it. A turn
+# is a first turn when the thread has no history rows yet; the conversation
+# id cannot tell, since a thread answered from the cache never gets one. Entries
+# expire after ANSWER_CACHE_TTL_SEC and the least recently used go first once
+# ANSWER_CACHE_MAX_ENTRIES is reached. The cache is per process.
+_acache_guard = Lock()
+_acache: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+_acache_counters: Dict[str, int] = {"stores": 0, "evictions": 0, "expired": 0, "invalidated": 0}
+_acache_lookups: Dict[str, Dict[str, int]] = {}
+
+# In-flight generations, one per (user, thread). A run owns the Dify call and
+# writes id-tagged frames into a bounded buffer; HTTP responses only read
+# from it, so a dropped client can reattach (Last-Event-ID or
+# /api/chat/resume) and the answer is persisted either way. Finished runs
+# stay around for CHAT_STREAM_RETAIN_SEC so a late reconnect still sees done.
+_runs_guard = Lock()
+_runs: Dict[Tuple[str, str], Dict[str, Any]] = {}
+_runs_stats: Dict[str, int] = {"started": 0, "finished": 0, "finished_detached": 0, "cancelled": 0, "resumes": 0, "gaps": 0}
+
+_sse_guard = Lock()
+_sse_stats: Dict[str, Any] = {"turns": 0, "deltas_in": 0, "delta_frames": 0, "delta_bytes": 0}
+
+
+def provisional_chat_turn(user_id: str, model_key: str, thread_id: str) -> Dict[str, Any]:
+    # stands in for the turn while it waits for admission; begin_chat_turn persists
+    # the user row only once a slot is granted, so a timeout or cancel leaves nothing behind
+    return {"user_id": user_id, "model_key": model_key, "thread_id": thread_id}
+
+
+def chat_turn_queued_meta(turn: Dict[str, Any], position: int, eta_sec: Optional[float]) -> Tuple[str, Dict[str, Any]]:
+    return ("meta", {
+        "status": "queued",
+        "model": turn["model_key"],
+        "thread_id": turn["thread_id"],
+        "position": position,
+        "eta_sec": eta_sec,
+    })
+
+
+def normalize_query(text: str) -> str:
+    s = unicodedata.normalize("NFKC", text or "").casefold()
+    return " ".join(s.split()).rstrip("?!。.、 ")
+
+
+def answer_cache_enabled(cfg: AppConfig, model_key: str) -> bool:
+    models = {m.strip() for m in (cfg.answer_cache_models or "").split(",") if m.strip()}
+    return "*" in models or model_key in models
+
+
+def answer_cache_get(cfg: AppConfig, model_key: str, query: str) -> Optional[str]:
+    k = (model_key, normalize_query(query))
+    now = time.time()
+    with _acache_guard:
+        cnt = _acache_lookups.setdefault(model_key, {"lookups": 0, "hits": 0})
+        cnt["lookups"] += 1
+        ent = _acache.get(k)
+        if ent is None:
+            return None
+        if now - ent["stored_at"] > cfg.answer_cache_ttl_sec:
+            del _acache[k]
+            _acache_counters["expired"] += 1
+            return None
+        _acache.move_to_end(k)
+        ent["hits"] += 1
+        cnt["hits"] += 1
+        return ent["answer"]
+
+
+def answer_cache_put(cfg: AppConfig, model_key: str, query: str, answer: str) -> None:
+    k = (model_key, normalize_query(query))
+    if not k[1]:
+        return
+    with _acache_guard:
+        _acache[k] = {"answer": answer, "stored_at": time.time(), "hits": 0}
+        _acache.move_to_end(k)
+        _acache_counters["stores"] += 1
+        while len(_acache) > max(1, cfg.answer_cache_max_entries):
+            _acache.popitem(last=False)
+            _acache_counters["evictions"] += 1
+
+
+def answer_cache_invalidate(model_key: Optional[str] = None) -> int:
+    with _acache_guard:
+        keys = [k for k in _acache if model_key is None or k[0] == model_key]
+        for k in keys:
+            del _acache[k]
+        _acache_counters["invalidated"] += len(keys)
+    return len(keys)
+
+
+def answer_cache_stats() -> Dict[str, Any]:
+    with _acache_guard:
+        out: Dict[str, Any] = dict(_acache_counters)
+        out["entries"] = len(_acache)
+        per_model: Dict[str, Any] = {}
+        for mk, cnt in _acache_lookups.items():
+            per_model[mk] = dict(cnt)
+            per_model[mk]["hit_rate"] = round(cnt["hits"] / cnt["lookups"], 3) if cnt["lookups"] else 0.0
+        for mk, _ in _acache:
+            per_model.setdefault(mk, {"lookups": 0, "hits": 0, "hit_rate": 0.0})
+            per_model[mk]["entries"] = per_model[mk].get("entries", 0) + 1
+    out["models"] = per_model
+    return out
+
+
+def _is_first_turn(cfg: AppConfig, user_id: str, thread_id: str) -> bool:
+    return not read_history(cfg, user_id, thread_id, limit=1)
+
+
+def cached_answer_for(cfg: AppConfig, user_id: str, model_key: str, thread_id: str, message: str) -> Optional[str]:
+    if not answer_cache_enabled(cfg, model_key):
+        return None
+    if not _is_first_turn(cfg, user_id, thread_id):
+        return None
+    return answer_cache_get(cfg, model_key, message)
+
+
+def sse_pack(event: str, data_obj: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data_obj, ensure_ascii=False)}\n\n"
+
+
+# One chat turn, shared by the WSGI (api_chat) and ASGI (app.asgi) streaming
+# paths so both speak the same SSE contract and persist the same rows: the
+# user row is written before Dify is called, the bot row, conversation id and
+# thread timestamp only once message_end arrives.
+#
+# Dify's per-token message events are coalesced into delta frames: pending
+# text is flushed once it reaches SSE_COALESCE_BYTES (SSE_FIRST_FLUSH_BYTES
+# for the first frame, so the first token is not held back) or has waited
+# SSE_COALESCE_MS. The WSGI path can only check the window when the next
+# event arrives; the ASGI path also flushes on a timer
+# (chat_turn_flush_timeout).
+
+_m_generation = metrics.histogram(
+    "chutgpt_generation_seconds",
+    "Dify request to message_end per answered turn.",
+    ("model",),
+    (0.5, 1, 2, 4, 8, 15, 30, 60, 120, 300),
+)
+_m_tokens_rate = metrics.histogram(
+    "chutgpt_generation_tokens_per_second",
+    "Completion tokens per second from the first delta to message_end.",
+    ("model",),
+    metrics.RATE_BUCKETS,
+)
+
+
+def begin_chat_turn(cfg: AppConfig, user_id: str, model_key: str, thread_id: str, message: str) -> Dict[str, Any]:
+    dify_cid_in = get_dify_cid(cfg, user_id, thread_id, model_key)
+    # checked before the user row below goes in
+    cacheable = not dify_cid_in and answer_cache_enabled(cfg, model_key) and _is_first_turn(cfg, user_id, thread_id)
+    ts_user = append_history(cfg, user_id, "user", model_key, thread_id, dify_cid_in, message)
+    upsert_thread(cfg, user_id, thread_id, message[:20], ts_user)
+    return {
+        "user_id": user_id,
+        "model_key": model_key,
+        "thread_id": thread_id,
+        "ts_user": ts_user,
+        "dify_cid": dify_cid_in,
+        "answer": "",
+        "pending": [],
+        "pending_bytes": 0,
+        "pending_since": 0.0,
+        "deltas_in": 0,
+        "delta_frames": 0,
+        "started_at": 0.0,
+        "first_delta_at": 0.0,
+        "completion_tokens": 0,
+        "coalesce_sec": max(0, cfg.sse_coalesce_ms) / 1000.0,
+        "coalesce_bytes": max(1, cfg.sse_coalesce_bytes),
+        "first_flush_bytes": max(1, cfg.sse_first_flush_bytes),
+        "done_mode": cfg.sse_done_mode,
+        "cacheable": cacheable,
+        "from_cache": False,
+        "payload": {
+            "inputs": {},
+            "query": message,
+            "response_mode": "streaming",
+            "conversation_id": dify_cid_in or "",
+            "user": user_id,
+        },
+    }
+
+
+def chat_turn_started(turn: Dict[str, Any]) -> None:
+    # call right before the Dify request; the generation metrics start here, after any queueing
+    turn["started_at"] = time.monotonic()
+
+
+def chat_turn_meta(turn: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    meta = {"status": "start", "model": turn["model_key"], "ts": turn["ts_user"], "thread_id": turn["thread_id"]}
+    if turn["from_cache"]:
+        meta["cached"] = True
+    return ("meta", meta)
+
+
+def replay_cached_turn(cfg: AppConfig, turn: Dict[str, Any], answer: str) -> Iterable[Tuple[str, Dict[str, Any]]]:
+    # same frames and history rows as a live turn; the thread just has no Dify conversation yet
+    turn["from_cache"] = True
+    turn["answer"] = answer
+    yield chat_turn_meta(turn)
+    step = max(1, turn["coalesce_bytes"])
+    for i in range(0, len(answer), step):
+        turn["delta_frames"] += 1
+        yield ("delta", {"text": answer[i:i + step]})
+    yield finish_chat_turn(cfg, turn)
+
+
+def chat_turn_flush(turn: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any]]]:
+    if not turn["pending"]:
+        return []
+    text = "".join(turn["pending"])
+    turn["pending"] = []
+    turn["pending_bytes"] = 0
+    turn["delta_frames"] += 1
+    return [("delta", {"text": text})]
+
+
+def chat_turn_flush_timeout(turn: Dict[str, Any], now: Optional[float] = None) -> Optional[float]:
+    # seconds until the pending text is due, None when nothing is pending
+    if not turn["pending"]:
+        return None
+    now = time.monotonic() if now is None else now
+    return max(0.0, turn["pending_since"] + turn["coalesce_sec"] - now)
+
+
+def _chat_turn_flush_due(turn: Dict[str, Any], now: float) -> bool:
+    if not turn["pending"]:
+        return False
+    limit = turn["first_flush_bytes"] if turn["delta_frames"] == 0 else turn["coalesce_bytes"]
+    return turn["pending_bytes"] >= limit or now - turn["pending_since"] >= turn["coalesce_sec"]
+
+
+def chat_turn_event(turn: Dict[str, Any], ev: Dict[str, Any]) -> Tuple[List[Tuple[str, Dict[str, Any]]], str]:
+    # -> (frames, status); status "end" means finish_chat_turn() must follow, "error" ends the stream
+    ev_type = ev.get("event")
+    if ev.get("conversation_id"):
+        turn["dify_cid"] = ev["conversation_id"]
+    now = time.monotonic()
+
+    if ev_type == "message":
+        delta = ev.get("answer") or ""
+        if delta:
+            turn["answer"] += delta
+            turn["deltas_in"] += 1
+            if not turn["first_delta_at"]:
+                turn["first_delta_at"] = now
+            if not turn["pending"]:
+                turn["pending_since"] = now
+            turn["pending"].append(delta)
+            turn["pending_bytes"] += len(delta.encode("utf-8"))
+    elif ev_type == "message_replace":
+        rep = ev.get("answer") or ""
+        turn["answer"] = rep
+        turn["pending"] = []
+        turn["pending_bytes"] = 0
+        return [("replace", {"text": rep})], ""
+    elif ev_type == "message_end":
+        usage = (ev.get("metadata") or {}).get("usage") or {}
+        try:
+            turn["completion_tokens"] = int(usage.get("completion_tokens") or 0)
+        except (TypeError, ValueError):
+            pass
+        return chat_turn_flush(turn), "end"
+    elif ev_type == "error":
+        return chat_turn_flush(turn) + [("error", {"message": ev.get("message") or "Dify error"})], "error"
+
+    if _chat_turn_flush_due(turn, now):
+        return chat_turn_flush(turn), ""
+    return [], ""
+
+
+def finish_chat_turn(cfg: AppConfig, turn: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    uid, mk, tid = turn["user_id"], turn["model_key"], turn["thread_id"]
+    cid, answer = turn["dify_cid"], turn["answer"]
+    # ts_bot is fixed here because done announces it; the writes follow on the post-turn queue
+    ts_bot = datetime.now().isoformat(timespec="seconds")
+    appended: List[bool] = []
+
+    def persist() -> None:
+        # may be rerun after a failure: the bot row goes in once, the other two are upserts
+        if not appended:
+            append_history(cfg, uid, "bot", mk, tid, cid, answer, ts=ts_bot)
+            appended.append(True)
+        set_dify_cid(cfg, uid, tid, mk, cid, ts_bot)
+        upsert_thread(cfg, uid, tid, "", ts_bot)
+
+    submit_post_turn(cfg, uid, persist)
+    if turn["cacheable"] and not turn["from_cache"] and turn["answer"]:
+        answer_cache_put(cfg, mk, turn["payload"]["query"], turn["answer"])
+    with _sse_guard:
+        _sse_stats["turns"] += 1
+        _sse_stats["deltas_in"] += turn["deltas_in"]
+        _sse_stats["delta_frames"] += turn["delta_frames"]
+        _sse_stats["delta_bytes"] += len(turn["answer"].encode("utf-8"))
+    _observe_generation(turn)
+    return ("done", chat_done_payload(turn, ts_bot))
+
+
+def _observe_generation(turn: Dict[str, Any]) -> None:
+    if turn["from_cache"] or not turn["started_at"]:
+        return
+    now = time.monotonic()
+    labels = (turn["model_key"],)
+    metrics.observe(_m_generation, labels, now - turn["started_at"])
+    # Dify reports usage on message_end; without it every message event counts as one token
+    tokens = turn["completion_tokens"] or turn["deltas_in"]
+    span = now - turn["first_delta_at"] if turn["first_delta_at"] else 0.0
+    if tokens and span > 0:
+        metrics.observe(_m_tokens_rate, labels, tokens / span)
+
+
+def chat_done_payload(turn: Dict[str, Any], ts_bot: str) -> Dict[str, Any]:
+    out: Dict[str, Any] = {"thread_id": turn["thread_id"], "model": turn["model_key"], "ts": ts_bot}
+    if turn["done_mode"] == "digest":
+        # the client already holds the text; it checks these and refetches the thread on a mismatch
+        b = turn["answer"].encode("utf-8")
+        out["bytes"] = len(b)
+        out["sha256"] = hashlib.sha256(b).hexdigest()
+    else:
+        out["answer"] = turn["answer"]
+    return out
+
+
+def sse_stats() -> Dict[str, Any]:
+    with _sse_guard:
+        out: Dict[str, Any] = dict(_sse_stats)
+    out.update(dify_sse_stats())
+    out["deltas_per_frame"] = round(out["deltas_in"] / out["delta_frames"], 2) if out["delta_frames"] else 0.0
+    return out
+
+
+def _chat_runs_sweep_locked(now: float) -> None:
+    for k in [k for k, r in _runs.items() if r["done"] and now - r["finished_at"] > r["retain_sec"]]:
+        del _runs[k]
+
+
+def open_chat_run(cfg: AppConfig, user_id: str, thread_id: str) -> Optional[Dict[str, Any]]:
+    # None while the thread already has a generation in flight
+    key = (user_id, thread_id)
+    with _runs_guard:
+        _chat_runs_sweep_locked(time.monotonic())
+        cur = _runs.get(key)
+        if cur is not None and not cur["done"]:
+            return None
+        run = {
+            "id": uuid.uuid4().hex[:12],
+            "key": key,
+            "cond": Condition(),
+            "frames": deque(maxlen=max(16, cfg.chat_stream_buffer_frames)),
+            "seq": 0,
+            "meta": None,
+            "text": "",
+            "text_seq": 0,
+            "done": False,
+            "cancelled": False,
+            "abort": None,
+            "finished_at": 0.0,
+            "retain_sec": cfg.chat_stream_retain_sec,
+            "subscribers": 0,
+            "wakers": set(),
+        }
+        _runs[key] = run
+        _runs_stats["started"] += 1
+    return run
+
+
+def chat_run_for(user_id: str, thread_id: str) -> Optional[Dict[str, Any]]:
+    with _runs_guard:
+        _chat_runs_sweep_locked(time.monotonic())
+        return _runs.get((user_id, thread_id))
+
+
+def _chat_run_wake_locked(run: Dict[str, Any]) -> None:
+    run["cond"].notify_all()
+    for w in list(run["wakers"]):
+        w()
+
+
+def chat_run_push(run: Dict[str, Any], frame: Tuple[str, Dict[str, Any]]) -> None:
+    event, data = frame
+    with run["cond"]:
+        if run["done"]:
+            return
+        run["seq"] += 1
+        seq = run["seq"]
+        if event == "delta":
+            run["text"] += data.get("text") or ""
+            run["text_seq"] = seq
+        elif event == "replace":
+            run["text"] = data.get("text") or ""
+            run["text_seq"] = seq
+        elif event == "meta":
+            run["meta"] = data
+            run["text_seq"] = seq
+        run["frames"].append((seq, f"id: {run['id']}.{seq}\n" + sse_pack(event, data)))
+        _chat_run_wake_locked(run)
+
+
+def chat_run_close(run: Dict[str, Any]) -> None:
+    with run["cond"]:
+        if run["done"]:
+            return
+        run["done"] = True
+        run["finished_at"] = time.monotonic()
+        detached = run["subscribers"] == 0
+        _chat_run_wake_locked(run)
+    with _runs_guard:
+        _runs_stats["finished"] += 1
+        if detached:
+            _runs_stats["finished_detached"] += 1
+
+
+def chat_run_on_cancel(run: Dict[str, Any], abort: Optional[Callable[[], None]]) -> None:
+    # abort interrupts whatever the producer is blocked on (the Dify read); None clears it
+    with run["cond"]:
+        run["abort"] = abort
+        now = abort is not None and run["cancelled"] and not run["done"]
+    if now:
+        abort()
+
+
+def chat_run_cancel(run: Dict[str, Any]) -> None:
+    with run["cond"]:
+        if run["done"] or run["cancelled"]:
+            return
+        run["cancelled"] = True
+        abort = run["abort"]
+    with _runs_guard:
+        _runs_stats["cancelled"] += 1
+    # a stalled upstream would otherwise hold the pool and admission slots until the read timeout
+    if abort is not None:
+        abort()
+
+
+def chat_run_cursor(run: Dict[str, Any], last_event_id: str) -> int:
+    # "<run id>.<seq>" from this run resumes after seq; anything else replays the run from the start
+    rid, _, seq = (last_event_id or "").strip().partition(".")
+    if rid != run["id"]:
+        return 0
+    try:
+        return max(0, int(seq))
+    except ValueError:
+        return 0
+
+
+def chat_run_take_locked(run: Dict[str, Any], after: int) -> Tuple[List[str], int, bool]:
+    # -> (frames after the cursor, new cursor, finished); call with run["cond"] held
+    frames = run["frames"]
+    out: List[str] = []
+    if frames and after < frames[0][0] - 1:
+        # evicted from the ring: rebuild the text the client is missing as one replace frame
+        with _runs_guard:
+            _runs_stats["gaps"] += 1
+        tag = f"id: {run['id']}.{run['text_seq']}\n"
+        if after == 0 and run["meta"] is not None:
+            out.append(tag + sse_pack("meta", run["meta"]))
+        out.append(tag + sse_pack("replace", {"text": run["text"]}))
+        after = run["text_seq"]
+    for seq, frame in frames:
+        if seq > after:
+            out.append(frame)
+    if frames:
+        after = max(after, frames[-1][0])
+    return out, after, run["done"] and after >= run["seq"]
+
+
+def iter_chat_run(run: Dict[str, Any], after: int = 0, keepalive_sec: float = 15.0) -> Iterable[str]:
+    with run["cond"]:
+        run["subscribers"] += 1
+    try:
+        while True:
+            with run["cond"]:
+                frames, after, finished = chat_run_take_locked(run, after)
+                if not frames and not finished:
+                    run["cond"].wait(keepalive_sec)
+                    frames, after, finished = chat_run_take_locked(run, after)
+            if not frames and not finished:
+                frames = [": keepalive\n\n"]
+            for frame in frames:
+                yield frame
+            if finished:
+                return
+    finally:
+        with run["cond"]:
+            run["subscribers"] -= 1
+
+
+def chat_run_note_resume() -> None:
+    with _runs_guard:
+        _runs_stats["resumes"] += 1
+
+
+def chat_runs_stats() -> Dict[str, Any]:
+    with _runs_guard:
+        out: Dict[str, Any] = dict(_runs_stats)
+        out["active"] = sum(1 for r in _runs.values() if not r["done"])
+        out["retained"] = len(_runs) - out["active"]
+    return out
+
+
+def _run_chat_turn(cfg: AppConfig, run: Dict[str, Any], user_id: str, model_key: str, thread_id: str, message: str, api_key: str) -> None:
+    push = lambda frame: chat_run_push(run, frame)  # noqa: E731
+    try:
+        cached = cached_answer_for(cfg, user_id, model_key, thread_id, message)
+        if cached is not None:
+            turn = begin_chat_turn(cfg, user_id, model_key, thread_id, message)
+            for frame in replay_cached_turn(cfg, turn, cached):
+                push(frame)
+            return
+
+        ticket = admission_enter(cfg, model_key)
+        if ticket is None:
+            push(("error", {"message": QUEUE_FULL_MESSAGE, "code": "queue_full"}))
+            return
+
+        try:
+            turn = provisional_chat_turn(user_id, model_key, thread_id)
+
+            deadline = time.monotonic() + cfg.dify_queue_timeout_sec
+            last_pos = None
+            while not ticket["event"].is_set():
+                if run["cancelled"]:
+                    push(("error", {"message": "cancelled", "code": "cancelled"}))
+                    return
+                pos, eta = admission_position(ticket)
+                if pos and pos != last_pos:
+                    last_pos = pos
+                    push(chat_turn_queued_meta(turn, pos, eta))
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    admission_timed_out(ticket)
+                    push(("error", {"message": QUEUE_TIMEOUT_MESSAGE, "code": "queue_timeout"}))
+                    return
+                ticket["event"].wait(min(1.0, left))
+
+            turn = begin_chat_turn(cfg, user_id, model_key, thread_id, message)
+            chat_turn_started(turn)
+            on_abort = lambda abort: chat_run_on_cancel(run, abort)  # noqa: E731
+            with dify_chat_stream(cfg, model_key, api_key, turn["payload"], on_abort=on_abort) as stream:
+                push(chat_turn_meta(turn))
+
+                for ev in iter_dify_sse(stream["chunks"]):
+                    if run["cancelled"]:
+                        push(("error", {"message": "cancelled", "code": "cancelled"}))
+                        break
+                    frames, status = chat_turn_event(turn, ev)
+                    for frame in frames:
+                        push(frame)
+                    if status == "end":
+                        dify_remember_conversation(turn["dify_cid"], stream["base"])
+                        push(finish_chat_turn(cfg, turn))
+                        break
+                    if status == "error":
+                        break
+                else:
+                    # an aborted read can also just look like the end of the body
+                    if run["cancelled"]:
+                        push(("error", {"message": "cancelled", "code": "cancelled"}))
+
+        except requests.HTTPError as e:
+            try:
+                body_txt = e.response.text if e.response is not None else "Dify HTTP error"
+            except Exception:
+                body_txt = "Dify HTTP error"
+            push(("error", {"message": body_txt}))
+        finally:
+            chat_run_on_cancel(run, None)
+            admission_leave(ticket)
+    except Exception as e:
+        if run["cancelled"]:
+            push(("error", {"message": "cancelled", "code": "cancelled"}))
+        else:
+            push(("error", {"message": str(e)}))
+    finally:
+        chat_run_close(run)
+
+
+def start_chat_run(cfg: AppConfig, user_id: str, model_key: str, thread_id: str, message: str, api_key: str) -> Optional[Dict[str, Any]]:
+    run = open_chat_run(cfg, user_id, thread_id)
+    if run is None:
+        return None
+    Thread(
+        target=_run_chat_turn,
+        args=(cfg, run, user_id, model_key, thread_id, message, api_key),
+        name=f"chat-run-{run['id']}",
+        daemon=True,
+    ).start()
+    return run
@@ -1,19 +1,27 @@
+import atexit
 import csv
+import functools
 import io
 import json
+import logging
 import os
 import re
+import shutil
 import time
 import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from threading import Lock
-from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
-
-import requests
-from flask import g
+from collections import OrderedDict, deque
+from threading import Condition, Event, Lock, RLock, Thread
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 from config import AppConfig
 
+from . import metrics
+
+_log = logging.getLogger(__name__)
+
 ID7_RE = re.compile(r"^\d{7}$")
 DEFAULT_MODEL_KEY = "seisan"
 
@@ -35,26 +43,173 @@ THREAD_FIELDS = ["thread_id", "name", "preview", "created_at", "updated_at"]
 MAP_FIELDS = ["thread_id", "model_key", "dify_conversation_id", "updated_at"]
 
 FEEDBACK_STATE_NAME = "feedback_state.csv"
+FEEDBACK_SHARD_DIR = "feedback_state"
 FEEDBACK_FIELDS = ["user_id", "model_key", "thread_id", "bot_ts", "kind", "saved_at", "question", "answer"]
 
-_file_locks: Dict[str, Lock] = {}
+_file_locks: Dict[str, "_PathLock"] = {}
 _file_locks_guard = Lock()
 
-_nas_ok_cache: Optional[bool] = None
-_nas_ok_checked_at: float = 0.0
+_csv_cache_guard = Lock()
+_csv_cache: "OrderedDict[str, Tuple[Tuple[int, int, int], List[str], List[Dict[str, str]]]]" = OrderedDict()
+_csv_cache_bytes = 0
+_csv_cache_max_bytes = 64 * 1024 * 1024
+_csv_cache_counters: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+_feedback_idx_guard = Lock()
+_feedback_idx: Dict[str, Dict[str, Any]] = {}
+
+_OFFSET_IDX_MAX_FILES = 1024
+_offset_idx_guard = Lock()
+_offset_idx: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+_history_pruned_on: Dict[str, str] = {}
+
+_hw_cond = Condition()
+_hw_pending: Dict[Tuple[str, str], List[Dict[str, str]]] = {}
+_hw_cfgs: Dict[str, AppConfig] = {}
+_hw_user_locks: Dict[Tuple[str, str], RLock] = {}
+_hw_thread: Optional[Thread] = None
+_hw_stats: Dict[str, Any] = {"enqueued": 0, "batches": 0, "rows_written": 0, "max_depth": 0, "last_batch_ms": 0.0, "errors": 0, "last_error": ""}
+
+# Post-turn persistence (see submit_post_turn): per-user FIFO of jobs, and
+# the users whose queue a worker is currently draining.
+_post_cond = Condition()
+_post_queues: Dict[Tuple[str, str], "deque[Callable[[], None]]"] = {}
+_post_running: Set[Tuple[str, str]] = set()
+_post_pool: Optional[ThreadPoolExecutor] = None
+_post_stats: Dict[str, Any] = {"submitted": 0, "done": 0, "errors": 0, "retries": 0, "dropped": 0, "last_error": "", "max_depth": 0, "last_job_ms": 0.0, "waits": 0, "wait_ms_max": 0.0, "wait_timeouts": 0}
+
+_journal_guard = Lock()
+_journal_compacting: Set[str] = set()
+
+_storages: Dict[str, Any] = {}
+_storages_guard = Lock()
+
+# Published NAS state. The monitor thread swaps in a new dict per probe, so
+# readers take a plain reference without any lock.
+_nas_state: Dict[str, Any] = {"ok": None, "checked_at": 0.0, "latency_ms": 0.0, "failures": 0}
 _nas_guard = Lock()
+_nas_monitor_thread: Optional[Thread] = None
+_nas_monitor_wake = Event()
+_nas_latency: "deque[Tuple[float, float, bool]]" = deque(maxlen=120)
+_nas_events: "deque[Dict[str, Any]]" = deque(maxlen=50)
+_nas_listeners: List[Callable[[bool], None]] = []
+
+_nas_sync_wake = Event()
+_nas_sync_guard = Lock()
+_nas_sync_thread: Optional[Thread] = None
+# spool snapshot being merged into the NAS and the deletes made meanwhile
+_nas_sync_inflight: Dict[str, Any] = {"dir": "", "tombstones": {}}
+_nas_sync_stats: Dict[str, Any] = {
+    "state": "stopped",
+    "runs": 0,
+    "merged_rows": 0,
+    "errors": 0,
+    "last_run_at": "",
+    "last_duration_ms": 0.0,
+    "last_report": None,
+    "last_error": "",
+}
+
+_md_idx_guard = Lock()
+_md_idx: Dict[str, Dict[str, Any]] = {}
+
+_rebuild_jobs_guard = Lock()
+_rebuild_jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+_md_sched_cond = Condition()
+_md_dirty: Dict[Tuple[str, str], Dict[str, Any]] = {}
+_md_running: Dict[Tuple[str, str], Set[str]] = {}
+_md_sched_thread: Optional[Thread] = None
+_md_dirty_file = ""
+_md_debounce_sec = 10.0
+_md_sched_stats: Dict[str, Any] = {"rebuilds": 0, "errors": 0, "last_ms": 0.0, "max_ms": 0.0, "total_ms": 0.0, "last_at": "", "last_error": ""}
+
+
+_m_http = metrics.histogram(
+    "chutgpt_http_request_duration_seconds",
+    "Time from request to response headers per route; SSE streams are not counted.",
+    ("route", "method", "status"),
+    metrics.LATENCY_BUCKETS,
+)
+_m_csv_read = metrics.histogram("chutgpt_csv_read_seconds", "CSV read latency per file type, cache hits included.", ("kind",), metrics.LATENCY_BUCKETS)
+_m_csv_write = metrics.histogram("chutgpt_csv_write_seconds", "CSV append/rewrite latency per file type.", ("kind",), metrics.LATENCY_BUCKETS)
+_m_lock_wait = metrics.histogram("chutgpt_path_lock_wait_seconds", "Time spent waiting for a per-file path lock.", ("kind",), metrics.WAIT_BUCKETS)
+_m_nas_probe = metrics.histogram("chutgpt_nas_probe_seconds", "NAS write-probe latency.", ("result",), metrics.LATENCY_BUCKETS)
+
+
+def observe_route(route: str, method: str, status: int, sec: float) -> None:
+    metrics.observe(_m_http, (route, method, str(status)), sec)
+
+
+def _path_kind(path: str) -> str:
+    # metric label of a data file: history, threads, map, feedback, feedback_md, user or other
+    d, name = os.path.split(path)
+    parent = os.path.basename(d)
+    if parent == "history" or name.startswith("history."):
+        return "history"
+    if name.startswith("threads."):
+        return "threads"
+    if name.startswith("thread_map."):
+        return "map"
+    if name == FEEDBACK_SHARD_DIR or parent == FEEDBACK_SHARD_DIR or name == FEEDBACK_STATE_NAME:
+        return "feedback"
+    if name.endswith(".md"):
+        return "feedback_md"
+    if name == "user.csv":
+        return "user"
+    return "other"
+
+
+class _PathLock:
+    # RLock that records how long each acquire waited; uncontended ones count as 0
+    __slots__ = ("_lk", "_labels")
+
+    def __init__(self, kind: str) -> None:
+        self._lk = RLock()
+        self._labels = (kind,)
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        if self._lk.acquire(False):
+            metrics.observe(_m_lock_wait, self._labels, 0.0)
+            return True
+        if not blocking:
+            return False
+        t0 = time.perf_counter()
+        ok = self._lk.acquire(True, timeout)
+        metrics.observe(_m_lock_wait, self._labels, time.perf_counter() - t0)
+        return ok
+
+    def release(self) -> None:
+        self._lk.release()
 
-_md_guard = Lock()
-_last_md_rebuild_at: Dict[str, float] = {}
-_dirty_months_by_model: Dict[str, Set[str]] = {}
+    def __enter__(self) -> bool:
+        return self.acquire()
 
+    def __exit__(self, *exc: Any) -> None:
+        self._lk.release()
 
-def _lock_for_path(path: str) -> Lock:
+
+def _timed_csv(hist: Dict[str, Any]):
+    # the wrapped function takes the CSV path as its first argument
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(path: str, *args: Any, **kwargs: Any):
+            t0 = time.perf_counter()
+            try:
+                return fn(path, *args, **kwargs)
+            finally:
+                metrics.observe(hist, (_path_kind(path),), time.perf_counter() - t0)
+        return wrapper
+    return deco
+
+
+def _lock_for_path(path: str) -> _PathLock:
     p = os.path.abspath(path)
     with _file_locks_guard:
         lk = _file_locks.get(p)
         if lk is None:
-            lk = Lock()
+            lk = _PathLock(_path_kind(p))
             _file_locks[p] = lk
         return lk
 
@@ -63,62 +218,476 @@ def ensure_dir(path: str) -> None:
     os.makedirs(path, exist_ok=True)
 
 
-def _csv_cache() -> Dict[str, Any]:
-    c = getattr(g, "_csv_cache", None)
-    if c is None:
-        c = {}
-        g._csv_cache = c
-    return c
+def _file_sig(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def configure_csv_cache(cfg: AppConfig) -> None:
+    global _csv_cache_max_bytes
+    with _csv_cache_guard:
+        _csv_cache_max_bytes = max(0, cfg.csv_cache_max_mb) * 1024 * 1024
+        _csv_cache_evict_locked()
 
 
+def csv_cache_stats() -> Dict[str, int]:
+    with _csv_cache_guard:
+        out = dict(_csv_cache_counters)
+        out["entries"] = len(_csv_cache)
+        out["bytes"] = _csv_cache_bytes
+        out["max_bytes"] = _csv_cache_max_bytes
+        return out
+
+
+def _csv_cache_evict_locked() -> None:
+    global _csv_cache_bytes
+    while _csv_cache and _csv_cache_bytes > _csv_cache_max_bytes:
+        _, (sig, _, _) = _csv_cache.popitem(last=False)
+        _csv_cache_bytes -= sig[1]
+        _csv_cache_counters["evictions"] += 1
+
+
+def _csv_cache_drop_locked(path: str) -> None:
+    global _csv_cache_bytes
+    ent = _csv_cache.pop(path, None)
+    if ent is not None:
+        _csv_cache_bytes -= ent[0][1]
+
+
+def _csv_cache_get(path: str, sig: Tuple[int, int, int], fieldnames: List[str]) -> Optional[List[Dict[str, str]]]:
+    with _csv_cache_guard:
+        ent = _csv_cache.get(path)
+        if ent is not None and ent[0] == sig and ent[1] == fieldnames:
+            _csv_cache.move_to_end(path)
+            _csv_cache_counters["hits"] += 1
+            return ent[2]
+        if ent is not None:
+            _csv_cache_drop_locked(path)
+        _csv_cache_counters["misses"] += 1
+        return None
+
+
+def _csv_cache_put(path: str, sig: Optional[Tuple[int, int, int]], fieldnames: List[str], rows: List[Dict[str, str]]) -> None:
+    global _csv_cache_bytes
+    with _csv_cache_guard:
+        _csv_cache_drop_locked(path)
+        if sig is None or sig[1] > _csv_cache_max_bytes:
+            return
+        _csv_cache[path] = (sig, list(fieldnames), rows)
+        _csv_cache_bytes += sig[1]
+        _csv_cache_evict_locked()
+
+
+def _csv_cache_extend(path: str, before: Optional[Tuple[int, int, int]], after: Optional[Tuple[int, int, int]], rows: List[List[Any]]) -> None:
+    global _csv_cache_bytes
+    with _csv_cache_guard:
+        ent = _csv_cache.get(path)
+        if ent is None:
+            return
+        if before is None or after is None or ent[0] != before:
+            _csv_cache_drop_locked(path)
+            _csv_cache_counters["invalidations"] += 1
+            return
+        fieldnames = ent[1]
+        added = []
+        for row in rows:
+            vals = ["" if v is None else str(v) for v in row]
+            added.append({k: (vals[i] if i < len(vals) else "") for i, k in enumerate(fieldnames)})
+        # copy-on-write: readers may still iterate the previous list
+        _csv_cache[path] = (after, fieldnames, ent[2] + added)
+        _csv_cache.move_to_end(path)
+        _csv_cache_bytes += after[1] - before[1]
+        _csv_cache_evict_locked()
+
+
+def _csv_cache_invalidate(path: str) -> None:
+    with _csv_cache_guard:
+        if path in _csv_cache:
+            _csv_cache_drop_locked(path)
+            _csv_cache_counters["invalidations"] += 1
+
+
+@_timed_csv(_m_csv_read)
 def csv_read_dicts_cached(path: str, fieldnames: List[str]) -> List[Dict[str, str]]:
-    cache = _csv_cache()
-    key = f"read::{path}"
-    if key in cache:
-        return cache[key]
+    p = os.path.abspath(path)
+    sig = _file_sig(p)
+    if sig is not None:
+        cached = _csv_cache_get(p, sig, fieldnames)
+        if cached is not None:
+            return cached
 
-    lk = _lock_for_path(path)
+    lk = _lock_for_path(p)
     with lk:
-        if not os.path.exists(path):
-            ensure_dir(os.path.dirname(path))
-            tmp = path + ".tmp"
-            with open(tmp, "w", newline="", encoding="utf-8") as f:
-                w = csv.DictWriter(f, fieldnames=fieldnames)
-                w.writeheader()
-            os.replace(tmp, path)
-
+        _ensure_csv_file_locked(p, fieldnames)
+        sig = _file_sig(p)
         out: List[Dict[str, str]] = []
-        with open(path, newline="", encoding="utf-8") as f:
+        with open(p, newline="", encoding="utf-8") as f:
             r = csv.DictReader(f)
             for row in r:
                 out.append({k: row.get(k, "") for k in fieldnames})
 
-    cache[key] = out
+    _csv_cache_put(p, sig, fieldnames, out)
     return out
 
 
-def csv_write_dicts_atomic(path: str, fieldnames: List[str], rows: List[Dict[str, str]]) -> None:
-    lk = _lock_for_path(path)
+def _ensure_csv_file_locked(path: str, fieldnames: List[str]) -> None:
+    if os.path.exists(path):
+        return
+    ensure_dir(os.path.dirname(path))
+    tmp = path + ".tmp"
+    with open(tmp, "w", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=fieldnames)
+        w.writeheader()
+    os.replace(tmp, path)
+
+
+def ensure_csv_file(path: str, fieldnames: List[str]) -> None:
+    p = os.path.abspath(path)
+    if os.path.exists(p):
+        return
+    lk = _lock_for_path(p)
+    with lk:
+        _ensure_csv_file_locked(p, fieldnames)
+
+
+@_timed_csv(_m_csv_write)
+def csv_write_dicts_atomic(path: str, fieldnames: List[str], rows: List[Dict[str, str]], index_field: Optional[str] = None) -> None:
+    p = os.path.abspath(path)
+    written: List[Dict[str, str]] = []
+    spans: List[Tuple[str, int, int]] = []
+    lk = _lock_for_path(p)
     with lk:
-        ensure_dir(os.path.dirname(path))
-        tmp = path + ".tmp"
-        with open(tmp, "w", newline="", encoding="utf-8") as f:
-            w = csv.DictWriter(f, fieldnames=fieldnames)
+        ensure_dir(os.path.dirname(p))
+        tmp = p + ".tmp"
+        buf = io.StringIO()
+        w = csv.DictWriter(buf, fieldnames=fieldnames)
+        with open(tmp, "wb") as f:
             w.writeheader()
+            f.write(buf.getvalue().encode("utf-8"))
+            header_end = f.tell()
             for r in rows:
-                w.writerow({k: r.get(k, "") for k in fieldnames})
-        os.replace(tmp, path)
-    _csv_cache().pop(f"read::{path}", None)
+                row = {k: r.get(k, "") for k in fieldnames}
+                buf.seek(0)
+                buf.truncate()
+                w.writerow(row)
+                start = f.tell()
+                f.write(buf.getvalue().encode("utf-8"))
+                vals = {k: ("" if v is None else str(v)) for k, v in row.items()}
+                written.append(vals)
+                if index_field:
+                    spans.append(((vals.get(index_field) or "").strip(), start, f.tell()))
+        os.replace(tmp, p)
+        sig = _file_sig(p)
+        if index_field:
+            _offset_index_save_locked(p, index_field, sig, list(fieldnames), header_end, spans)
+    _csv_cache_put(p, sig, fieldnames, written)
 
 
-def csv_append_row(path: str, row: List[str]) -> None:
-    lk = _lock_for_path(path)
+@_timed_csv(_m_csv_write)
+def csv_append_rows(path: str, rows: List[List[str]], index: Optional[Tuple[str, int]] = None, fsync: bool = False) -> None:
+    if not rows:
+        return
+    p = os.path.abspath(path)
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    chunks: List[bytes] = []
+    for row in rows:
+        buf.seek(0)
+        buf.truncate()
+        w.writerow(row)
+        chunks.append(buf.getvalue().encode("utf-8"))
+
+    lk = _lock_for_path(p)
+    with lk:
+        ensure_dir(os.path.dirname(p))
+        before = _file_sig(p)
+        with open(p, "ab") as f:
+            pos = f.seek(0, os.SEEK_END)
+            f.write(b"".join(chunks))
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        after = _file_sig(p)
+        if index is not None:
+            field, col = index
+            spans: List[Tuple[str, int, int]] = []
+            for row, data in zip(rows, chunks):
+                key = str(row[col] if col < len(row) and row[col] is not None else "").strip()
+                spans.append((key, pos, pos + len(data)))
+                pos += len(data)
+            _offset_index_note_append_locked(p, field, spans, before, after)
+    _csv_cache_extend(p, before, after, rows)
+
+
+def csv_append_row(path: str, row: List[str], index: Optional[Tuple[str, int]] = None) -> None:
+    csv_append_rows(path, [row], index=index)
+
+
+# Sidecar byte-offset index: "<name>.idx" next to the CSV maps one column's
+# value to the (start, end) byte spans of its records. All access happens
+# while holding the CSV's path lock, so offsets always match the file.
+
+def _offset_index_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".idx"
+
+
+def _iter_csv_record_spans(f, pos: int = 0) -> Iterable[Tuple[int, int, bytes]]:
+    parts: List[bytes] = []
+    start = pos
+    quotes = 0
+    for line in f:
+        parts.append(line)
+        quotes += line.count(b'"')
+        pos += len(line)
+        if quotes % 2 == 0:
+            yield start, pos, b"".join(parts)
+            parts = []
+            start = pos
+            quotes = 0
+    if parts:
+        yield start, pos, b"".join(parts)
+
+
+def _parse_csv_record(raw: bytes) -> List[str]:
+    return next(csv.reader(io.StringIO(raw.decode("utf-8"), newline="")), [])
+
+
+def _read_csv_header(path: str) -> List[str]:
+    with open(path, "rb") as f:
+        first = next(_iter_csv_record_spans(f), None)
+    return _parse_csv_record(first[2]) if first else []
+
+
+def _offset_index_remember(path: str, ent: Dict[str, Any]) -> None:
+    with _offset_idx_guard:
+        _offset_idx[path] = ent
+        _offset_idx.move_to_end(path)
+        while len(_offset_idx) > _OFFSET_IDX_MAX_FILES:
+            _offset_idx.popitem(last=False)
+
+
+def _offset_index_forget(path: str) -> None:
+    with _offset_idx_guard:
+        _offset_idx.pop(path, None)
+
+
+def _offset_index_save_locked(
+    path: str,
+    key_field: str,
+    sig: Optional[Tuple[int, int, int]],
+    header: List[str],
+    header_end: int,
+    spans: List[Tuple[str, int, int]],
+) -> Optional[Dict[str, Any]]:
+    if sig is None:
+        return None
+    ip = _offset_index_path(path)
+    by_key: Dict[str, List[Tuple[int, int]]] = {}
+    tmp = ip + ".tmp"
+    with open(tmp, "w", encoding="utf-8", newline="\n") as f:
+        f.write(f"#offidx1\t{sig[2]}\t{key_field}\t{header_end}\n")
+        for key, start, end in spans:
+            f.write(f"{json.dumps(key, ensure_ascii=False)}\t{start}\t{end}\n")
+            by_key.setdefault(key, []).append((start, end))
+    os.replace(tmp, ip)
+    ent = {"sig": sig, "key": key_field, "header": header, "spans": by_key}
+    _offset_index_remember(path, ent)
+    return ent
+
+
+def _offset_index_read_disk_locked(path: str, key_field: str, sig: Tuple[int, int, int]) -> Optional[Dict[str, Any]]:
+    by_key: Dict[str, List[Tuple[int, int]]] = {}
+    try:
+        with open(_offset_index_path(path), "r", encoding="utf-8", newline="\n") as f:
+            head = f.readline().rstrip("\n").split("\t")
+            if len(head) != 4 or head[0] != "#offidx1" or head[2] != key_field or int(head[1]) != sig[2]:
+                return None
+            end = int(head[3])
+            for line in f:
+                parts = line.rstrip("\n").rsplit("\t", 2)
+                if len(parts) != 3:
+                    return None
+                start, stop = int(parts[1]), int(parts[2])
+                by_key.setdefault(json.loads(parts[0]), []).append((start, stop))
+                end = max(end, stop)
+    except (OSError, ValueError):
+        return None
+    if end != sig[1]:
+        return None
+    return {"sig": sig, "key": key_field, "header": _read_csv_header(path), "spans": by_key}
+
+
+def _offset_index_rebuild_locked(path: str, key_field: str) -> Dict[str, Any]:
+    sig = _file_sig(path)
+    header: List[str] = []
+    header_end = 0
+    spans: List[Tuple[str, int, int]] = []
+    with open(path, "rb") as f:
+        it = _iter_csv_record_spans(f)
+        first = next(it, None)
+        if first is not None:
+            header = _parse_csv_record(first[2])
+            header_end = first[1]
+        col = header.index(key_field) if key_field in header else -1
+        for start, end, raw in it:
+            vals = _parse_csv_record(raw) if col >= 0 else []
+            key = vals[col].strip() if col < len(vals) and col >= 0 else ""
+            spans.append((key, start, end))
+    ent = _offset_index_save_locked(path, key_field, sig, header, header_end, spans)
+    return ent or {"sig": sig, "key": key_field, "header": header, "spans": {}}
+
+
+def _offset_index_peek_locked(path: str, key_field: str) -> Optional[Dict[str, Any]]:
+    sig = _file_sig(path)
+    with _offset_idx_guard:
+        ent = _offset_idx.get(path)
+        if ent is not None and ent["sig"] == sig and ent["key"] == key_field:
+            _offset_idx.move_to_end(path)
+            return ent
+    if sig is not None:
+        ent = _offset_index_read_disk_locked(path, key_field, sig)
+        if ent is not None:
+            _offset_index_remember(path, ent)
+            return ent
+    return None
+
+
+def _offset_index_get_locked(path: str, key_field: str) -> Dict[str, Any]:
+    return _offset_index_peek_locked(path, key_field) or _offset_index_rebuild_locked(path, key_field)
+
+
+def _offset_index_note_append_locked(
+    path: str,
+    key_field: str,
+    spans: List[Tuple[str, int, int]],
+    before: Optional[Tuple[int, int, int]],
+    after: Optional[Tuple[int, int, int]],
+) -> None:
+    ent = None
+    if before is not None and after is not None and spans and spans[0][1] == before[1]:
+        with _offset_idx_guard:
+            ent = _offset_idx.get(path)
+        if ent is None or ent["sig"] != before or ent["key"] != key_field:
+            ent = _offset_index_read_disk_locked(path, key_field, before)
+    if ent is None:
+        _offset_index_forget(path)
+        try:
+            os.remove(_offset_index_path(path))
+        except OSError:
+            pass
+        return
+    with open(_offset_index_path(path), "a", encoding="utf-8", newline="\n") as f:
+        f.write("".join(f"{json.dumps(key, ensure_ascii=False)}\t{start}\t{end}\n" for key, start, end in spans))
+    for key, start, end in spans:
+        ent["spans"].setdefault(key, []).append((start, end))
+    ent["sig"] = after
+    _offset_index_remember(path, ent)
+
+
+@_timed_csv(_m_csv_read)
+def csv_read_rows_by_key(path: str, fieldnames: List[str], key_field: str, key: str) -> List[Dict[str, str]]:
+    p = os.path.abspath(path)
+    out: List[Dict[str, str]] = []
+    lk = _lock_for_path(p)
+    with lk:
+        if not os.path.exists(p):
+            return out
+        ent = _offset_index_get_locked(p, key_field)
+        spans = ent["spans"].get(key) or []
+        if not spans:
+            return out
+        header = ent["header"]
+        with open(p, "rb") as f:
+            for start, end in spans:
+                f.seek(start)
+                row = dict(zip(header, _parse_csv_record(f.read(end - start))))
+                out.append({k: row.get(k, "") for k in fieldnames})
+    return out
+
+
+_TAIL_BLOCK = 64 * 1024
+
+
+def _iter_csv_records_reverse(f, start: int, end: int) -> Iterable[bytes]:
+    # Walks [start, end) backwards in blocks, newest record first. With every
+    # record quote-balanced, a newline ends a record iff an even number of
+    # quotes follows it, so only the bytes after the last boundary are counted.
+    buf = b""
+    i = 0
+    quotes = 0
+    pos = end
+    while pos > start:
+        n = min(_TAIL_BLOCK, pos - start)
+        pos -= n
+        f.seek(pos)
+        buf = f.read(n) + buf
+        i += n
+        while True:
+            j = buf.rfind(b"\n", 0, i)
+            if j < 0:
+                break
+            quotes += buf.count(b'"', j + 1, i)
+            i = j
+            if quotes % 2 == 0:
+                if j + 1 < len(buf):
+                    yield buf[j + 1:]
+                buf = buf[:j + 1]
+                quotes = 0
+    if buf:
+        yield buf
+
+
+@_timed_csv(_m_csv_read)
+def csv_scan_rows_reverse(
+    path: str,
+    fieldnames: List[str],
+    key_field: str,
+    key: str,
+    visit: Callable[[Dict[str, str]], bool],
+) -> bool:
+    p = os.path.abspath(path)
+    lk = _lock_for_path(p)
     with lk:
-        ensure_dir(os.path.dirname(path))
-        with open(path, "a", newline="", encoding="utf-8") as f:
-            w = csv.writer(f)
-            w.writerow(row)
-    _csv_cache().pop(f"read::{path}", None)
+        sig = _file_sig(p)
+        if sig is None:
+            return True
+        with open(p, "rb") as f:
+            ent = _offset_index_peek_locked(p, key_field)
+            if ent is None and sig[1] > 0:
+                f.seek(sig[1] - 1)
+                if f.read(1) != b"\n":
+                    ent = _offset_index_rebuild_locked(p, key_field)
+            if ent is not None:
+                header = ent["header"]
+                for start, end in reversed(ent["spans"].get(key) or []):
+                    f.seek(start)
+                    row = dict(zip(header, _parse_csv_record(f.read(end - start))))
+                    if not visit({k: row.get(k, "") for k in fieldnames}):
+                        return False
+                return True
+
+            f.seek(0)
+            first = next(_iter_csv_record_spans(f), None)
+            if first is None:
+                return True
+            header = _parse_csv_record(first[2])
+            if key_field not in header:
+                return True
+            col = header.index(key_field)
+            needle = key.encode("utf-8") if '"' not in key else b""
+            for raw in _iter_csv_records_reverse(f, first[1], sig[1]):
+                if needle not in raw:
+                    continue
+                vals = _parse_csv_record(raw)
+                if col >= len(vals) or vals[col].strip() != key:
+                    continue
+                row = dict(zip(header, vals))
+                if not visit({k: row.get(k, "") for k in fieldnames}):
+                    return False
+    return True
 
 
 def ensure_notice_file(cfg: AppConfig) -> None:
@@ -149,16 +718,101 @@ def _is_dir_writable(path: str) -> bool:
         return False
 
 
-def is_nas_available_cached(cfg: AppConfig) -> bool:
-    global _nas_ok_cache, _nas_ok_checked_at
+def _probe_nas(cfg: AppConfig) -> bool:
+    global _nas_state
+    t0 = time.perf_counter()
+    ok = _is_dir_writable(cfg.feedback_dir_nas)
+    ms = round((time.perf_counter() - t0) * 1000.0, 2)
     now = time.time()
+    prev = _nas_state
+    _nas_state = {
+        "ok": ok,
+        "checked_at": now,
+        "latency_ms": ms,
+        "failures": 0 if ok else prev["failures"] + 1,
+    }
+    _nas_latency.append((now, ms, ok))
+    metrics.observe(_m_nas_probe, ("ok" if ok else "fail",), ms / 1000.0)
+    if prev["ok"] != ok:
+        _nas_events.append({"at": datetime.fromtimestamp(now).isoformat(timespec="seconds"), "ok": ok, "latency_ms": ms})
+        for fn in list(_nas_listeners):
+            try:
+                fn(ok)
+            except Exception:
+                pass
+    return ok
+
+
+def _nas_next_probe_delay(cfg: AppConfig, st: Dict[str, Any]) -> float:
+    base = float(max(1, cfg.nas_check_ttl_sec))
+    if st["ok"]:
+        return base
+    return min(float(max(base, cfg.nas_backoff_max_sec)), base * (2 ** min(max(0, st["failures"] - 1), 16)))
+
+
+def _nas_monitor_loop(cfg: AppConfig) -> None:
+    while True:
+        _nas_monitor_wake.wait(_nas_next_probe_delay(cfg, _nas_state))
+        _nas_monitor_wake.clear()
+        _probe_nas(cfg)
+
+
+def start_nas_monitor(cfg: AppConfig) -> None:
+    global _nas_monitor_thread
     with _nas_guard:
-        if _nas_ok_cache is not None and (now - _nas_ok_checked_at) < cfg.nas_check_ttl_sec:
-            return _nas_ok_cache
-        ok = _is_dir_writable(cfg.feedback_dir_nas)
-        _nas_ok_cache = ok
-        _nas_ok_checked_at = now
-        return ok
+        if _nas_monitor_thread is not None and _nas_monitor_thread.is_alive():
+            return
+        if _nas_state["ok"] is None:
+            _probe_nas(cfg)
+        _nas_monitor_thread = Thread(target=_nas_monitor_loop, args=(cfg,), name="nas-monitor", daemon=True)
+        _nas_monitor_thread.start()
+
+
+def add_nas_state_listener(fn: Callable[[bool], None]) -> None:
+    with _nas_guard:
+        if fn not in _nas_listeners:
+            _nas_listeners.append(fn)
+
+
+def request_nas_probe() -> None:
+    _nas_monitor_wake.set()
+
+
+def is_nas_available_cached(cfg: AppConfig) -> bool:
+    st = _nas_state
+    if _nas_monitor_thread is not None:
+        return bool(st["ok"])
+    # no monitor thread (CLI tools): probe inline once the TTL has passed
+    if st["ok"] is not None and (time.time() - st["checked_at"]) < cfg.nas_check_ttl_sec:
+        return bool(st["ok"])
+    with _nas_guard:
+        st = _nas_state
+        if st["ok"] is not None and (time.time() - st["checked_at"]) < cfg.nas_check_ttl_sec:
+            return bool(st["ok"])
+        return _probe_nas(cfg)
+
+
+def nas_health_stats(cfg: AppConfig) -> Dict[str, Any]:
+    st = _nas_state
+    samples = list(_nas_latency)
+    lat = sorted(ms for _, ms, _ in samples)
+
+    def pct(q: float) -> float:
+        return lat[min(len(lat) - 1, int(q * len(lat)))] if lat else 0.0
+
+    return {
+        "ok": st["ok"],
+        "monitor": _nas_monitor_thread is not None and _nas_monitor_thread.is_alive(),
+        "checked_at": datetime.fromtimestamp(st["checked_at"]).isoformat(timespec="seconds") if st["checked_at"] else "",
+        "latency_ms": st["latency_ms"],
+        "consecutive_failures": st["failures"],
+        "next_probe_in_sec": round(max(0.0, st["checked_at"] + _nas_next_probe_delay(cfg, st) - time.time()), 1),
+        "latency_p50_ms": pct(0.5),
+        "latency_p95_ms": pct(0.95),
+        "latency_max_ms": lat[-1] if lat else 0.0,
+        "recent": [{"ms": ms, "ok": ok} for _, ms, ok in samples[-10:]],
+        "events": list(_nas_events),
+    }
 
 
 def active_feedback_dir(cfg: AppConfig) -> str:
@@ -177,6 +831,14 @@ def history_csv_path(cfg: AppConfig, user_id: str) -> str:
     return os.path.join(user_dir(cfg, user_id), "history.csv")
 
 
+def history_dir_path(cfg: AppConfig, user_id: str) -> str:
+    return os.path.join(user_dir(cfg, user_id), "history")
+
+
+def history_segment_path(cfg: AppConfig, user_id: str, ymd: str) -> str:
+    return os.path.join(history_dir_path(cfg, user_id), f"{ymd}.csv")
+
+
 def threads_csv_path(cfg: AppConfig, user_id: str) -> str:
     return os.path.join(user_dir(cfg, user_id), "threads.csv")
 
@@ -186,17 +848,18 @@ def map_csv_path(cfg: AppConfig, user_id: str) -> str:
 
 
 def ensure_all_user_csv(cfg: AppConfig, user_id: str) -> None:
-    ensure_dir(user_dir(cfg, user_id))
-    csv_read_dicts_cached(history_csv_path(cfg, user_id), HISTORY_FIELDS)
-    csv_read_dicts_cached(threads_csv_path(cfg, user_id), THREAD_FIELDS)
-    csv_read_dicts_cached(map_csv_path(cfg, user_id), MAP_FIELDS)
+    ensure_dir(history_dir_path(cfg, user_id))
+    if os.path.exists(history_csv_path(cfg, user_id)):
+        migrate_history_to_segments(cfg, user_id)
+    ensure_csv_file(threads_csv_path(cfg, user_id), THREAD_FIELDS)
+    ensure_csv_file(map_csv_path(cfg, user_id), MAP_FIELDS)
 
 
-def user_exists(cfg: AppConfig, user_id: str) -> bool:
+def _csv_user_exists(cfg: AppConfig, user_id: str) -> bool:
     return os.path.exists(user_csv_path(cfg, user_id))
 
 
-def load_user(cfg: AppConfig, user_id: str) -> Optional[Dict[str, str]]:
+def _csv_load_user(cfg: AppConfig, user_id: str) -> Optional[Dict[str, str]]:
     p = user_csv_path(cfg, user_id)
     if not os.path.exists(p):
         return None
@@ -223,7 +886,7 @@ def load_user(cfg: AppConfig, user_id: str) -> Optional[Dict[str, str]]:
     }
 
 
-def save_user(cfg: AppConfig, u: Dict[str, str]) -> None:
+def _csv_save_user(cfg: AppConfig, u: Dict[str, str]) -> None:
     ensure_all_user_csv(cfg, u["user_id"])
     p = user_csv_path(cfg, u["user_id"])
     csv_write_dicts_atomic(p, USER_FIELDS, [{
@@ -234,7 +897,7 @@ def save_user(cfg: AppConfig, u: Dict[str, str]) -> None:
     }])
 
 
-def create_user_files(cfg: AppConfig, user_id: str, password: str) -> None:
+def _csv_create_user_files(cfg: AppConfig, user_id: str, password: str) -> None:
     ensure_all_user_csv(cfg, user_id)
     p = user_csv_path(cfg, user_id)
     csv_write_dicts_atomic(p, USER_FIELDS, [{
@@ -255,203 +918,373 @@ def resolve_api_key(cfg: AppConfig, model_key: str) -> str:
     return (os.environ.get(env_key) or "").strip() or cfg.default_dify_api_key
 
 
-def _last_prune_path(cfg: AppConfig, user_id: str) -> str:
-    return os.path.join(user_dir(cfg, user_id), ".last_prune.txt")
+# History is partitioned into one CSV per day under users/<id>/history/
+# (YYYYMMDD.csv, each with its own .idx sidecar). Retention drops whole
+# segments, and reads walk the segments newest first.
 
+_SEGMENT_RE = re.compile(r"^(\d{8})\.csv$")
 
-def _read_last_prune(cfg: AppConfig, user_id: str) -> str:
-    p = _last_prune_path(cfg, user_id)
-    lk = _lock_for_path(p)
-    with lk:
-        try:
-            with open(p, "r", encoding="utf-8") as f:
-                return (f.read() or "").strip()
-        except Exception:
-            return ""
 
+def _ymd_from_iso(iso: str) -> str:
+    return re.sub(r"\D", "", (iso or ""))[:8]
 
-def _write_last_prune(cfg: AppConfig, user_id: str, ymd: str) -> None:
-    p = _last_prune_path(cfg, user_id)
+
+def _history_segments(cfg: AppConfig, user_id: str) -> List[Tuple[str, str]]:
+    d = history_dir_path(cfg, user_id)
+    try:
+        names = os.listdir(d)
+    except OSError:
+        return []
+    out = []
+    for name in names:
+        m = _SEGMENT_RE.match(name)
+        if m:
+            out.append((m.group(1), os.path.join(d, name)))
+    out.sort()
+    return out
+
+
+def _drop_csv_file(path: str) -> None:
+    p = os.path.abspath(path)
     lk = _lock_for_path(p)
     with lk:
-        ensure_dir(os.path.dirname(p))
-        tmp = p + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            f.write(ymd)
-        os.replace(tmp, p)
+        for f in (p, _offset_index_path(p)):
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+        _offset_index_forget(p)
+    _csv_cache_invalidate(p)
 
 
 def prune_history_14days(cfg: AppConfig, user_id: str) -> None:
-    ensure_all_user_csv(cfg, user_id)
     today = datetime.now().strftime("%Y-%m-%d")
-    if _read_last_prune(cfg, user_id) == today:
+    key = user_dir(cfg, user_id)
+    if _history_pruned_on.get(key) == today:
         return
 
-    cutoff = datetime.now() - timedelta(days=14)
-    path = history_csv_path(cfg, user_id)
-    rows = csv_read_dicts_cached(path, HISTORY_FIELDS)
-
-    kept: List[Dict[str, str]] = []
-    for row in rows:
-        ts = (row.get("timestamp") or "").strip()
-        try:
-            dt = datetime.fromisoformat(ts)
-        except Exception:
-            kept.append({k: row.get(k, "") for k in HISTORY_FIELDS})
-            continue
-        if dt >= cutoff:
-            kept.append({k: row.get(k, "") for k in HISTORY_FIELDS})
-
-    csv_write_dicts_atomic(path, HISTORY_FIELDS, kept)
-    _write_last_prune(cfg, user_id, today)
-
-
-def append_history(cfg: AppConfig, user_id: str, role: str, model_key: str, thread_id: str, dify_cid: str, content: str) -> str:
+    cutoff = (datetime.now() - timedelta(days=14)).strftime("%Y%m%d")
+    for ymd, path in _history_segments(cfg, user_id):
+        if ymd < cutoff:
+            _drop_csv_file(path)
+    _history_pruned_on[key] = today
+
+
+def _move_to_backup(src: str, backup_dir: str, *parts: str) -> str:
+    # "<backup_dir>/migrated_<yyyymmdd_hhmmss>/<parts>": tools/backup_rotate.py ages the
+    # folder out by the date in its name. shutil.move, since the source may be on the NAS.
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    dest = base = os.path.join(backup_dir, f"migrated_{stamp}", *parts)
+    n = 1
+    while os.path.exists(dest):
+        dest = f"{base}.{n}"
+        n += 1
+    ensure_dir(os.path.dirname(dest))
+    shutil.move(src, dest)
+    return dest
+
+
+def migrate_history_to_segments(cfg: AppConfig, user_id: str) -> Dict[str, int]:
+    legacy = history_csv_path(cfg, user_id)
+    report = {"rows": 0, "segments": 0}
+    lk = _lock_for_path(legacy)
+    with lk:
+        if not os.path.exists(legacy):
+            return report
+        fallback_ymd = datetime.fromtimestamp(os.path.getmtime(legacy)).strftime("%Y%m%d")
+        by_day: Dict[str, List[Dict[str, str]]] = {}
+        for row in csv_read_dicts_cached(legacy, HISTORY_FIELDS):
+            ymd = _ymd_from_iso(row.get("timestamp") or "")
+            if len(ymd) != 8:
+                ymd = fallback_ymd
+            by_day.setdefault(ymd, []).append(row)
+
+        for ymd, rows in sorted(by_day.items()):
+            seg = history_segment_path(cfg, user_id, ymd)
+            existing = csv_read_dicts_cached(seg, HISTORY_FIELDS) if os.path.exists(seg) else []
+            csv_write_dicts_atomic(seg, HISTORY_FIELDS, rows + existing, index_field="thread_id")
+            report["rows"] += len(rows)
+            report["segments"] += 1
+
+        _move_to_backup(legacy, cfg.backup_dir, "users", user_id, os.path.basename(legacy))
+        _drop_csv_file(legacy)
+    return report
+
+
+def _csv_append_history(cfg: AppConfig, user_id: str, role: str, model_key: str, thread_id: str, dify_cid: str, content: str) -> str:
     ensure_all_user_csv(cfg, user_id)
     ts = datetime.now().isoformat(timespec="seconds")
-    csv_append_row(history_csv_path(cfg, user_id), [ts, role, model_key, thread_id, dify_cid or "", content])
+    seg = history_segment_path(cfg, user_id, _ymd_from_iso(ts))
+    ensure_csv_file(seg, HISTORY_FIELDS)
+    csv_append_row(
+        seg,
+        [ts, role, model_key, thread_id, dify_cid or "", content],
+        index=("thread_id", HISTORY_FIELDS.index("thread_id")),
+    )
     prune_history_14days(cfg, user_id)
     return ts
 
 
-def read_history(cfg: AppConfig, user_id: str, thread_id: Optional[str], limit: int = 200) -> List[Dict[str, str]]:
-    if not thread_id:
-        return []
+def _csv_append_history_rows(cfg: AppConfig, user_id: str, rows: List[Dict[str, str]], fsync: bool = False) -> None:
     ensure_all_user_csv(cfg, user_id)
-    rows = csv_read_dicts_cached(history_csv_path(cfg, user_id), HISTORY_FIELDS)
+    by_seg: Dict[str, List[List[str]]] = {}
+    for r in rows:
+        seg = history_segment_path(cfg, user_id, _ymd_from_iso(r.get("timestamp") or ""))
+        by_seg.setdefault(seg, []).append([r.get(k) or "" for k in HISTORY_FIELDS])
+    for seg, vals in by_seg.items():
+        ensure_csv_file(seg, HISTORY_FIELDS)
+        csv_append_rows(seg, vals, index=("thread_id", HISTORY_FIELDS.index("thread_id")), fsync=fsync)
+    try:
+        prune_history_14days(cfg, user_id)
+    except OSError:
+        # the rows are on disk; failing here would make the write-behind append them again
+        pass
 
-    out: List[Dict[str, str]] = []
-    for row in rows:
-        if (row.get("thread_id") or "").strip() != thread_id:
-            continue
-        out.append({
-            "timestamp": row.get("timestamp") or "",
-            "role": row.get("role") or "",
-            "model_key": row.get("model_key") or DEFAULT_MODEL_KEY,
-            "thread_id": thread_id,
-            "content": row.get("content") or "",
-        })
 
-    if len(out) > limit:
-        out = out[-limit:]
+def _csv_iter_history_rows(cfg: AppConfig, user_id: str) -> Iterable[Dict[str, str]]:
+    ensure_all_user_csv(cfg, user_id)
+    for _, seg in _history_segments(cfg, user_id):
+        yield from csv_read_dicts_cached(seg, HISTORY_FIELDS)
+
+
+def _history_items(rows: List[Dict[str, str]], thread_id: str) -> List[Dict[str, str]]:
+    return [{
+        "timestamp": row.get("timestamp") or "",
+        "role": row.get("role") or "",
+        "model_key": row.get("model_key") or DEFAULT_MODEL_KEY,
+        "thread_id": thread_id,
+        "content": row.get("content") or "",
+    } for row in rows]
+
+
+def _history_tail_visitor(limit: int, before: Optional[str]) -> Tuple[List[Any], Callable[[Any], bool]]:
+    # Fed newest-first. A page never splits rows sharing a timestamp, so the
+    # oldest timestamp of one page is an exact "before" cursor for the next.
+    out: List[Any] = []
+
+    def visit(row: Any) -> bool:
+        ts = row["timestamp"] or ""
+        if before and ts >= before:
+            return True
+        if len(out) >= limit and ts != (out[-1]["timestamp"] or ""):
+            return False
+        out.append(row)
+        return True
+
+    return out, visit
+
+
+def history_tail(rows: Iterable[Any], limit: int, before: Optional[str] = None) -> List[Any]:
+    out, visit = _history_tail_visitor(limit, before)
+    for row in rows:
+        if not visit(row):
+            break
+    out.reverse()
     return out
 
 
-def read_history_all(cfg: AppConfig, user_id: str, thread_id: str) -> List[Dict[str, str]]:
+def _csv_read_history(
+    cfg: AppConfig,
+    user_id: str,
+    thread_id: Optional[str],
+    limit: int = 200,
+    before: Optional[str] = None,
+) -> List[Dict[str, str]]:
+    if not thread_id:
+        return []
     ensure_all_user_csv(cfg, user_id)
-    rows = csv_read_dicts_cached(history_csv_path(cfg, user_id), HISTORY_FIELDS)
-    out: List[Dict[str, str]] = []
-    for row in rows:
-        if (row.get("thread_id") or "").strip() != thread_id:
+    rows, visit = _history_tail_visitor(limit, before)
+    before_ymd = _ymd_from_iso(before or "")
+    for ymd, seg in reversed(_history_segments(cfg, user_id)):
+        if before_ymd and ymd > before_ymd:
             continue
-        out.append({
-            "timestamp": row.get("timestamp") or "",
-            "role": row.get("role") or "",
-            "model_key": row.get("model_key") or DEFAULT_MODEL_KEY,
-            "thread_id": thread_id,
-            "content": row.get("content") or "",
-        })
-    return out
+        if not csv_scan_rows_reverse(seg, HISTORY_FIELDS, "thread_id", thread_id, visit):
+            break
+    rows.reverse()
+    return _history_items(rows, thread_id)
 
 
-def _load_threads(cfg: AppConfig, user_id: str) -> List[Dict[str, str]]:
+def _csv_read_history_all(cfg: AppConfig, user_id: str, thread_id: str) -> List[Dict[str, str]]:
     ensure_all_user_csv(cfg, user_id)
-    rows = csv_read_dicts_cached(threads_csv_path(cfg, user_id), THREAD_FIELDS)
-    out = []
-    for r in rows:
+    rows: List[Dict[str, str]] = []
+    for _, seg in _history_segments(cfg, user_id):
+        rows.extend(csv_read_rows_by_key(seg, HISTORY_FIELDS, "thread_id", thread_id))
+    return _history_items(rows, thread_id)
+
+
+# threads.csv / thread_map.csv are snapshots; every change is appended to a
+# "<name>.journal.csv" sidecar and folded in on read. Replaying a journal on
+# top of a snapshot that already contains it is harmless, so readers load the
+# journal before the snapshot and compaction rewrites the snapshot before it
+# truncates the journal.
+
+def _journal_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".journal.csv"
+
+
+def _journal_load(path: str, fieldnames: List[str], fold) -> List[Dict[str, str]]:
+    jp = _journal_path(path)
+    journal = csv_read_dicts_cached(jp, ["op"] + fieldnames) if os.path.exists(jp) else []
+    snapshot = csv_read_dicts_cached(path, fieldnames)
+    return fold(snapshot, journal)
+
+
+def _journal_append(cfg: AppConfig, path: str, fieldnames: List[str], fold, op: str, values: Dict[str, str]) -> None:
+    jp = _journal_path(path)
+    jfields = ["op"] + fieldnames
+    ensure_csv_file(jp, jfields)
+    csv_append_row(jp, [op] + [values.get(k, "") for k in fieldnames])
+    if len(csv_read_dicts_cached(jp, jfields)) >= max(1, cfg.journal_compact_rows):
+        _schedule_journal_compaction(path, fieldnames, fold)
+
+
+def _schedule_journal_compaction(path: str, fieldnames: List[str], fold) -> None:
+    jp = os.path.abspath(_journal_path(path))
+    with _journal_guard:
+        if jp in _journal_compacting:
+            return
+        _journal_compacting.add(jp)
+    Thread(target=_compact_journal, args=(path, fieldnames, fold), name="journal-compact", daemon=True).start()
+
+
+def _compact_journal(path: str, fieldnames: List[str], fold) -> None:
+    jp = _journal_path(path)
+    jfields = ["op"] + fieldnames
+    try:
+        lk = _lock_for_path(jp)
+        with lk:
+            journal = csv_read_dicts_cached(jp, jfields)
+            if not journal:
+                return
+            snapshot = csv_read_dicts_cached(path, fieldnames)
+            csv_write_dicts_atomic(path, fieldnames, fold(snapshot, journal))
+            csv_write_dicts_atomic(jp, jfields, [])
+    finally:
+        with _journal_guard:
+            _journal_compacting.discard(os.path.abspath(jp))
+
+
+def _fold_threads(snapshot: List[Dict[str, str]], journal: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    rows: Dict[str, Dict[str, str]] = {}
+    for r in snapshot:
         tid = (r.get("thread_id") or "").strip()
         if not tid:
             continue
-        out.append({k: r.get(k, "") for k in THREAD_FIELDS})
-    return out
+        rows[tid] = {k: r.get(k, "") for k in THREAD_FIELDS}
 
+    for j in journal:
+        tid = (j.get("thread_id") or "").strip()
+        if not tid:
+            continue
+        op = j.get("op") or ""
+        cur = rows.get(tid)
+        updated_at = j.get("updated_at") or ""
+        if op == "delete":
+            rows.pop(tid, None)
+        elif op == "rename":
+            if cur is not None:
+                cur["name"] = j.get("name") or ""
+                cur["preview"] = j.get("preview") or ""
+                cur["updated_at"] = updated_at
+        elif op == "upsert":
+            preview = j.get("preview") or ""
+            if cur is None:
+                rows[tid] = {
+                    "thread_id": tid,
+                    "name": "",
+                    "preview": preview,
+                    "created_at": updated_at,
+                    "updated_at": updated_at,
+                }
+                continue
+            if preview and not (cur.get("preview") or "").strip():
+                cur["preview"] = preview
+            cur["updated_at"] = updated_at
+    return list(rows.values())
 
-def _save_threads(cfg: AppConfig, user_id: str, rows: List[Dict[str, str]]) -> None:
-    csv_write_dicts_atomic(threads_csv_path(cfg, user_id), THREAD_FIELDS, rows)
 
+def _load_threads(cfg: AppConfig, user_id: str) -> List[Dict[str, str]]:
+    ensure_all_user_csv(cfg, user_id)
+    return _journal_load(threads_csv_path(cfg, user_id), THREAD_FIELDS, _fold_threads)
 
-def upsert_thread(cfg: AppConfig, user_id: str, thread_id: str, preview: str, updated_at: str) -> None:
-    rows = _load_threads(cfg, user_id)
-    for r in rows:
-        if (r.get("thread_id") or "") == thread_id:
-            if preview and not (r.get("preview") or "").strip():
-                r["preview"] = preview
-            r["updated_at"] = updated_at
-            _save_threads(cfg, user_id, rows)
-            return
 
-    rows.append({
-        "thread_id": thread_id,
-        "name": "",
-        "preview": preview,
-        "created_at": updated_at,
-        "updated_at": updated_at,
-    })
-    _save_threads(cfg, user_id, rows)
+def _append_thread_op(cfg: AppConfig, user_id: str, op: str, values: Dict[str, str]) -> None:
+    _journal_append(cfg, threads_csv_path(cfg, user_id), THREAD_FIELDS, _fold_threads, op, values)
 
 
-def list_threads(cfg: AppConfig, user_id: str, limit: int = 100) -> List[Dict[str, str]]:
+def _csv_upsert_thread(cfg: AppConfig, user_id: str, thread_id: str, preview: str, updated_at: str) -> None:
+    ensure_all_user_csv(cfg, user_id)
+    _append_thread_op(cfg, user_id, "upsert", {"thread_id": thread_id, "preview": preview, "updated_at": updated_at})
+
+
+def _csv_list_threads(cfg: AppConfig, user_id: str, limit: int = 100) -> List[Dict[str, str]]:
     rows = _load_threads(cfg, user_id)
     rows.sort(key=lambda x: (x.get("updated_at") or ""), reverse=True)
     return rows[:limit]
 
 
-def rename_thread(cfg: AppConfig, user_id: str, thread_id: str, name: str) -> bool:
+def _csv_rename_thread(cfg: AppConfig, user_id: str, thread_id: str, name: str) -> bool:
     name = (name or "").strip()
     if not thread_id or not name:
         return False
     rows = _load_threads(cfg, user_id)
-    for r in rows:
-        if (r.get("thread_id") or "") == thread_id:
-            r["name"] = name
-            r["preview"] = name[:20]
-            r["updated_at"] = datetime.now().isoformat(timespec="seconds")
-            _save_threads(cfg, user_id, rows)
-            return True
-    return False
+    if not any((r.get("thread_id") or "") == thread_id for r in rows):
+        return False
+    _append_thread_op(cfg, user_id, "rename", {
+        "thread_id": thread_id,
+        "name": name,
+        "preview": name[:20],
+        "updated_at": datetime.now().isoformat(timespec="seconds"),
+    })
+    return True
 
 
-def delete_thread(cfg: AppConfig, user_id: str, thread_id: str) -> bool:
+def _csv_delete_thread(cfg: AppConfig, user_id: str, thread_id: str) -> bool:
     if not thread_id:
         return False
     rows = _load_threads(cfg, user_id)
-    new_rows = [r for r in rows if (r.get("thread_id") or "") != thread_id]
-    if len(new_rows) == len(rows):
+    if not any((r.get("thread_id") or "") == thread_id for r in rows):
         return False
-    _save_threads(cfg, user_id, new_rows)
+    _append_thread_op(cfg, user_id, "delete", {"thread_id": thread_id})
 
-    hist_path = history_csv_path(cfg, user_id)
-    hist_rows = csv_read_dicts_cached(hist_path, HISTORY_FIELDS)
-    kept_hist = [r for r in hist_rows if (r.get("thread_id") or "").strip() != thread_id]
-    csv_write_dicts_atomic(hist_path, HISTORY_FIELDS, kept_hist)
+    for _, seg in _history_segments(cfg, user_id):
+        if not csv_read_rows_by_key(seg, HISTORY_FIELDS, "thread_id", thread_id):
+            continue
+        hist_rows = csv_read_dicts_cached(seg, HISTORY_FIELDS)
+        kept_hist = [r for r in hist_rows if (r.get("thread_id") or "").strip() != thread_id]
+        csv_write_dicts_atomic(seg, HISTORY_FIELDS, kept_hist, index_field="thread_id")
 
-    map_path = map_csv_path(cfg, user_id)
-    map_rows = csv_read_dicts_cached(map_path, MAP_FIELDS)
-    kept_map = [r for r in map_rows if (r.get("thread_id") or "").strip() != thread_id]
-    csv_write_dicts_atomic(map_path, MAP_FIELDS, kept_map)
+    _journal_append(cfg, map_csv_path(cfg, user_id), MAP_FIELDS, _fold_map, "delete", {"thread_id": thread_id})
 
     return True
 
 
-def _load_map(cfg: AppConfig, user_id: str) -> List[Dict[str, str]]:
-    ensure_all_user_csv(cfg, user_id)
-    rows = csv_read_dicts_cached(map_csv_path(cfg, user_id), MAP_FIELDS)
-    out = []
-    for r in rows:
+def _fold_map(snapshot: List[Dict[str, str]], journal: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    rows: Dict[Tuple[str, str], Dict[str, str]] = {}
+    for r in list(snapshot) + list(journal):
         tid = (r.get("thread_id") or "").strip()
-        mk = (r.get("model_key") or DEFAULT_MODEL_KEY).strip() or DEFAULT_MODEL_KEY
         if not tid:
             continue
-        out.append({
+        if r.get("op") == "delete":
+            for k in [k for k in rows if k[0] == tid]:
+                del rows[k]
+            continue
+        mk = (r.get("model_key") or DEFAULT_MODEL_KEY).strip() or DEFAULT_MODEL_KEY
+        rows[(tid, mk)] = {
             "thread_id": tid,
             "model_key": mk,
             "dify_conversation_id": (r.get("dify_conversation_id") or "").strip(),
             "updated_at": r.get("updated_at") or "",
-        })
-    return out
+        }
+    return list(rows.values())
 
 
-def get_dify_cid(cfg: AppConfig, user_id: str, thread_id: str, model_key: str) -> str:
+def _load_map(cfg: AppConfig, user_id: str) -> List[Dict[str, str]]:
+    ensure_all_user_csv(cfg, user_id)
+    return _journal_load(map_csv_path(cfg, user_id), MAP_FIELDS, _fold_map)
+
+
+def _csv_get_dify_cid(cfg: AppConfig, user_id: str, thread_id: str, model_key: str) -> str:
     rows = _load_map(cfg, user_id)
     for r in rows:
         if r["thread_id"] == thread_id and r["model_key"] == model_key:
@@ -459,108 +1292,752 @@ def get_dify_cid(cfg: AppConfig, user_id: str, thread_id: str, model_key: str) -
     return ""
 
 
-def set_dify_cid(cfg: AppConfig, user_id: str, thread_id: str, model_key: str, dify_cid: str, updated_at: str) -> None:
-    rows = _load_map(cfg, user_id)
-    for r in rows:
-        if r["thread_id"] == thread_id and r["model_key"] == model_key:
-            r["dify_conversation_id"] = dify_cid
-            r["updated_at"] = updated_at
-            csv_write_dicts_atomic(map_csv_path(cfg, user_id), MAP_FIELDS, rows)
-            return
-    rows.append({
+def _csv_set_dify_cid(cfg: AppConfig, user_id: str, thread_id: str, model_key: str, dify_cid: str, updated_at: str) -> None:
+    ensure_all_user_csv(cfg, user_id)
+    _journal_append(cfg, map_csv_path(cfg, user_id), MAP_FIELDS, _fold_map, "set", {
         "thread_id": thread_id,
         "model_key": model_key,
         "dify_conversation_id": dify_cid,
         "updated_at": updated_at,
     })
-    csv_write_dicts_atomic(map_csv_path(cfg, user_id), MAP_FIELDS, rows)
 
 
-def export_thread_as_csv(cfg: AppConfig, user_id: str, thread_id: str) -> str:
-    items = read_history_all(cfg, user_id, thread_id)
-    sio = io.StringIO()
-    w = csv.writer(sio, lineterminator="\n")
-    w.writerow(["timestamp", "role", "model_key", "thread_id", "content"])
-    for m in items:
-        w.writerow([m.get("timestamp", ""), m.get("role", ""), m.get("model_key", ""), m.get("thread_id", ""), m.get("content", "")])
-    return "\ufeff" + sio.getvalue()
+# Public storage API. Blueprints call these; the configured backend
+# (cfg.storage_backend) decides where the data lives. The _csv_* functions
+# above are the CSV implementation.
 
+def storage_for(cfg: AppConfig):
+    st = _storages.get(cfg.base_dir)
+    if st is not None:
+        return st
+    from .storage import create_storage
+    with _storages_guard:
+        st = _storages.get(cfg.base_dir)
+        if st is None:
+            st = create_storage(cfg)
+            _storages[cfg.base_dir] = st
+    return st
 
-def create_new_thread_id() -> str:
-    return uuid.uuid4().hex
 
+def user_exists(cfg: AppConfig, user_id: str) -> bool:
+    return storage_for(cfg).user_exists(user_id)
 
-def feedback_state_csv_path(dir_path: str) -> str:
-    return os.path.join(dir_path, FEEDBACK_STATE_NAME)
 
+def load_user(cfg: AppConfig, user_id: str) -> Optional[Dict[str, str]]:
+    return storage_for(cfg).load_user(user_id)
 
-def ensure_feedback_state_csv(dir_path: str) -> None:
-    ensure_dir(dir_path)
-    p = feedback_state_csv_path(dir_path)
-    lk = _lock_for_path(p)
-    with lk:
-        if os.path.exists(p):
-            return
-        tmp = p + ".tmp"
-        with open(tmp, "w", newline="", encoding="utf-8") as f:
-            w = csv.DictWriter(f, fieldnames=FEEDBACK_FIELDS)
-            w.writeheader()
-        os.replace(tmp, p)
-    _csv_cache().pop(f"read::{p}", None)
+
+def save_user(cfg: AppConfig, u: Dict[str, str]) -> None:
+    storage_for(cfg).save_user(u)
+
+
+def create_user_files(cfg: AppConfig, user_id: str, password: str) -> None:
+    storage_for(cfg).create_user(user_id, password)
+
+
+def append_history(
+    cfg: AppConfig,
+    user_id: str,
+    role: str,
+    model_key: str,
+    thread_id: str,
+    dify_cid: str,
+    content: str,
+    ts: Optional[str] = None,
+) -> str:
+    # ts is given when the caller already announced it (the bot row's ts is the feedback key)
+    if ts is None and not _history_write_behind(cfg):
+        return storage_for(cfg).append_history(user_id, role, model_key, thread_id, dify_cid, content)
+    ts = ts or datetime.now().isoformat(timespec="seconds")
+    row = {
+        "timestamp": ts,
+        "role": role,
+        "model_key": model_key,
+        "thread_id": thread_id,
+        "dify_conversation_id": dify_cid or "",
+        "content": content,
+    }
+    if _history_write_behind(cfg):
+        _enqueue_history_row(cfg, user_id, row)
+    else:
+        storage_for(cfg).append_history_rows(user_id, [row])
+    return ts
+
+
+def read_history(
+    cfg: AppConfig,
+    user_id: str,
+    thread_id: Optional[str],
+    limit: int = 200,
+    before: Optional[str] = None,
+) -> List[Dict[str, str]]:
+    if not thread_id:
+        return []
+    wait_post_turn(cfg, user_id)
+    if not _history_write_behind(cfg):
+        return storage_for(cfg).read_history(user_id, thread_id, limit, before)
+    with _history_user_lock(cfg, user_id):
+        rows = storage_for(cfg).read_history(user_id, thread_id, limit, before)
+        pending = _pending_history_items(cfg, user_id, thread_id)
+    if pending:
+        rows = history_tail(reversed(rows + pending), limit, before)
+    return rows
+
+
+def read_history_all(cfg: AppConfig, user_id: str, thread_id: str) -> List[Dict[str, str]]:
+    wait_post_turn(cfg, user_id)
+    if not _history_write_behind(cfg):
+        return storage_for(cfg).read_history_all(user_id, thread_id)
+    with _history_user_lock(cfg, user_id):
+        return storage_for(cfg).read_history_all(user_id, thread_id) + _pending_history_items(cfg, user_id, thread_id)
+
+
+def upsert_thread(cfg: AppConfig, user_id: str, thread_id: str, preview: str, updated_at: str) -> None:
+    storage_for(cfg).upsert_thread(user_id, thread_id, preview, updated_at)
+
+
+def list_threads(cfg: AppConfig, user_id: str, limit: int = 100) -> List[Dict[str, str]]:
+    wait_post_turn(cfg, user_id)
+    return storage_for(cfg).list_threads(user_id, limit)
+
+
+def rename_thread(cfg: AppConfig, user_id: str, thread_id: str, name: str) -> bool:
+    wait_post_turn(cfg, user_id)
+    return storage_for(cfg).rename_thread(user_id, thread_id, name)
+
+
+def delete_thread(cfg: AppConfig, user_id: str, thread_id: str) -> bool:
+    wait_post_turn(cfg, user_id)
+    if not _history_write_behind(cfg):
+        return storage_for(cfg).delete_thread(user_id, thread_id)
+    with _history_user_lock(cfg, user_id):
+        key = (cfg.base_dir, user_id)
+        with _hw_cond:
+            rows = _hw_pending.get(key)
+            if rows:
+                _hw_pending[key] = [r for r in rows if r["thread_id"] != thread_id]
+        return storage_for(cfg).delete_thread(user_id, thread_id)
+
+
+def get_dify_cid(cfg: AppConfig, user_id: str, thread_id: str, model_key: str) -> str:
+    wait_post_turn(cfg, user_id)
+    return storage_for(cfg).get_dify_cid(user_id, thread_id, model_key)
+
+
+def set_dify_cid(cfg: AppConfig, user_id: str, thread_id: str, model_key: str, dify_cid: str, updated_at: str) -> None:
+    storage_for(cfg).set_dify_cid(user_id, thread_id, model_key, dify_cid, updated_at)
+
+
+# Write-behind for append_history (HISTORY_WRITE_MODE=batched|fsync). Rows
+# are queued per user and a single writer thread flushes each user's batch
+# with one append (plus fsync in "fsync" mode) every HISTORY_BATCH_MS. The
+# per-user lock is held by the writer while it flushes and by readers while
+# they merge storage rows with still-pending rows, so a reader never sees a
+# row twice or misses one. A batch is written one day (history segment) at a
+# time and each day leaves the queue as soon as it is committed, so a failed
+# flush retries only what did not reach disk.
+
+def _history_write_behind(cfg: AppConfig) -> bool:
+    return cfg.history_write_mode in ("batched", "fsync")
+
+
+def _history_user_lock(cfg: AppConfig, user_id: str) -> RLock:
+    key = (cfg.base_dir, user_id)
+    with _hw_cond:
+        lk = _hw_user_locks.get(key)
+        if lk is None:
+            lk = RLock()
+            _hw_user_locks[key] = lk
+        return lk
+
+
+def _enqueue_history_row(cfg: AppConfig, user_id: str, row: Dict[str, str]) -> None:
+    global _hw_thread
+    with _hw_cond:
+        _hw_cfgs[cfg.base_dir] = cfg
+        _hw_pending.setdefault((cfg.base_dir, user_id), []).append(row)
+        depth = sum(len(v) for v in _hw_pending.values())
+        _hw_stats["enqueued"] += 1
+        _hw_stats["max_depth"] = max(_hw_stats["max_depth"], depth)
+        if _hw_thread is None or not _hw_thread.is_alive():
+            _hw_thread = Thread(target=_history_writer_loop, name="history-writer", daemon=True)
+            _hw_thread.start()
+        _hw_cond.notify()
+
+
+def _pending_history_items(cfg: AppConfig, user_id: str, thread_id: str) -> List[Dict[str, str]]:
+    with _hw_cond:
+        rows = [r for r in _hw_pending.get((cfg.base_dir, user_id), []) if r["thread_id"] == thread_id]
+    return _history_items(rows, thread_id)
+
+
+def _history_writer_loop() -> None:
+    while True:
+        with _hw_cond:
+            while not _hw_pending:
+                _hw_cond.wait()
+            window = min(c.history_batch_ms for c in _hw_cfgs.values()) / 1000.0
+        time.sleep(max(0.0, window))
+        _flush_history_pending()
+
+
+def _flush_history_user(cfg: AppConfig, user_id: str) -> None:
+    key = (cfg.base_dir, user_id)
+    with _history_user_lock(cfg, user_id):
+        with _hw_cond:
+            batch = list(_hw_pending.get(key) or [])
+            if not batch:
+                _hw_pending.pop(key, None)
+                return
+        t0 = time.perf_counter()
+        runs: List[List[Dict[str, str]]] = []
+        for r in batch:
+            if runs and _ymd_from_iso(r.get("timestamp") or "") == _ymd_from_iso(runs[-1][0].get("timestamp") or ""):
+                runs[-1].append(r)
+            else:
+                runs.append([r])
+        for run in runs:
+            try:
+                storage_for(cfg).append_history_rows(user_id, run, fsync=cfg.history_write_mode == "fsync")
+            except Exception as e:
+                with _hw_cond:
+                    _hw_stats["errors"] += 1
+                    _hw_stats["last_error"] = f"{user_id}: {e}"
+                return
+            with _hw_cond:
+                rest = (_hw_pending.get(key) or [])[len(run):]
+                if rest:
+                    _hw_pending[key] = rest
+                else:
+                    _hw_pending.pop(key, None)
+                _hw_stats["rows_written"] += len(run)
+        with _hw_cond:
+            _hw_stats["batches"] += 1
+            _hw_stats["last_batch_ms"] = round((time.perf_counter() - t0) * 1000.0, 2)
+
+
+def _flush_history_pending() -> None:
+    with _hw_cond:
+        keys = list(_hw_pending.keys())
+    for base_dir, user_id in keys:
+        _flush_history_user(_hw_cfgs[base_dir], user_id)
+
+
+def drain_history_writer() -> None:
+    for _ in range(100):
+        with _hw_cond:
+            if not _hw_pending:
+                return
+        _flush_history_pending()
+
+
+# once per process, however often the writer thread is (re)started; a no-op with nothing queued
+atexit.register(drain_history_writer)
+
+
+def history_writer_stats() -> Dict[str, Any]:
+    with _hw_cond:
+        out = dict(_hw_stats)
+        out["queue_depth"] = sum(len(v) for v in _hw_pending.values())
+        out["pending_users"] = len(_hw_pending)
+        return out
+
+
+def _hw_depth_gauge() -> Dict[Tuple[str, ...], float]:
+    with _hw_cond:
+        return {(): sum(len(v) for v in _hw_pending.values())}
+
+
+def _hw_errors_gauge() -> Dict[Tuple[str, ...], float]:
+    with _hw_cond:
+        return {(): _hw_stats["errors"]}
+
+
+metrics.gauge(
+    "chutgpt_history_queue_depth",
+    "History rows queued by the write-behind writer and not yet on disk.",
+    (),
+    _hw_depth_gauge,
+)
+metrics.gauge(
+    "chutgpt_history_write_errors_total",
+    "Write-behind appends that failed; their rows stay queued for the next flush.",
+    (),
+    _hw_errors_gauge,
+)
+
+
+# Post-turn persistence. The end of a chat turn (bot history row, Dify
+# conversation map, thread bump) is queued here so "done" can go out before
+# any of it touches disk. Jobs of one user run in submission order, one
+# user per worker at a time, on POST_TURN_WORKERS threads. Every read that
+# could observe them (history, threads, the conversation map) first waits
+# for that user's queue to drain, so the next request still reads its own
+# writes. POST_TURN_WORKERS=0 runs the jobs inline. "done" has already told
+# the client the rows exist, so a failing job is logged and retried
+# POST_TURN_RETRIES times (backing off from POST_TURN_RETRY_SEC, holding up
+# that user's later jobs) before it is dropped; jobs must be safe to rerun.
+
+POST_TURN_RETRIES = 3
+POST_TURN_RETRY_SEC = 0.5
+
+def submit_post_turn(cfg: AppConfig, user_id: str, job: Callable[[], None]) -> None:
+    global _post_pool
+    if cfg.post_turn_workers <= 0:
+        _run_post_job(job)
+        return
+    key = (cfg.base_dir, user_id)
+    with _post_cond:
+        q = _post_queues.setdefault(key, deque())
+        q.append(job)
+        _post_stats["submitted"] += 1
+        _post_stats["max_depth"] = max(_post_stats["max_depth"], sum(len(v) for v in _post_queues.values()))
+        if key in _post_running:
+            return
+        _post_running.add(key)
+        if _post_pool is None:
+            _post_pool = ThreadPoolExecutor(max_workers=cfg.post_turn_workers, thread_name_prefix="post-turn")
+    _post_pool.submit(_drain_post_queue, key)
+
+
+def _run_post_job(job: Callable[[], None]) -> None:
+    t0 = time.perf_counter()
+    for attempt in range(POST_TURN_RETRIES + 1):
+        try:
+            job()
+            break
+        except Exception as e:
+            with _post_cond:
+                _post_stats["errors"] += 1
+                _post_stats["last_error"] = str(e)
+            if attempt == POST_TURN_RETRIES:
+                with _post_cond:
+                    _post_stats["dropped"] += 1
+                _log.error("post-turn job dropped after %d attempts", attempt + 1, exc_info=True)
+                return
+            _log.warning("post-turn job failed (attempt %d), retrying: %s", attempt + 1, e)
+            with _post_cond:
+                _post_stats["retries"] += 1
+            time.sleep(POST_TURN_RETRY_SEC * (2 ** attempt))
+    with _post_cond:
+        _post_stats["done"] += 1
+        _post_stats["last_job_ms"] = round((time.perf_counter() - t0) * 1000.0, 2)
+
+
+def _drain_post_queue(key: Tuple[str, str]) -> None:
+    while True:
+        with _post_cond:
+            q = _post_queues.get(key)
+            if not q:
+                _post_queues.pop(key, None)
+                _post_running.discard(key)
+                _post_cond.notify_all()
+                return
+            job = q.popleft()
+        _run_post_job(job)
+
+
+def wait_post_turn(cfg: AppConfig, user_id: str) -> None:
+    key = (cfg.base_dir, user_id)
+    with _post_cond:
+        if key not in _post_running:
+            return
+        t0 = time.perf_counter()
+        ok = _post_cond.wait_for(lambda: key not in _post_running, timeout=max(0.1, cfg.post_turn_wait_sec))
+        waited = (time.perf_counter() - t0) * 1000.0
+        _post_stats["waits"] += 1
+        _post_stats["wait_ms_max"] = max(_post_stats["wait_ms_max"], round(waited, 2))
+        if not ok:
+            _post_stats["wait_timeouts"] += 1
+
+
+def drain_post_turns(timeout: float = 30.0) -> bool:
+    with _post_cond:
+        return _post_cond.wait_for(lambda: not _post_running, timeout=timeout)
+
+
+atexit.register(drain_post_turns)
+
+
+def post_turn_stats() -> Dict[str, Any]:
+    with _post_cond:
+        out = dict(_post_stats)
+        out["queue_depth"] = sum(len(v) for v in _post_queues.values())
+        out["busy_users"] = len(_post_running)
+    return out
+
+
+# Exports are generators of ~64 KiB text chunks so a response never holds a
+# whole thread (or a whole account) in memory.
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "jsonl": ("application/x-ndjson; charset=utf-8", "jsonl"),
+    "md": ("text/markdown; charset=utf-8", "md"),
+}
+_EXPORT_CHUNK = 64 * 1024
+_EXPORT_FIELDS = ["timestamp", "role", "model_key", "thread_id", "content"]
+
+
+def iter_history(cfg: AppConfig, user_id: str, thread_id: str) -> Iterable[Dict[str, str]]:
+    wait_post_turn(cfg, user_id)
+    if _history_write_behind(cfg):
+        _flush_history_user(cfg, user_id)
+    return storage_for(cfg).iter_history(user_id, thread_id)
+
+
+def _csv_iter_history(cfg: AppConfig, user_id: str, thread_id: str) -> Iterable[Dict[str, str]]:
+    ensure_all_user_csv(cfg, user_id)
+    for _, seg in _history_segments(cfg, user_id):
+        yield from _history_items(csv_read_rows_by_key(seg, HISTORY_FIELDS, "thread_id", thread_id), thread_id)
+
+
+def _export_lines(rows: Iterable[Dict[str, str]], fmt: str) -> Iterable[str]:
+    if fmt == "jsonl":
+        for m in rows:
+            yield json.dumps({k: m.get(k, "") for k in _EXPORT_FIELDS}, ensure_ascii=False) + "\n"
+        return
+    if fmt == "md":
+        for m in rows:
+            yield (
+                "***\n"
+                f"- timestamp: {m.get('timestamp', '')}\n"
+                f"- model: {m.get('model_key', '')}\n"
+                f"## {'Q' if m.get('role') == 'user' else 'A'}\n"
+                f"{(m.get('content') or '').rstrip()}\n\n"
+            )
+        return
+    sio = io.StringIO()
+    w = csv.writer(sio, lineterminator="\n")
+    w.writerow(_EXPORT_FIELDS)
+    yield "\ufeff" + sio.getvalue()
+    for m in rows:
+        sio.seek(0)
+        sio.truncate()
+        w.writerow([m.get(k, "") for k in _EXPORT_FIELDS])
+        yield sio.getvalue()
+
+
+def _export_chunks(parts: Iterable[str]) -> Iterable[str]:
+    buf: List[str] = []
+    size = 0
+    for s in parts:
+        buf.append(s)
+        size += len(s)
+        if size >= _EXPORT_CHUNK:
+            yield "".join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield "".join(buf)
+
+
+def iter_thread_export(cfg: AppConfig, user_id: str, thread_id: str, fmt: str = "csv") -> Iterable[str]:
+    return _export_chunks(_export_lines(iter_history(cfg, user_id, thread_id), fmt))
+
+
+def export_thread_as_csv(cfg: AppConfig, user_id: str, thread_id: str) -> str:
+    return "".join(iter_thread_export(cfg, user_id, thread_id, "csv"))
+
+
+class _ZipSink:
+    # write-only target for zipfile; without tell()/seek() zipfile streams
+    # entries with data descriptors instead of seeking back to patch headers
+    def __init__(self) -> None:
+        self.parts: List[bytes] = []
+
+    def write(self, b: bytes) -> int:
+        if len(b):
+            self.parts.append(bytes(b))
+        return len(b)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        out = b"".join(self.parts)
+        self.parts = []
+        return out
+
+
+def _export_entry_name(th: Dict[str, str], ext: str, used: Set[str]) -> str:
+    title = re.sub(r'[\\/:*?"<>|\s]+', "_", (th.get("name") or th.get("preview") or "").strip())[:40].strip("_")
+    stamp = _ymd_from_iso(th.get("updated_at") or "") or "00000000"
+    base = f"{stamp}_{title or 'chat'}_{th['thread_id'][:8]}"
+    name = f"{base}.{ext}"
+    n = 2
+    while name in used:
+        name = f"{base}_{n}.{ext}"
+        n += 1
+    used.add(name)
+    return name
+
+
+def iter_account_export_zip(cfg: AppConfig, user_id: str, fmt: str = "csv") -> Iterable[bytes]:
+    sink = _ZipSink()
+    used: Set[str] = set()
+    ext = EXPORT_FORMATS[fmt][1]
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for th in list_threads(cfg, user_id, limit=1_000_000):
+            info = zipfile.ZipInfo(_export_entry_name(th, ext, used), date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with zf.open(info, "w", force_zip64=True) as zw:
+                for chunk in iter_thread_export(cfg, user_id, th["thread_id"], fmt):
+                    zw.write(chunk.encode("utf-8"))
+                    if sink.parts:
+                        yield sink.take()
+            if sink.parts:
+                yield sink.take()
+    if sink.parts:
+        yield sink.take()
+
+
+def create_new_thread_id() -> str:
+    return uuid.uuid4().hex
+
+
+def feedback_state_csv_path(dir_path: str) -> str:
+    return os.path.join(dir_path, FEEDBACK_STATE_NAME)
+
+
+# Feedback state is sharded like the md files it feeds:
+# "<dir>/feedback_state/<model>_<yyyymm>.csv", the month taken from saved_at.
+# A key lives in exactly one shard; re-saving it in a later month moves it.
+# The legacy single feedback_state.csv is split on first use (or by
+# tools/migrate_feedback_state.py) and moved into the backup dir.
+
+_FEEDBACK_SHARD_RE = re.compile(r"^(.+)_(\d{6})\.csv$")
+
+
+def feedback_shard_dir(dir_path: str) -> str:
+    return os.path.join(dir_path, FEEDBACK_SHARD_DIR)
+
+
+def feedback_shard_path(dir_path: str, model_key: str, yyyymm: str) -> str:
+    return os.path.join(feedback_shard_dir(dir_path), f"{_safe_filename_part(model_key)}_{yyyymm}.csv")
+
+
+def _feedback_shards(dir_path: str) -> List[str]:
+    d = feedback_shard_dir(dir_path)
+    try:
+        names = os.listdir(d)
+    except OSError:
+        return []
+    return sorted(os.path.join(d, n) for n in names if _FEEDBACK_SHARD_RE.match(n))
+
+
+def ensure_feedback_state_csv(dir_path: str, backup_dir: str) -> None:
+    ensure_dir(feedback_shard_dir(dir_path))
+    if os.path.exists(feedback_state_csv_path(dir_path)):
+        migrate_feedback_state_to_shards(dir_path, backup_dir)
 
 
 def _feedback_key(user_id: str, model_key: str, thread_id: str, bot_ts: str) -> str:
     return f"{user_id}||{model_key}||{thread_id}||{bot_ts}"
 
 
-def _load_feedback_state_from(dir_path: str) -> List[Dict[str, str]]:
-    ensure_feedback_state_csv(dir_path)
-    p = feedback_state_csv_path(dir_path)
-    lk = _lock_for_path(p)
+@_timed_csv(_m_csv_read)
+def _read_feedback_csv(path: str) -> List[Dict[str, str]]:
+    lk = _lock_for_path(path)
     with lk:
-        out = []
-        with open(p, newline="", encoding="utf-8") as f:
-            r = csv.DictReader(f)
-            for row in r:
-                out.append({k: row.get(k, "") for k in FEEDBACK_FIELDS})
-        return out
+        try:
+            with open(path, newline="", encoding="utf-8") as f:
+                return [{k: row.get(k, "") for k in FEEDBACK_FIELDS} for row in csv.DictReader(f)]
+        except FileNotFoundError:
+            return []
+
+
+# Per-directory index over all shards: rows by _feedback_key, the shard that
+# holds each key and the keys of each (user_id, thread_id). Shards whose file
+# signature moved (a write from another process or host) are reloaded one by
+# one; our own upserts patch the index in place. Everything is read and
+# mutated under the shard directory's path lock.
+#
+# A lookup only stats the shard directory: every shard write is a tmp file
+# plus os.replace, which moves the directory mtime. The listdir and per-shard
+# stats run when that signature changed, when it was recorded within
+# FEEDBACK_DIR_SETTLE_SEC of its mtime (a second write in the same tick would
+# not move it), and every FEEDBACK_INDEX_RESCAN_SEC as a backstop.
+
+FEEDBACK_DIR_SETTLE_SEC = 2.0
+FEEDBACK_INDEX_RESCAN_SEC = 30.0
+
+
+def _feedback_index_unload(ent: Dict[str, Any], shard: str) -> None:
+    for key in ent["keys_of"].pop(shard, {}):
+        if ent["shard_of"].get(key) != shard:
+            continue
+        r = ent["by_key"].pop(key)
+        del ent["shard_of"][key]
+        ent["by_thread"].get((r["user_id"], r["thread_id"]), {}).pop(key, None)
+
+
+def _feedback_index_add(ent: Dict[str, Any], shard: str, key: str, r: Dict[str, str]) -> None:
+    ent["by_key"][key] = r
+    ent["shard_of"][key] = shard
+    ent["keys_of"].setdefault(shard, {})[key] = None
+    ent["by_thread"].setdefault((r["user_id"], r["thread_id"]), {})[key] = None
+
+
+def _feedback_index_remove(ent: Dict[str, Any], key: str) -> Optional[str]:
+    r = ent["by_key"].pop(key, None)
+    if r is None:
+        return None
+    shard = ent["shard_of"].pop(key)
+    ent["keys_of"].get(shard, {}).pop(key, None)
+    ent["by_thread"].get((r["user_id"], r["thread_id"]), {}).pop(key, None)
+    return shard
+
+
+def _feedback_index_locked(dir_path: str) -> Dict[str, Any]:
+    d = feedback_shard_dir(dir_path)
+    now = time.time()
+    dsig = _file_sig(d)
+    with _feedback_idx_guard:
+        ent = _feedback_idx.get(d)
+    if ent is not None and dsig is not None and ent["dir_sig"] == dsig and now - ent["scanned_at"] < FEEDBACK_INDEX_RESCAN_SEC:
+        return ent
+    sigs = {p: _file_sig(p) for p in _feedback_shards(dir_path)}
+    if ent is None:
+        ent = {"shards": {}, "by_key": {}, "shard_of": {}, "keys_of": {}, "by_thread": {}, "dir_sig": None, "scanned_at": 0.0}
+
+    for shard in set(ent["shards"]) | set(sigs):
+        if ent["shards"].get(shard) == sigs.get(shard):
+            continue
+        _feedback_index_unload(ent, shard)
+        ent["shards"].pop(shard, None)
+        if sigs.get(shard) is None:
+            continue
+        for r in _read_feedback_csv(shard):
+            key = _feedback_key(r["user_id"], r["model_key"], r["thread_id"], r["bot_ts"])
+            prev = ent["by_key"].get(key)
+            if prev is not None and (prev.get("saved_at") or "") > (r.get("saved_at") or ""):
+                continue
+            _feedback_index_remove(ent, key)
+            _feedback_index_add(ent, shard, key, r)
+        ent["shards"][shard] = sigs[shard]
+
+    settled = dsig is not None and now - dsig[0] / 1e9 >= FEEDBACK_DIR_SETTLE_SEC
+    ent["dir_sig"] = dsig if settled else None
+    ent["scanned_at"] = now
+    with _feedback_idx_guard:
+        _feedback_idx[d] = ent
+    return ent
 
 
-def _save_feedback_state_to(dir_path: str, rows: List[Dict[str, str]]) -> None:
-    p = feedback_state_csv_path(dir_path)
-    csv_write_dicts_atomic(p, FEEDBACK_FIELDS, rows)
+def _feedback_dir_lock(dir_path: str) -> _PathLock:
+    return _lock_for_path(feedback_shard_dir(dir_path))
 
 
-def _merge_feedback_rows(primary: List[Dict[str, str]], secondary: List[Dict[str, str]]) -> List[Dict[str, str]]:
-    def ts_key(x: Dict[str, str]) -> str:
-        return (x.get("saved_at") or "").strip()
+def _load_feedback_state_from(dir_path: str) -> List[Dict[str, str]]:
+    with _feedback_dir_lock(dir_path):
+        return [dict(r) for r in _feedback_index_locked(dir_path)["by_key"].values()]
+
+
+def _feedback_rows_by_key(dir_path: str, key: str) -> List[Dict[str, str]]:
+    with _feedback_dir_lock(dir_path):
+        r = _feedback_index_locked(dir_path)["by_key"].get(key)
+        return [dict(r)] if r is not None else []
+
+
+def _feedback_thread_rows(dir_path: str, user_id: str, thread_id: str) -> List[Dict[str, str]]:
+    with _feedback_dir_lock(dir_path):
+        ent = _feedback_index_locked(dir_path)
+        return [dict(ent["by_key"][k]) for k in ent["by_thread"].get((user_id, thread_id), {})]
+
+
+def _feedback_upsert_rows(dir_path: str, rows: List[Dict[str, str]], *, only_if_newer: bool = False) -> int:
+    # kind "none" deletes; rewrites each touched shard once and returns the number of rows applied
+    applied = 0
+    with _feedback_dir_lock(dir_path):
+        ensure_dir(feedback_shard_dir(dir_path))
+        ent = _feedback_index_locked(dir_path)
+        touched: Set[str] = set()
+        for row in rows:
+            r = {k: row.get(k, "") or "" for k in FEEDBACK_FIELDS}
+            key = _feedback_key(r["user_id"], r["model_key"], r["thread_id"], r["bot_ts"])
+            prev = ent["by_key"].get(key)
+            if only_if_newer and prev is not None and (prev.get("saved_at") or "") > r["saved_at"]:
+                continue
+            old_shard = _feedback_index_remove(ent, key)
+            if old_shard:
+                touched.add(old_shard)
+            if r["kind"] != "none":
+                shard = feedback_shard_path(dir_path, r["model_key"], _yyyymm_from_iso(r["saved_at"]))
+                _feedback_index_add(ent, shard, key, r)
+                touched.add(shard)
+            if old_shard or r["kind"] != "none":
+                applied += 1
 
+        try:
+            for shard in sorted(touched):
+                keys = ent["keys_of"].get(shard, {})
+                csv_write_dicts_atomic(shard, FEEDBACK_FIELDS, [ent["by_key"][k] for k in keys])
+                _csv_cache_invalidate(os.path.abspath(shard))
+                ent["shards"][shard] = _file_sig(shard)
+            if touched:
+                # our own replace moved the directory mtime; rescan (but not reread) next time
+                ent["dir_sig"] = None
+        except Exception:
+            with _feedback_idx_guard:
+                _feedback_idx.pop(feedback_shard_dir(dir_path), None)
+            raise
+    return applied
+
+
+def migrate_feedback_state_to_shards(dir_path: str, backup_dir: str) -> Dict[str, int]:
+    legacy = feedback_state_csv_path(dir_path)
+    report = {"rows": 0, "shards": 0}
+    with _feedback_dir_lock(dir_path):
+        if not os.path.exists(legacy):
+            return report
+        rows = _read_feedback_csv(legacy)
+        report["rows"] = _feedback_upsert_rows(dir_path, rows, only_if_newer=True)
+        report["shards"] = len({(r.get("model_key") or "", _yyyymm_from_iso(r.get("saved_at") or "")) for r in rows if r.get("kind") != "none"})
+        # the NAS and the local spool both end in good_and_bad; the full path tells them apart
+        label = re.sub(r"[^\w.-]+", "_", os.path.abspath(dir_path)).strip("_")
+        lk = _lock_for_path(legacy)
+        with lk:
+            _move_to_backup(legacy, backup_dir, "feedback", label, FEEDBACK_STATE_NAME)
+        _csv_cache_invalidate(os.path.abspath(legacy))
+    return report
+
+
+def _feedback_state_dirs(cfg: AppConfig) -> List[str]:
+    # NAS first, local second: on equal saved_at the later directory (the local one) wins.
+    # A spool snapshot that is being merged into the NAS stays visible in between.
+    # The NAS is only touched while the monitor reports it up; a hung share
+    # must not block request threads on a stat.
+    with _nas_sync_guard:
+        snap = _nas_sync_inflight["dir"]
+    local = [snap, cfg.feedback_dir_local] if snap else [cfg.feedback_dir_local]
+    dirs = [d for d in local if os.path.isdir(feedback_shard_dir(d))]
+    if is_nas_available_cached(cfg):
+        dirs.insert(0, cfg.feedback_dir_nas)
+    return dirs
+
+
+def _merged_feedback_lookup(cfg: AppConfig, fetch) -> Dict[str, Dict[str, str]]:
     m: Dict[str, Dict[str, str]] = {}
-    for r in primary:
-        m[_feedback_key(r.get("user_id", ""), r.get("model_key", ""), r.get("thread_id", ""), r.get("bot_ts", ""))] = r
-    for r in secondary:
-        k = _feedback_key(r.get("user_id", ""), r.get("model_key", ""), r.get("thread_id", ""), r.get("bot_ts", ""))
-        if k not in m or ts_key(r) >= ts_key(m[k]):
-            m[k] = r
-    return list(m.values())
+    for d in _feedback_state_dirs(cfg):
+        try:
+            rows = fetch(d)
+        except Exception:
+            continue
+        for r in rows:
+            k = _feedback_key(r.get("user_id", ""), r.get("model_key", ""), r.get("thread_id", ""), r.get("bot_ts", ""))
+            if k not in m or (r.get("saved_at") or "").strip() >= (m[k].get("saved_at") or "").strip():
+                m[k] = r
+    with _nas_sync_guard:
+        tombstones = dict(_nas_sync_inflight["tombstones"]) if _nas_sync_inflight["dir"] else {}
+    for k, t in tombstones.items():
+        if k in m and (t.get("saved_at") or "") >= (m[k].get("saved_at") or "").strip():
+            del m[k]
+    return m
 
 
 def load_feedback_state_merged(cfg: AppConfig) -> List[Dict[str, str]]:
-    rows_nas = []
-    rows_local = []
-    try:
-        if os.path.exists(feedback_state_csv_path(cfg.feedback_dir_nas)) or is_nas_available_cached(cfg):
-            if os.path.exists(feedback_state_csv_path(cfg.feedback_dir_nas)):
-                rows_nas = _load_feedback_state_from(cfg.feedback_dir_nas)
-    except Exception:
-        rows_nas = []
-    try:
-        if os.path.exists(feedback_state_csv_path(cfg.feedback_dir_local)):
-            rows_local = _load_feedback_state_from(cfg.feedback_dir_local)
-    except Exception:
-        rows_local = []
-
-    return _merge_feedback_rows(rows_nas, rows_local)
+    return list(_merged_feedback_lookup(cfg, _load_feedback_state_from).values())
 
 
 def upsert_feedback_state_to_dir(
@@ -575,39 +2052,16 @@ def upsert_feedback_state_to_dir(
     question: str,
     answer: str,
 ) -> None:
-    rows = _load_feedback_state_from(dir_path)
-    key = _feedback_key(user_id, model_key, thread_id, bot_ts)
-
-    out: List[Dict[str, str]] = []
-    found = False
-    for r in rows:
-        rk = _feedback_key(r.get("user_id", ""), r.get("model_key", ""), r.get("thread_id", ""), r.get("bot_ts", ""))
-        if rk != key:
-            out.append(r)
-            continue
-        found = True
-        if kind == "none":
-            continue
-        r2 = dict(r)
-        r2["kind"] = kind
-        r2["saved_at"] = saved_at
-        r2["question"] = question
-        r2["answer"] = answer
-        out.append(r2)
-
-    if not found and kind != "none":
-        out.append({
-            "user_id": user_id,
-            "model_key": model_key,
-            "thread_id": thread_id,
-            "bot_ts": bot_ts,
-            "kind": kind,
-            "saved_at": saved_at,
-            "question": question,
-            "answer": answer,
-        })
-
-    _save_feedback_state_to(dir_path, out)
+    _feedback_upsert_rows(dir_path, [{
+        "user_id": user_id,
+        "model_key": model_key,
+        "thread_id": thread_id,
+        "bot_ts": bot_ts,
+        "kind": kind,
+        "saved_at": saved_at,
+        "question": question,
+        "answer": answer,
+    }])
 
 
 def _yyyymm_from_iso(iso: str) -> str:
@@ -643,107 +2097,416 @@ def _md_chunk(saved_at: str, user_id: str, model_key: str, question: str, answer
     )
 
 
-def append_feedback_md(
+# Every .md keeps a chunk-offset index in
+# "<dir>/feedback_state/<md name>.mdidx" mapping each feedback key to the byte
+# span of its chunk. Chunks are newest first, so a new entry is spliced in at
+# the head: one streamed copy into a temp file that also drops the key's old
+# chunk, os.replace()-d over the original, after which every other span moves
+# by the bytes inserted and cut. The .md is never deleted, so the RAG ingest
+# always finds it. A missing or stale index (file size or inode moved) makes
+# that one file get re-rendered from its shard instead.
+
+def _md_index_path(md_path: str) -> str:
+    d, name = os.path.split(md_path)
+    return os.path.join(d, FEEDBACK_SHARD_DIR, os.path.splitext(name)[0] + ".mdidx")
+
+
+def _md_index_save_locked(md_path: str, spans: Dict[str, Tuple[int, int]]) -> None:
+    sig = _file_sig(md_path)
+    if sig is None:
+        return
+    ip = _md_index_path(md_path)
+    ensure_dir(os.path.dirname(ip))
+    tmp = ip + ".tmp"
+    with open(tmp, "w", encoding="utf-8", newline="\n") as f:
+        f.write(f"#mdidx1\t{sig[2]}\n")
+        for key, (start, end) in sorted(spans.items(), key=lambda kv: kv[1][0]):
+            f.write(f"{json.dumps(key, ensure_ascii=False)}\t{start}\t{end}\n")
+    os.replace(tmp, ip)
+    with _md_idx_guard:
+        _md_idx[md_path] = {"sig": sig, "spans": dict(spans)}
+
+
+def _md_index_get_locked(md_path: str) -> Optional[Dict[str, Tuple[int, int]]]:
+    sig = _file_sig(md_path)
+    if sig is None:
+        return {}
+    with _md_idx_guard:
+        ent = _md_idx.get(md_path)
+        if ent is not None and ent["sig"] == sig:
+            return dict(ent["spans"])
+    spans: Dict[str, Tuple[int, int]] = {}
+    end = 0
+    try:
+        with open(_md_index_path(md_path), "r", encoding="utf-8", newline="\n") as f:
+            head = f.readline().rstrip("\n").split("\t")
+            if len(head) != 2 or head[0] != "#mdidx1" or int(head[1]) != sig[2]:
+                return None
+            for line in f:
+                parts = line.rstrip("\n").rsplit("\t", 2)
+                if len(parts) != 3:
+                    return None
+                spans[json.loads(parts[0])] = (int(parts[1]), int(parts[2]))
+                end = max(end, int(parts[2]))
+    except (OSError, ValueError):
+        return None
+    if end != sig[1]:
+        return None
+    with _md_idx_guard:
+        _md_idx[md_path] = {"sig": sig, "spans": dict(spans)}
+    return spans
+
+
+def _md_splice_locked(md_path: str, spans: Dict[str, Tuple[int, int]], key: str, head: bytes = b"") -> None:
+    # drops key's chunk (if indexed) and puts head, the key's new chunk, at the top
+    start, end = spans.pop(key, (0, 0))
+    tmp = md_path + ".tmp"
+    with open(tmp, "wb") as dst:
+        dst.write(head)
+        if os.path.exists(md_path):
+            with open(md_path, "rb") as src:
+                left = start
+                while left > 0:
+                    b = src.read(min(left, 1024 * 1024))
+                    if not b:
+                        break
+                    dst.write(b)
+                    left -= len(b)
+                src.seek(end)
+                while True:
+                    b = src.read(1024 * 1024)
+                    if not b:
+                        break
+                    dst.write(b)
+    os.replace(tmp, md_path)
+    cut = end - start
+    for k, (s, e) in list(spans.items()):
+        shift = len(head) - (cut if s >= end else 0)
+        spans[k] = (s + shift, e + shift)
+    if head:
+        spans[key] = (0, len(head))
+
+
+def _render_md_file_locked(dir_path: str, model_key: str, kind: str, ym: str, rows: Optional[List[Dict[str, str]]] = None) -> None:
+    p = _feedback_md_path(dir_path, model_key, kind, ym)
+    if rows is None:
+        rows = _read_feedback_csv(feedback_shard_path(dir_path, model_key, ym))
+    rows = [
+        r for r in rows
+        if (r.get("model_key") or "") == model_key
+        and (r.get("kind") or "").strip().lower() == kind
+        and _yyyymm_from_iso(r.get("saved_at", "")) == ym
+    ]
+    if not rows and not os.path.exists(p):
+        return
+    rows.sort(key=lambda x: x.get("saved_at", ""), reverse=True)
+
+    spans: Dict[str, Tuple[int, int]] = {}
+    pos = 0
+    tmp = p + ".tmp"
+    with open(tmp, "wb") as f:
+        for r in rows:
+            chunk = _md_chunk(
+                r.get("saved_at", ""),
+                r.get("user_id", ""),
+                r.get("model_key", ""),
+                r.get("question", ""),
+                r.get("answer", ""),
+            ).encode("utf-8")
+            f.write(chunk)
+            spans[_feedback_key(r.get("user_id", ""), r.get("model_key", ""), r.get("thread_id", ""), r.get("bot_ts", ""))] = (pos, pos + len(chunk))
+            pos += len(chunk)
+    os.replace(tmp, p)
+    _md_index_save_locked(p, spans)
+
+
+def update_feedback_md(
     *,
     dir_path: str,
+    user_id: str,
     model_key: str,
+    thread_id: str,
+    bot_ts: str,
+    prev_kind: str,
+    prev_saved_at: str,
     kind: str,
     saved_at: str,
-    user_id: str,
     question: str,
     answer: str,
-) -> str:
+) -> None:
+    # call after the state upsert: a file without a usable index is re-rendered from its shard
     ensure_dir(dir_path)
-    ym = _yyyymm_from_iso(saved_at)
-    p = _feedback_md_path(dir_path, model_key, kind, ym)
-    lk = _lock_for_path(p)
-    with lk:
-        with open(p, "a", encoding="utf-8", newline="\n") as f:
-            f.write(_md_chunk(saved_at, user_id, model_key, question, answer))
-    return ym
+    key = _feedback_key(user_id, model_key, thread_id, bot_ts)
+
+    if prev_kind in ("good", "bad") and prev_saved_at:
+        ym = _yyyymm_from_iso(prev_saved_at)
+        p = _feedback_md_path(dir_path, model_key, prev_kind, ym)
+        lk = _lock_for_path(p)
+        with lk:
+            spans = _md_index_get_locked(p)
+            if spans is None:
+                _render_md_file_locked(dir_path, model_key, prev_kind, ym)
+            elif key in spans:
+                _md_splice_locked(p, spans, key)
+                _md_index_save_locked(p, spans)
+
+    if kind in ("good", "bad"):
+        ym = _yyyymm_from_iso(saved_at)
+        p = _feedback_md_path(dir_path, model_key, kind, ym)
+        lk = _lock_for_path(p)
+        with lk:
+            spans = _md_index_get_locked(p)
+            if spans is None:
+                _render_md_file_locked(dir_path, model_key, kind, ym)
+                return
+            _md_splice_locked(p, spans, key, _md_chunk(saved_at, user_id, model_key, question, answer).encode("utf-8"))
+            _md_index_save_locked(p, spans)
 
 
 def rebuild_feedback_md_for_model_months_in_dir(dir_path: str, model_key: str, months: Set[str]) -> None:
     ensure_dir(dir_path)
-    rows = _load_feedback_state_from(dir_path)
 
     targets = {re.sub(r"\D", "", m)[:6] for m in months if m}
     targets.discard("")
-    if not targets:
-        return
 
-    buckets: Dict[Tuple[str, str], List[Dict[str, str]]] = {}
-    for r in rows:
-        if (r.get("model_key") or "") != model_key:
-            continue
-        kind = (r.get("kind") or "").strip().lower()
-        if kind not in ("good", "bad"):
-            continue
-        ym = _yyyymm_from_iso(r.get("saved_at", ""))
-        if ym not in targets:
-            continue
-        buckets.setdefault((kind, ym), []).append(r)
-
-    mk_safe = _safe_filename_part(model_key)
-    for ym in targets:
+    for ym in sorted(targets):
+        rows = _read_feedback_csv(feedback_shard_path(dir_path, model_key, ym))
         for kd in ("good", "bad"):
-            p = os.path.join(dir_path, f"{mk_safe}_{kd}_{ym}.md")
+            p = _feedback_md_path(dir_path, model_key, kd, ym)
             lk = _lock_for_path(p)
             with lk:
-                if os.path.exists(p):
-                    try:
-                        os.remove(p)
-                    except Exception:
-                        pass
-
-    for (kind, ym), lst in buckets.items():
-        lst.sort(key=lambda x: x.get("saved_at", ""), reverse=True)
-        p = _feedback_md_path(dir_path, model_key, kind, ym)
-        tmp = p + ".tmp"
+                _render_md_file_locked(dir_path, model_key, kd, ym, rows)
+
+
+_FEEDBACK_MD_RE = re.compile(r"^(.+)_(good|bad)_(\d{6})\.md$")
+
+
+def _rebuild_all_partitions(dir_path: str, model_key: Optional[str]) -> Dict[Tuple[str, str], List[Dict[str, str]]]:
+    # one pass over the directory's state; months that only have a stale .md left get an empty partition
+    parts: Dict[Tuple[str, str], List[Dict[str, str]]] = {}
+    for r in _load_feedback_state_from(dir_path):
+        mk = (r.get("model_key") or "").strip()
+        if not mk or (model_key and mk != model_key):
+            continue
+        if (r.get("kind") or "").strip().lower() not in ("good", "bad"):
+            continue
+        parts.setdefault((mk, _yyyymm_from_iso(r.get("saved_at", ""))), []).append(r)
+
+    safe_to_model = {_safe_filename_part(mk): mk for mk, _ in parts}
+    if model_key:
+        safe_to_model.setdefault(_safe_filename_part(model_key), model_key)
+    try:
+        names = os.listdir(dir_path)
+    except OSError:
+        names = []
+    for name in names:
+        m = _FEEDBACK_MD_RE.match(name)
+        if m and m.group(1) in safe_to_model:
+            parts.setdefault((safe_to_model[m.group(1)], m.group(3)), [])
+    return parts
+
+
+def _render_md_partition(dir_path: str, model_key: str, ym: str, rows: List[Dict[str, str]]) -> None:
+    for kd in ("good", "bad"):
+        p = _feedback_md_path(dir_path, model_key, kd, ym)
         lk = _lock_for_path(p)
         with lk:
-            with open(tmp, "w", encoding="utf-8", newline="\n") as f:
-                for r in lst:
-                    f.write(_md_chunk(
-                        r.get("saved_at", ""),
-                        r.get("user_id", ""),
-                        r.get("model_key", ""),
-                        r.get("question", ""),
-                        r.get("answer", ""),
-                    ))
-            os.replace(tmp, p)
-
-
-def mark_dirty_month(model_key: str, yyyymm: str) -> None:
+            _render_md_file_locked(dir_path, model_key, kd, ym, rows)
+
+
+def _run_feedback_rebuild_job(job: Dict[str, Any], workers: int) -> None:
+    t0 = time.perf_counter()
+    with _rebuild_jobs_guard:
+        job["state"] = "running"
+    try:
+        ensure_dir(job["target_dir"])
+        parts = _rebuild_all_partitions(job["target_dir"], job["model_key"] or None)
+        with _rebuild_jobs_guard:
+            job["total"] = len(parts)
+        months_by_model: Dict[str, Set[str]] = {}
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="md-rebuild-all") as pool:
+            futs = {pool.submit(_render_md_partition, job["target_dir"], mk, ym, rows): (mk, ym) for (mk, ym), rows in parts.items()}
+            for fut in as_completed(futs):
+                mk, ym = futs[fut]
+                err = fut.exception()
+                with _rebuild_jobs_guard:
+                    job["done"] += 1
+                    if err is not None:
+                        job["errors"].append(f"{mk} {ym}: {err}")
+                    else:
+                        months_by_model.setdefault(mk, set()).add(ym)
+        with _rebuild_jobs_guard:
+            job["rebuilt"] = [{"model_key": mk, "months": sorted(ms)} for mk, ms in sorted(months_by_model.items())]
+            job["state"] = "error" if job["errors"] else "done"
+    except Exception as e:
+        with _rebuild_jobs_guard:
+            job["errors"].append(str(e))
+            job["state"] = "error"
+    with _rebuild_jobs_guard:
+        job["finished_at"] = datetime.now().isoformat(timespec="seconds")
+        job["duration_ms"] = round((time.perf_counter() - t0) * 1000.0, 2)
+
+
+def start_feedback_rebuild_job(cfg: AppConfig, target_dir: str, model_key: str = "") -> Dict[str, Any]:
+    with _rebuild_jobs_guard:
+        for job in _rebuild_jobs.values():
+            if job["state"] in ("queued", "running") and job["target_dir"] == target_dir and job["model_key"] == model_key:
+                return dict(job)
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "state": "queued",
+            "target_dir": target_dir,
+            "model_key": model_key,
+            "total": 0,
+            "done": 0,
+            "rebuilt": [],
+            "errors": [],
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "finished_at": "",
+            "duration_ms": 0.0,
+        }
+        _rebuild_jobs[job["job_id"]] = job
+        while len(_rebuild_jobs) > 50:
+            _rebuild_jobs.popitem(last=False)
+        snapshot = dict(job)
+    Thread(target=_run_feedback_rebuild_job, args=(job, cfg.feedback_rebuild_workers), name="feedback-rebuild", daemon=True).start()
+    return snapshot
+
+
+def feedback_rebuild_job_status(job_id: str) -> Optional[Dict[str, Any]]:
+    with _rebuild_jobs_guard:
+        job = _rebuild_jobs.get(job_id)
+        if job is None:
+            return None
+        out = dict(job)
+        out["errors"] = list(job["errors"])
+        return out
+
+
+# Dirty (dir, model) -> months are rebuilt by one scheduler thread. Marks are
+# debounced by MD_REBUILD_COOLDOWN_SEC (capped at 6 windows after the first
+# mark), rebuilds run on a pool of MD_REBUILD_WORKERS with at most one job per
+# (dir, model), and pending plus in-flight months are persisted to
+# _spool/md_dirty.json so a restart picks them up again.
+
+def _md_dirty_save_locked() -> None:
+    if not _md_dirty_file:
+        return
+    merged: Dict[Tuple[str, str], Set[str]] = {}
+    for k, e in _md_dirty.items():
+        merged.setdefault(k, set()).update(e["months"])
+    for k, months in _md_running.items():
+        merged.setdefault(k, set()).update(months)
+    data = [{"dir": d, "model_key": mk, "months": sorted(months)} for (d, mk), months in sorted(merged.items())]
+    try:
+        ensure_dir(os.path.dirname(_md_dirty_file))
+        tmp = _md_dirty_file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, _md_dirty_file)
+    except OSError as e:
+        _md_sched_stats["last_error"] = f"persist: {e}"
+
+
+def _md_mark_locked(dir_path: str, model_key: str, months: Set[str], now: float) -> None:
+    e = _md_dirty.get((dir_path, model_key))
+    if e is None:
+        e = {"months": set(), "first": now, "due": now}
+        _md_dirty[(dir_path, model_key)] = e
+    e["months"].update(months)
+    e["due"] = min(e["first"] + _md_debounce_sec * 6, now + _md_debounce_sec)
+
+
+def mark_dirty_month(dir_path: str, model_key: str, yyyymm: str) -> None:
     ym = re.sub(r"\D", "", (yyyymm or ""))[:6]
     if not ym:
         return
-    _dirty_months_by_model.setdefault(model_key, set()).add(ym)
+    with _md_sched_cond:
+        _md_mark_locked(dir_path, model_key, {ym}, time.time())
+        _md_dirty_save_locked()
+        _md_sched_cond.notify()
 
 
-def maybe_rebuild_dirty_months(cfg: AppConfig, dir_path: str, model_key: str) -> None:
-    now = time.time()
-    with _md_guard:
-        dirty = _dirty_months_by_model.get(model_key, set())
-        if not dirty:
-            return
-        last = _last_md_rebuild_at.get(model_key, 0.0)
-        if (now - last) < cfg.md_rebuild_cooldown_sec:
+def _md_rebuild_job(key: Tuple[str, str], months: Set[str]) -> None:
+    t0 = time.perf_counter()
+    err = ""
+    try:
+        rebuild_feedback_md_for_model_months_in_dir(key[0], key[1], months)
+    except Exception as e:
+        err = f"{key[1]}: {e}"
+    ms = round((time.perf_counter() - t0) * 1000.0, 2)
+    with _md_sched_cond:
+        _md_running.pop(key, None)
+        st = _md_sched_stats
+        st["rebuilds"] += 1
+        st["last_ms"] = ms
+        st["max_ms"] = max(st["max_ms"], ms)
+        st["total_ms"] += ms
+        st["last_at"] = datetime.now().isoformat(timespec="seconds")
+        if err:
+            st["errors"] += 1
+            st["last_error"] = err
+            _md_mark_locked(key[0], key[1], months, time.time())
+        _md_dirty_save_locked()
+        _md_sched_cond.notify()
+
+
+def _md_scheduler_loop(workers: int) -> None:
+    pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="md-rebuild")
+    while True:
+        with _md_sched_cond:
+            now = time.time()
+            waiting = [(k, e) for k, e in _md_dirty.items() if k not in _md_running]
+            ready = [k for k, e in waiting if e["due"] <= now]
+            if not ready:
+                _md_sched_cond.wait(min(e["due"] for _, e in waiting) - now if waiting else None)
+                continue
+            jobs = []
+            for k in ready:
+                months = _md_dirty.pop(k)["months"]
+                _md_running[k] = months
+                jobs.append((k, months))
+        for k, months in jobs:
+            pool.submit(_md_rebuild_job, k, months)
+
+
+def start_md_scheduler(cfg: AppConfig) -> None:
+    global _md_sched_thread, _md_dirty_file, _md_debounce_sec
+    with _md_sched_cond:
+        if _md_sched_thread is not None and _md_sched_thread.is_alive():
             return
-        months = set(dirty)
-        _dirty_months_by_model[model_key] = set()
-        _last_md_rebuild_at[model_key] = now
-    rebuild_feedback_md_for_model_months_in_dir(dir_path, model_key, months)
+        _md_debounce_sec = float(max(0, cfg.md_rebuild_cooldown_sec))
+        _md_dirty_file = os.path.join(cfg.base_dir, "_spool", "md_dirty.json")
+        try:
+            with open(_md_dirty_file, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = []
+        now = time.time()
+        for it in saved if isinstance(saved, list) else []:
+            try:
+                _md_mark_locked(str(it["dir"]), str(it["model_key"]), {str(m) for m in it["months"]}, now)
+            except (KeyError, TypeError):
+                continue
+        _md_sched_thread = Thread(target=_md_scheduler_loop, args=(cfg.md_rebuild_workers,), name="md-scheduler", daemon=True)
+        _md_sched_thread.start()
+
+
+def md_rebuild_stats() -> Dict[str, Any]:
+    with _md_sched_cond:
+        out = dict(_md_sched_stats)
+        out["pending_models"] = len(_md_dirty)
+        out["pending_months"] = sum(len(e["months"]) for e in _md_dirty.values())
+        out["in_flight"] = len(_md_running)
+    total_ms = out.pop("total_ms")
+    out["avg_ms"] = round(total_ms / out["rebuilds"], 2) if out["rebuilds"] else 0.0
+    return out
 
 
-def list_feedback_state_for_user_thread(cfg: AppConfig, *, user_id: str, thread_id: str, model_key: Optional[str]) -> List[Dict[str, str]]:
-    rows = load_feedback_state_merged(cfg)
+def _csv_list_feedback_state_for_user_thread(cfg: AppConfig, *, user_id: str, thread_id: str, model_key: Optional[str]) -> List[Dict[str, str]]:
+    rows = _merged_feedback_lookup(cfg, lambda d: _feedback_thread_rows(d, user_id, thread_id)).values()
     out = []
     for r in rows:
-        if (r.get("user_id") or "") != user_id:
-            continue
-        if (r.get("thread_id") or "") != thread_id:
-            continue
         if model_key and (r.get("model_key") or "") != model_key:
             continue
         kind = (r.get("kind") or "").strip().lower()
@@ -758,6 +2521,73 @@ def list_feedback_state_for_user_thread(cfg: AppConfig, *, user_id: str, thread_
     return out
 
 
+def _csv_get_feedback_state(cfg: AppConfig, *, user_id: str, model_key: str, thread_id: str, bot_ts: str) -> Optional[Dict[str, str]]:
+    key = _feedback_key(user_id, model_key, thread_id, bot_ts)
+    r = _merged_feedback_lookup(cfg, lambda d: _feedback_rows_by_key(d, key)).get(key)
+    if r is None:
+        return None
+    return {
+        "kind": (r.get("kind") or "none").strip().lower(),
+        "saved_at": r.get("saved_at") or "",
+    }
+
+
+def get_feedback_state(cfg: AppConfig, *, user_id: str, model_key: str, thread_id: str, bot_ts: str) -> Optional[Dict[str, str]]:
+    return storage_for(cfg).get_feedback_state(user_id=user_id, model_key=model_key, thread_id=thread_id, bot_ts=bot_ts)
+
+
+def list_feedback_state_for_user_thread(cfg: AppConfig, *, user_id: str, thread_id: str, model_key: Optional[str]) -> List[Dict[str, str]]:
+    return storage_for(cfg).list_feedback_state_for_user_thread(user_id=user_id, thread_id=thread_id, model_key=model_key)
+
+
+def upsert_feedback_state(
+    cfg: AppConfig,
+    *,
+    dir_path: str,
+    user_id: str,
+    model_key: str,
+    thread_id: str,
+    bot_ts: str,
+    kind: str,
+    saved_at: str,
+    question: str,
+    answer: str,
+) -> None:
+    if kind == "none":
+        _nas_sync_note_delete({
+            "user_id": user_id,
+            "model_key": model_key,
+            "thread_id": thread_id,
+            "bot_ts": bot_ts,
+            "kind": kind,
+            "saved_at": saved_at,
+        })
+    if kind == "none" and dir_path != cfg.feedback_dir_local and _feedback_shards(cfg.feedback_dir_local):
+        # drop a spooled copy too, or the next spool -> NAS sync would bring it back
+        upsert_feedback_state_to_dir(
+            dir_path=cfg.feedback_dir_local,
+            user_id=user_id,
+            model_key=model_key,
+            thread_id=thread_id,
+            bot_ts=bot_ts,
+            kind=kind,
+            saved_at=saved_at,
+            question=question,
+            answer=answer,
+        )
+    storage_for(cfg).upsert_feedback_state(
+        dir_path=dir_path,
+        user_id=user_id,
+        model_key=model_key,
+        thread_id=thread_id,
+        bot_ts=bot_ts,
+        kind=kind,
+        saved_at=saved_at,
+        question=question,
+        answer=answer,
+    )
+
+
 def _compute_months_by_model(rows: List[Dict[str, str]]) -> Dict[str, Set[str]]:
     out: Dict[str, Set[str]] = {}
     for r in rows:
@@ -774,6 +2604,7 @@ def sync_local_spool_to_nas_if_possible(cfg: AppConfig) -> Dict[str, Any]:
     report: Dict[str, Any] = {
         "nas_available": False,
         "moved_csv": False,
+        "merged_rows": 0,
         "rebuilt": [],
         "errors": [],
     }
@@ -782,65 +2613,161 @@ def sync_local_spool_to_nas_if_possible(cfg: AppConfig) -> Dict[str, Any]:
         return report
     report["nas_available"] = True
 
-    local_csv = feedback_state_csv_path(cfg.feedback_dir_local)
-    if not os.path.exists(local_csv):
+    local_shards = feedback_shard_dir(cfg.feedback_dir_local)
+    if not _feedback_shards(cfg.feedback_dir_local):
         return report
 
+    # The spool lock is only held while the shards are snapshotted, i.e. moved
+    # aside into "<shard dir>.bak_<ts>/feedback_state" and replaced by an empty
+    # spool. The NAS merge runs without it, so feedback POSTs never wait for
+    # SMB. Lookups see the snapshot until it is merged; deletes made meanwhile
+    # are replayed afterwards so the merge cannot resurrect them. If the merge
+    # fails the snapshot goes back into the spool, where newer rows win.
+    snap = local_shards + f".bak_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
     try:
-        rows_local = _load_feedback_state_from(cfg.feedback_dir_local)
+        with _feedback_dir_lock(cfg.feedback_dir_local):
+            rows_local = _load_feedback_state_from(cfg.feedback_dir_local)
+            if not rows_local:
+                return report
+            ensure_dir(snap)
+            os.replace(local_shards, feedback_shard_dir(snap))
+            ensure_dir(local_shards)
+            with _nas_sync_guard:
+                _nas_sync_inflight["dir"] = snap
+                _nas_sync_inflight["tombstones"] = {}
     except Exception as e:
+        if not os.path.isdir(feedback_shard_dir(snap)):
+            shutil.rmtree(snap, ignore_errors=True)
         report["errors"].append(str(e))
         return report
 
-    if not rows_local:
+    try:
+        ensure_feedback_state_csv(cfg.feedback_dir_nas, cfg.backup_dir)
+        report["merged_rows"] = _feedback_upsert_rows(cfg.feedback_dir_nas, rows_local, only_if_newer=True)
+        deletes = _nas_sync_finish()
+        if deletes:
+            _feedback_upsert_rows(cfg.feedback_dir_nas, deletes, only_if_newer=True)
+        report["moved_csv"] = True
+        shutil.rmtree(snap, ignore_errors=True)
+    except Exception as e:
+        report["errors"].append(str(e))
+        deletes = _nas_sync_finish()
+        try:
+            _feedback_upsert_rows(cfg.feedback_dir_local, rows_local + deletes, only_if_newer=True)
+            shutil.rmtree(snap, ignore_errors=True)
+        except Exception as e2:
+            report["errors"].append(f"spool restore error (snapshot kept at {snap}): {e2}")
         return report
+    finally:
+        with _feedback_idx_guard:
+            _feedback_idx.pop(feedback_shard_dir(snap), None)
 
-    try:
-        ensure_feedback_state_csv(cfg.feedback_dir_nas)
-        rows_nas = _load_feedback_state_from(cfg.feedback_dir_nas)
-        merged = _merge_feedback_rows(rows_nas, rows_local)
-        _save_feedback_state_to(cfg.feedback_dir_nas, merged)
+    mk_to_months = _compute_months_by_model(rows_local)
+    for mk, months in mk_to_months.items():
+        try:
+            rebuild_feedback_md_for_model_months_in_dir(cfg.feedback_dir_nas, mk, months)
+            report["rebuilt"].append({"model_key": mk, "months": sorted(list(months))})
+        except Exception as e:
+            report["errors"].append(f"md rebuild error: {mk}: {e}")
+    return report
 
-        mk_to_months = _compute_months_by_model(rows_local)
-        for mk, months in mk_to_months.items():
-            try:
-                rebuild_feedback_md_for_model_months_in_dir(cfg.feedback_dir_nas, mk, months)
-                report["rebuilt"].append({"model_key": mk, "months": sorted(list(months))})
-            except Exception as e:
-                report["errors"].append(f"md rebuild error: {mk}: {e}")
 
-        bak = local_csv + f".bak_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        try:
-            os.replace(local_csv, bak)
-        except Exception:
-            try:
-                os.remove(local_csv)
-            except Exception:
-                pass
+# Spool -> NAS sync runs on one background thread (or in tools/nas_sync.py
+# --daemon) so a feedback POST only ever writes to one directory. The worker
+# wakes every NAS_SYNC_INTERVAL_SEC, or early via notify_spool_changed().
 
-        report["moved_csv"] = True
-        return report
+def _nas_sync_note_delete(row: Dict[str, str]) -> None:
+    with _nas_sync_guard:
+        if _nas_sync_inflight["dir"]:
+            r = {k: row.get(k, "") for k in FEEDBACK_FIELDS}
+            _nas_sync_inflight["tombstones"][_feedback_key(r["user_id"], r["model_key"], r["thread_id"], r["bot_ts"])] = r
 
-    except Exception as e:
-        report["errors"].append(str(e))
-        return report
 
+def _nas_sync_finish() -> List[Dict[str, str]]:
+    with _nas_sync_guard:
+        deletes = list(_nas_sync_inflight["tombstones"].values())
+        _nas_sync_inflight["dir"] = ""
+        _nas_sync_inflight["tombstones"] = {}
+    return deletes
 
-def sse_pack(event: str, data_obj: Dict[str, Any]) -> str:
-    return f"event: {event}\ndata: {json.dumps(data_obj, ensure_ascii=False)}\n\n"
 
+def spool_backlog(cfg: AppConfig) -> int:
+    if not _feedback_shards(cfg.feedback_dir_local):
+        return 0
+    with _feedback_dir_lock(cfg.feedback_dir_local):
+        return len(_feedback_index_locked(cfg.feedback_dir_local)["by_key"])
 
-def iter_dify_sse(resp: requests.Response) -> Iterable[Dict[str, Any]]:
-    for raw in resp.iter_lines(decode_unicode=True):
-        if not raw:
-            continue
-        s = raw.strip()
-        if not s.startswith("data:"):
-            continue
-        payload = s[len("data:"):].strip()
-        if payload == "[DONE]":
-            break
+
+def notify_spool_changed() -> None:
+    _nas_sync_wake.set()
+
+
+def run_nas_sync_once(cfg: AppConfig) -> Dict[str, Any]:
+    with _nas_sync_guard:
+        _nas_sync_stats["state"] = "running"
+    t0 = time.perf_counter()
+    try:
+        report = sync_local_spool_to_nas_if_possible(cfg)
+    except Exception as e:
+        report = {"nas_available": False, "moved_csv": False, "rebuilt": [], "errors": [str(e)]}
+    with _nas_sync_guard:
+        _nas_sync_stats["state"] = "idle"
+        _nas_sync_stats["runs"] += 1
+        _nas_sync_stats["merged_rows"] += int(report.get("merged_rows") or 0)
+        _nas_sync_stats["last_run_at"] = datetime.now().isoformat(timespec="seconds")
+        _nas_sync_stats["last_duration_ms"] = round((time.perf_counter() - t0) * 1000.0, 2)
+        _nas_sync_stats["last_report"] = report
+        if report.get("errors"):
+            _nas_sync_stats["errors"] += 1
+            _nas_sync_stats["last_error"] = "; ".join(str(e) for e in report["errors"])
+    return report
+
+
+def nas_sync_loop(cfg: AppConfig, interval_sec: float, on_report=None) -> None:
+    _nas_sync_wake.set()
+    while True:
+        _nas_sync_wake.wait(max(1.0, interval_sec))
+        _nas_sync_wake.clear()
         try:
-            yield json.loads(payload)
-        except Exception:
-            continue
\ No newline at end of file
+            if not is_nas_available_cached(cfg) or spool_backlog(cfg) == 0:
+                continue
+        except Exception as e:
+            with _nas_sync_guard:
+                _nas_sync_stats["errors"] += 1
+                _nas_sync_stats["last_error"] = str(e)
+            continue
+        report = run_nas_sync_once(cfg)
+        if on_report is not None:
+            on_report(report)
+
+
+def _wake_sync_on_nas_up(ok: bool) -> None:
+    if ok:
+        notify_spool_changed()
+
+
+def start_nas_sync_worker(cfg: AppConfig) -> None:
+    global _nas_sync_thread
+    if cfg.nas_sync_interval_sec <= 0:
+        return
+    with _nas_sync_guard:
+        if _nas_sync_thread is not None and _nas_sync_thread.is_alive():
+            return
+        _nas_sync_stats["state"] = "idle"
+        add_nas_state_listener(_wake_sync_on_nas_up)
+        _nas_sync_thread = Thread(target=nas_sync_loop, args=(cfg, cfg.nas_sync_interval_sec), name="nas-sync", daemon=True)
+        _nas_sync_thread.start()
+
+
+def nas_sync_status(cfg: AppConfig) -> Dict[str, Any]:
+    with _nas_sync_guard:
+        out = dict(_nas_sync_stats)
+    try:
+        out["backlog"] = spool_backlog(cfg)
+    except Exception:
+        out["backlog"] = -1
+    return out
+
+
+def is_admin(cfg: AppConfig, user_id: str) -> bool:
+    return bool(user_id) and user_id in {u.strip() for u in (cfg.admin_user_ids or "").split(",") if u.strip()}
@@ -0,0 +1,832 @@
+import json
+import os
+import socket
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from threading import Condition, Lock, Thread, local
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from config import AppConfig
+
+from . import metrics
+from .core import MODELS, resolve_api_key
+
+# One keep-alive requests.Session per (DIFY_API_BASE, model). The gate caps
+# concurrent streams at the pool size so urllib3 never opens throwaway
+# connections past it; time spent waiting for a slot is counted separately
+# from the Dify round trip.
+_dify_guard = Lock()
+_dify_pools: Dict[Tuple[str, str], Dict[str, Any]] = {}
+_dify_eps: Dict[Tuple[str, str], Dict[str, Any]] = {}
+_dify_orphans: List[Dict[str, Any]] = []
+_dify_local = local()
+_dify_affinity: "OrderedDict[str, str]" = OrderedDict()
+
+_sse_guard = Lock()
+_sse_stats: Dict[str, Any] = {"dify_events": 0, "dify_bad_payloads": 0, "dify_last_bad": ""}
+
+
+# Dify attempts run on their own threads. Each attempt registers the urllib3
+# connection its request goes out on (pooled or new) in att["conn"], so a
+# losing hedge can be cut off by shutting the socket down, before or after
+# the response headers. A connection that finishes connecting after its
+# attempt was cancelled shuts itself down; both sides check under att["cond"].
+
+def _dify_track_conn(conn: HTTPConnection) -> None:
+    att = getattr(_dify_local, "att", None)
+    if att is not None:
+        with att["cond"]:
+            att["conn"] = conn
+
+
+def _dify_check_cancelled(conn: HTTPConnection) -> None:
+    att = getattr(_dify_local, "att", None)
+    if att is None:
+        return
+    with att["cond"]:
+        cancelled = att["cancelled"]
+    if cancelled:
+        _shutdown_sock(getattr(conn, "sock", None))
+
+
+def _shutdown_sock(sock: Optional[socket.socket]) -> None:
+    try:
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class _DifyHTTPConnection(HTTPConnection):
+    def connect(self) -> None:
+        super().connect()
+        _dify_check_cancelled(self)
+
+    def request(self, *args: Any, **kwargs: Any) -> None:
+        _dify_track_conn(self)
+        super().request(*args, **kwargs)
+
+
+class _DifyHTTPSConnection(HTTPSConnection):
+    def connect(self) -> None:
+        super().connect()
+        _dify_check_cancelled(self)
+
+    def request(self, *args: Any, **kwargs: Any) -> None:
+        _dify_track_conn(self)
+        super().request(*args, **kwargs)
+
+
+class _DifyHTTPPool(HTTPConnectionPool):
+    ConnectionCls = _DifyHTTPConnection
+
+
+class _DifyHTTPSPool(HTTPSConnectionPool):
+    ConnectionCls = _DifyHTTPSConnection
+
+
+class _DifyAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _DifyHTTPPool, "https": _DifyHTTPSPool}
+
+
+def _dify_pool(cfg: AppConfig, model_key: str, base: str) -> Dict[str, Any]:
+    k = (base, model_key)
+    with _dify_guard:
+        pool = _dify_pools.get(k)
+        if pool is not None:
+            return pool
+        size = max(1, cfg.dify_pool_size)
+        s = requests.Session()
+        # only connection failures are retried: the POST never reached Dify
+        retry = Retry(total=cfg.dify_connect_retries, connect=cfg.dify_connect_retries, read=0, status=0, other=0, backoff_factor=0.2)
+        adapter = _DifyAdapter(pool_connections=1, pool_maxsize=size, max_retries=retry)
+        s.mount("http://", adapter)
+        s.mount("https://", adapter)
+        pool = {
+            "session": s,
+            "adapter": adapter,
+            "cond": Condition(),
+            "size": size,
+            "in_use": 0,
+            "stats": {
+                "requests": 0,
+                "peak_in_use": 0,
+                "waits": 0,
+                "wait_timeouts": 0,
+                "wait_ms_total": 0.0,
+                "wait_ms_max": 0.0,
+                "ttfb_ms_last": 0.0,
+                "ttfb_ms_total": 0.0,
+                "errors": 0,
+                "warmed": 0,
+            },
+        }
+        _dify_pools[k] = pool
+        return pool
+
+
+def _dify_pool_acquire(pool: Dict[str, Any], timeout: float) -> None:
+    t0 = time.perf_counter()
+    waited = False
+    with pool["cond"]:
+        while pool["in_use"] >= pool["size"]:
+            waited = True
+            left = timeout - (time.perf_counter() - t0)
+            if left <= 0:
+                pool["stats"]["wait_timeouts"] += 1
+                raise TimeoutError("Dify connection pool exhausted")
+            pool["cond"].wait(left)
+        pool["in_use"] += 1
+        st = pool["stats"]
+        st["requests"] += 1
+        st["peak_in_use"] = max(st["peak_in_use"], pool["in_use"])
+        if waited:
+            ms = (time.perf_counter() - t0) * 1000.0
+            st["waits"] += 1
+            st["wait_ms_total"] += ms
+            st["wait_ms_max"] = max(st["wait_ms_max"], ms)
+
+
+def _dify_pool_release(pool: Dict[str, Any]) -> None:
+    with pool["cond"]:
+        pool["in_use"] -= 1
+        pool["cond"].notify()
+
+
+# Dify endpoints. DIFY_API_BASES (or DIFY_API_BASES_<MODEL>) lists base URLs
+# in order of preference; without it DIFY_API_BASE is a list of one. An
+# endpoint that fails DIFY_ENDPOINT_FAIL_THRESHOLD times in a row is put
+# last for DIFY_ENDPOINT_COOLDOWN_SEC, and a failed attempt moves on to the
+# next endpoint. Each endpoint keeps a histogram of time to the first body
+# byte. With DIFY_HEDGE=1, a first turn whose first byte is later than the
+# endpoint's p95 (never below DIFY_HEDGE_MIN_MS; DIFY_HEDGE_DEFAULT_MS until
+# DIFY_HEDGE_MIN_SAMPLES are in) is also sent to the next endpoint, and the
+# stream that starts first wins. Turns that continue a Dify conversation are
+# never hedged: they go first to the endpoint that created the conversation,
+# and an endpoint that does not know the id answers 404, which only moves on
+# to the next one. A conversation is never silently restarted elsewhere.
+
+DIFY_TTFB_BUCKETS_MS = (50, 100, 200, 400, 800, 1600, 3200, 6400, 12800, 25600, 60000)
+_m_dify_ttfb = metrics.histogram(
+    "chutgpt_dify_ttfb_seconds",
+    "Dify time to the first body byte of the chat stream.",
+    ("model", "endpoint"),
+    [ms / 1000.0 for ms in DIFY_TTFB_BUCKETS_MS],
+)
+_DIFY_AFFINITY_MAX = 20000
+
+
+def dify_bases(cfg: AppConfig, model_key: str) -> List[str]:
+    raw = (os.environ.get(f"DIFY_API_BASES_{model_key.upper()}") or "").strip() or cfg.dify_api_bases or cfg.dify_api_base
+    out: List[str] = []
+    for b in raw.split(","):
+        b = b.strip().rstrip("/")
+        if b and b not in out:
+            out.append(b)
+    return out
+
+
+def _dify_endpoint_locked(model_key: str, base: str) -> Dict[str, Any]:
+    ep = _dify_eps.get((base, model_key))
+    if ep is None:
+        ep = {
+            "fails": 0,
+            "down_until": 0.0,
+            "ok": 0,
+            "errors": 0,
+            "last_error": "",
+            "hist": [0] * (len(DIFY_TTFB_BUCKETS_MS) + 1),
+            "ttfb_n": 0,
+            "ttfb_ms_total": 0.0,
+            "hedged_to": 0,
+            "hedge_wins": 0,
+            "failovers_to": 0,
+        }
+        _dify_eps[(base, model_key)] = ep
+    return ep
+
+
+def _ttfb_quantile_ms(hist: List[int], q: float) -> Optional[float]:
+    n = sum(hist)
+    if not n:
+        return None
+    rank = q * n
+    seen = 0
+    for i, c in enumerate(hist):
+        seen += c
+        if seen >= rank:
+            return float(DIFY_TTFB_BUCKETS_MS[i]) if i < len(DIFY_TTFB_BUCKETS_MS) else float(DIFY_TTFB_BUCKETS_MS[-1]) * 2
+    return float(DIFY_TTFB_BUCKETS_MS[-1]) * 2
+
+
+def dify_candidates(cfg: AppConfig, model_key: str, conversation_id: str = "") -> List[str]:
+    bases = dify_bases(cfg, model_key)
+    now = time.monotonic()
+    with _dify_guard:
+        up = [b for b in bases if _dify_endpoint_locked(model_key, b)["down_until"] <= now]
+        down = [b for b in bases if b not in up]
+        pinned = _dify_affinity.get(conversation_id) if conversation_id else None
+    order = up + down
+    if pinned in order:
+        order.remove(pinned)
+        order.insert(0, pinned)
+    return order
+
+
+def dify_endpoint_ok(model_key: str, base: str, ttfb_ms: float) -> None:
+    i = 0
+    while i < len(DIFY_TTFB_BUCKETS_MS) and ttfb_ms > DIFY_TTFB_BUCKETS_MS[i]:
+        i += 1
+    with _dify_guard:
+        ep = _dify_endpoint_locked(model_key, base)
+        ep["fails"] = 0
+        ep["down_until"] = 0.0
+        ep["ok"] += 1
+        ep["hist"][i] += 1
+        ep["ttfb_n"] += 1
+        ep["ttfb_ms_total"] += ttfb_ms
+    metrics.observe(_m_dify_ttfb, (model_key, base), ttfb_ms / 1000.0)
+
+
+def dify_endpoint_failed(cfg: AppConfig, model_key: str, base: str, err: BaseException) -> None:
+    with _dify_guard:
+        ep = _dify_endpoint_locked(model_key, base)
+        ep["fails"] += 1
+        ep["errors"] += 1
+        ep["last_error"] = f"{type(err).__name__}: {err}"[:300]
+        if ep["fails"] >= max(1, cfg.dify_endpoint_fail_threshold):
+            ep["down_until"] = time.monotonic() + cfg.dify_endpoint_cooldown_sec
+
+
+def dify_note_attempt(model_key: str, base: str, kind: str) -> None:
+    # kind: "hedged_to", "hedge_wins" or "failovers_to"
+    with _dify_guard:
+        _dify_endpoint_locked(model_key, base)[kind] += 1
+
+
+def dify_failover_ok(status: Optional[int], conversation_id: str) -> bool:
+    # status None is a transport error (connect, timeout, reset)
+    if status is None or status >= 500 or status == 429:
+        return True
+    return status == 404 and bool(conversation_id)
+
+
+def dify_counts_as_failure(status: Optional[int]) -> bool:
+    return status is None or status >= 500 or status == 429
+
+
+def dify_hedge_after_sec(cfg: AppConfig, model_key: str, base: str) -> float:
+    with _dify_guard:
+        ep = _dify_endpoint_locked(model_key, base)
+        p95 = _ttfb_quantile_ms(ep["hist"], 0.95) if ep["ttfb_n"] >= max(1, cfg.dify_hedge_min_samples) else None
+    ms = cfg.dify_hedge_default_ms if p95 is None else p95
+    return max(cfg.dify_hedge_min_ms, ms) / 1000.0
+
+
+def dify_remember_conversation(conversation_id: str, base: str) -> None:
+    if not conversation_id or not base:
+        return
+    with _dify_guard:
+        _dify_affinity[conversation_id] = base
+        _dify_affinity.move_to_end(conversation_id)
+        while len(_dify_affinity) > _DIFY_AFFINITY_MAX:
+            _dify_affinity.popitem(last=False)
+
+
+def dify_hedge_enabled(cfg: AppConfig, payload: Dict[str, Any], bases: List[str]) -> bool:
+    return bool(cfg.dify_hedge) and not payload.get("conversation_id") and len(bases) > 1
+
+
+def _dify_http_status(err: BaseException) -> Optional[int]:
+    resp = getattr(err, "response", None)
+    return getattr(resp, "status_code", None) if resp is not None else None
+
+
+def _dify_open(cfg: AppConfig, model_key: str, api_key: str, payload: Dict[str, Any], att: Dict[str, Any]) -> None:
+    # POST and wait for the first body byte; fills att["resp"/"chunks"/"first"] or att["error"]
+    pool = _dify_pool(cfg, model_key, att["base"])
+    t0 = time.perf_counter()
+    try:
+        _dify_pool_acquire(pool, float(cfg.dify_connect_timeout_sec))
+    except Exception as e:
+        att["error"] = e
+        return
+    with att["cond"]:
+        att["pool"] = pool
+    try:
+        r = pool["session"].post(
+            f"{att['base']}/chat-messages",
+            headers={
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+            },
+            json=payload,
+            stream=True,
+            timeout=(cfg.dify_connect_timeout_sec, cfg.dify_read_timeout_sec),
+        )
+        att["resp"] = r
+        if r.status_code >= 400:
+            # read the (short) error body so it can be shown and the socket reused
+            _ = r.content
+            raise requests.HTTPError(f"{r.status_code} from {att['base']}", response=r)
+        chunks = _iter_sse_chunks(r)
+        att["first"] = next(chunks, b"")
+        att["chunks"] = chunks
+    except Exception as e:
+        att["error"] = e
+        if dify_counts_as_failure(_dify_http_status(e)):
+            with pool["cond"]:
+                pool["stats"]["errors"] += 1
+        return
+    ms = (time.perf_counter() - t0) * 1000.0
+    with pool["cond"]:
+        pool["stats"]["ttfb_ms_last"] = round(ms, 2)
+        pool["stats"]["ttfb_ms_total"] += ms
+    dify_endpoint_ok(model_key, att["base"], ms)
+
+
+def _dify_attempt_close(att: Dict[str, Any]) -> None:
+    if att["resp"] is not None:
+        try:
+            att["resp"].close()
+        except Exception:
+            pass
+    with att["cond"]:
+        pool, att["pool"] = att["pool"], None
+    if pool is not None:
+        _dify_pool_release(pool)
+
+
+def _dify_attempt_abort(att: Dict[str, Any]) -> None:
+    # close() would wait for the attempt thread's blocked read (it holds the reader's lock);
+    # shutting the socket down makes that read, or the wait for headers, return at once
+    with att["cond"]:
+        att["cancelled"] = True
+        conn = att["conn"]
+        sock = getattr(conn, "sock", None) if conn is not None else None
+    _shutdown_sock(sock)
+
+
+DIFY_DRAIN_SEC = 1.0
+
+
+def _dify_release_winner(att: Dict[str, Any]) -> None:
+    # After message_end Dify normally only has the chunked terminator left. Reading it lets
+    # the keep-alive socket go back to the pool; a body that stays open longer than
+    # DIFY_DRAIN_SEC is dropped with its connection. Runs off the request thread.
+    deadline = time.monotonic() + DIFY_DRAIN_SEC
+    with att["cond"]:
+        sock = getattr(att["conn"], "sock", None) if att["conn"] is not None else None
+    try:
+        if sock is not None:
+            sock.settimeout(DIFY_DRAIN_SEC)
+        for _ in att["chunks"] or ():
+            if time.monotonic() >= deadline:
+                break
+    except Exception:
+        pass
+    _dify_attempt_close(att)
+
+
+def _dify_attempt(cfg: AppConfig, model_key: str, api_key: str, payload: Dict[str, Any], att: Dict[str, Any], cond: Condition) -> None:
+    _dify_local.att = att
+    try:
+        _dify_open(cfg, model_key, api_key, payload, att)
+    finally:
+        _dify_local.att = None
+    with cond:
+        att["done"] = True
+        orphan = att["cancelled"]
+        cond.notify_all()
+    if orphan:
+        _dify_attempt_close(att)
+        with _dify_guard:
+            if att in _dify_orphans:
+                _dify_orphans.remove(att)
+
+
+@contextmanager
+def dify_chat_stream(
+    cfg: AppConfig,
+    model_key: str,
+    api_key: str,
+    payload: Dict[str, Any],
+    on_abort: Optional[Callable[[Callable[[], None]], None]] = None,
+):
+    # yields {"base", "chunks"} for the endpoint whose stream started first; raises the last
+    # error (requests.HTTPError carries the response) when no endpoint could take the turn.
+    # on_abort receives a function that breaks off the turn from another thread: the wait
+    # for headers raises ConnectionAbortedError and a blocked chunk read returns at once.
+    cid = payload.get("conversation_id") or ""
+    todo = dify_candidates(cfg, model_key, cid)
+    hedge = dify_hedge_enabled(cfg, payload, todo)
+    cond = Condition()
+    live: List[Dict[str, Any]] = []
+    winner: Optional[Dict[str, Any]] = None
+    state = {"aborted": False, "closed": False}
+
+    def abort() -> None:
+        # under cond, so the winner's socket is never shut down after it went back to the pool
+        with cond:
+            if state["closed"] or state["aborted"]:
+                return
+            state["aborted"] = True
+            for a in live + ([winner] if winner is not None else []):
+                _dify_attempt_abort(a)
+            cond.notify_all()
+
+    def launch(kind: str = "") -> Dict[str, Any]:
+        att = {
+            "base": todo.pop(0),
+            "model": model_key,
+            "cond": cond,
+            "done": False,
+            "cancelled": False,
+            "conn": None,
+            "resp": None,
+            "pool": None,
+            "chunks": None,
+            "first": b"",
+            "error": None,
+            "kind": kind,
+            "started": time.monotonic(),
+        }
+        if kind:
+            dify_note_attempt(model_key, att["base"], kind)
+        live.append(att)
+        Thread(target=_dify_attempt, args=(cfg, model_key, api_key, payload, att, cond), name="dify-attempt", daemon=True).start()
+        return att
+
+    try:
+        if on_abort is not None:
+            on_abort(abort)
+        with cond:
+            first = launch()
+            hedge_at = time.monotonic() + dify_hedge_after_sec(cfg, model_key, first["base"]) if hedge else None
+            while winner is None:
+                if state["aborted"]:
+                    # aborted attempts fail on their own; that says nothing about the endpoint
+                    raise ConnectionAbortedError("Dify request cancelled")
+                for att in [a for a in live if a["done"]]:
+                    live.remove(att)
+                    if att["error"] is None:
+                        winner = att
+                        break
+                    status = _dify_http_status(att["error"])
+                    _dify_attempt_close(att)
+                    if dify_counts_as_failure(status):
+                        dify_endpoint_failed(cfg, model_key, att["base"], att["error"])
+                    if not dify_failover_ok(status, cid) or (not live and not todo):
+                        raise att["error"]
+                    if not live:
+                        launch("failovers_to")
+                if winner is not None:
+                    break
+                timeout = None
+                if hedge_at is not None and todo:
+                    timeout = hedge_at - time.monotonic()
+                    if timeout <= 0:
+                        launch("hedged_to")
+                        hedge_at = None
+                        continue
+                cond.wait(timeout)
+        if winner["kind"] == "hedged_to":
+            dify_note_attempt(model_key, winner["base"], "hedge_wins")
+        first_chunk, rest = winner["first"], winner["chunks"]
+
+        def chunks() -> Iterable[bytes]:
+            # a plain loop, not "yield from": closing this wrapper must not close rest,
+            # which _dify_release_winner drains on its own thread after the block exits
+            if first_chunk:
+                yield first_chunk
+            for b in rest:
+                yield b
+
+        yield {"base": winner["base"], "chunks": chunks()}
+    finally:
+        with cond:
+            state["closed"] = True
+            leftovers = [a for a in live if a["done"]]
+            running = [a for a in live if not a["done"]]
+            for a in running:
+                a["cancelled"] = True
+            if running:
+                # until its own thread sees the failed request and releases the pool slot
+                with _dify_guard:
+                    _dify_orphans.extend(running)
+        for a in running:
+            _dify_attempt_abort(a)
+        for a in leftovers:
+            _dify_attempt_close(a)
+        if winner is not None:
+            Thread(target=_dify_release_winner, args=(winner,), name="dify-release", daemon=True).start()
+
+
+def _warm_dify_pool(cfg: AppConfig, model_key: str, base: str, api_key: str) -> None:
+    # any answer leaves a kept-alive socket in the pool; GET /parameters is the cheapest authenticated call
+    pool = _dify_pool(cfg, model_key, base)
+    n = min(pool["size"], max(0, cfg.dify_pool_warm))
+
+    def one() -> bool:
+        try:
+            r = pool["session"].get(
+                f"{base}/parameters",
+                headers={"Authorization": f"Bearer {api_key}"},
+                timeout=(cfg.dify_connect_timeout_sec, cfg.dify_connect_timeout_sec),
+            )
+            r.close()
+            return True
+        except Exception:
+            return False
+
+    if n <= 0:
+        return
+    with ThreadPoolExecutor(max_workers=n, thread_name_prefix="dify-warm") as ex:
+        ok = sum(1 for v in ex.map(lambda _: one(), range(n)) if v)
+    with pool["cond"]:
+        pool["stats"]["warmed"] += ok
+
+
+def start_dify_pools(cfg: AppConfig) -> None:
+    if not cfg.dify_api_base:
+        return
+    todo = []
+    for mk in MODELS:
+        api_key = resolve_api_key(cfg, mk)
+        for base in dify_bases(cfg, mk):
+            _dify_pool(cfg, mk, base)
+            if api_key:
+                todo.append((mk, base, api_key))
+    if cfg.dify_pool_warm <= 0 or not todo:
+        return
+
+    def warm_all() -> None:
+        for mk, base, api_key in todo:
+            _warm_dify_pool(cfg, mk, base, api_key)
+
+    Thread(target=warm_all, name="dify-warm", daemon=True).start()
+
+
+def _dify_orphan_counts() -> Dict[Tuple[str, str], Tuple[int, float]]:
+    # (base, model) -> (pool slots still held by cancelled attempts, age of the oldest in seconds)
+    now = time.monotonic()
+    out: Dict[Tuple[str, str], Tuple[int, float]] = {}
+    with _dify_guard:
+        orphans = list(_dify_orphans)
+    for a in orphans:
+        if a["pool"] is None:
+            continue
+        n, age = out.get((a["base"], a["model"]), (0, 0.0))
+        out[(a["base"], a["model"])] = (n + 1, max(age, now - a["started"]))
+    return out
+
+
+def _dify_slot_gauge() -> Dict[Tuple[str, ...], float]:
+    out: Dict[Tuple[str, ...], float] = {}
+    with _dify_guard:
+        pools = list(_dify_pools.items())
+    orphans = _dify_orphan_counts()
+    for (base, mk), pool in pools:
+        with pool["cond"]:
+            out[(mk, base, "in_use")] = float(pool["in_use"])
+        out[(mk, base, "orphaned")] = float(orphans.get((base, mk), (0, 0.0))[0])
+    return out
+
+
+def _dify_orphan_age_gauge() -> Dict[Tuple[str, ...], float]:
+    return {(mk, base): age for (base, mk), (_, age) in _dify_orphan_counts().items()}
+
+
+metrics.gauge(
+    "chutgpt_dify_pool_slots",
+    "Dify pool slots in use; orphaned ones are held by cancelled attempts (hedge losers) still unwinding.",
+    ("model", "endpoint", "state"),
+    _dify_slot_gauge,
+)
+metrics.gauge(
+    "chutgpt_dify_orphan_oldest_seconds",
+    "Age of the oldest cancelled attempt still holding a Dify pool slot.",
+    ("model", "endpoint"),
+    _dify_orphan_age_gauge,
+)
+
+
+def dify_pool_stats() -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    with _dify_guard:
+        pools = list(_dify_pools.items())
+    orphans = _dify_orphan_counts()
+    for (base, mk), pool in pools:
+        opened = 0
+        try:
+            pm = pool["adapter"].poolmanager
+            for key in pm.pools.keys():
+                opened += getattr(pm.pools[key], "num_connections", 0)
+        except Exception:
+            pass
+        with pool["cond"]:
+            st = dict(pool["stats"])
+            in_use = pool["in_use"]
+        if not st["requests"] and not st["warmed"]:
+            continue
+        n = st.pop("ttfb_ms_total")
+        st["ttfb_ms_avg"] = round(n / st["requests"], 2) if st["requests"] else 0.0
+        st["wait_ms_total"] = round(st["wait_ms_total"], 2)
+        st["wait_ms_max"] = round(st["wait_ms_max"], 2)
+        st.update({"base": base, "size": pool["size"], "in_use": in_use, "orphaned": orphans.get((base, mk), (0, 0.0))[0], "connections_opened": opened})
+        out[mk if mk not in out else f"{mk}@{base}"] = st
+    return out
+
+
+def dify_endpoint_stats() -> Dict[str, Any]:
+    now = time.monotonic()
+    labels = [f"le_{b}" for b in DIFY_TTFB_BUCKETS_MS] + ["inf"]
+    models: Dict[str, List[Dict[str, Any]]] = {}
+    with _dify_guard:
+        items = [((b, mk), dict(ep, hist=list(ep["hist"]))) for (b, mk), ep in _dify_eps.items()]
+        pinned = len(_dify_affinity)
+    for (base, mk), ep in items:
+        if not ep["ok"] and not ep["errors"]:
+            continue
+        n = ep.pop("ttfb_n")
+        total = ep.pop("ttfb_ms_total")
+        hist = ep.pop("hist")
+        down_for = ep.pop("down_until") - now
+        ep.update({
+            "base": base,
+            "healthy": down_for <= 0,
+            "down_for_sec": round(max(0.0, down_for), 1),
+            "ttfb_ms_avg": round(total / n, 2) if n else 0.0,
+            "ttfb_ms_p50": _ttfb_quantile_ms(hist, 0.5),
+            "ttfb_ms_p95": _ttfb_quantile_ms(hist, 0.95),
+            "ttfb_hist": dict(zip(labels, hist)),
+        })
+        models.setdefault(mk, []).append(ep)
+    return {"models": models, "pinned_conversations": pinned}
+
+
+# Incremental text/event-stream parser working on raw bytes: chunks are
+# appended to one bytearray, events are cut at blank lines with find() and
+# only the data field is copied out (json.loads takes the bytes as they
+# are). Follows the HTML SSE rules: CR, LF and CRLF line ends, a leading
+# BOM, ":" comment lines, multi-line data joined with "\n", event/id/retry
+# fields, and no dispatch for a block without data.
+
+class SseParser:
+    __slots__ = ("_buf", "_cr", "_started", "last_event_id", "retry_ms")
+
+    def __init__(self) -> None:
+        self._buf = bytearray()
+        self._cr = False
+        self._started = False
+        self.last_event_id = ""
+        self.retry_ms: Optional[int] = None
+
+    def feed(self, chunk: bytes) -> List[Tuple[str, bytes]]:
+        # -> [(event name, data)] for every event completed by this chunk
+        if not self._started and chunk:
+            # a leading BOM may itself arrive split; hold the first bytes until it is decided
+            head = bytes(self._buf) + chunk
+            if len(head) < 3 and b"\xef\xbb\xbf".startswith(head):
+                self._buf += chunk
+                return []
+            self._started = True
+            self._buf.clear()
+            chunk = head[3:] if head.startswith(b"\xef\xbb\xbf") else head
+        if self._cr or b"\r" in chunk:
+            # rare in practice; a CR at the end may be the first half of a CRLF, so hold it
+            if self._cr:
+                chunk = b"\r" + chunk
+            self._cr = chunk.endswith(b"\r")
+            if self._cr:
+                chunk = chunk[:-1]
+            chunk = chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        buf = self._buf
+        buf += chunk
+        out: List[Tuple[str, bytes]] = []
+        start = 0
+        while True:
+            end = buf.find(b"\n\n", start)
+            if end < 0:
+                break
+            self._dispatch(buf, start, end, out)
+            start = end + 2
+        if start:
+            del buf[:start]
+        return out
+
+    def _dispatch(self, buf: bytearray, pos: int, end: int, out: List[Tuple[str, bytes]]) -> None:
+        if buf.startswith(b"data:", pos, end) and buf.find(b"\n", pos, end) < 0:
+            # the usual Dify block: a single data line
+            v = pos + 5
+            if v < end and buf[v] == 0x20:
+                v += 1
+            out.append(("message", bytes(buf[v:end])))
+            return
+        event = "message"
+        data: Optional[bytearray] = None
+        while pos < end:
+            nl = buf.find(b"\n", pos, end)
+            if nl < 0:
+                nl = end
+            if nl > pos and buf[pos] != 0x3A:
+                colon = buf.find(b":", pos, nl)
+                name_end = nl if colon < 0 else colon
+                v = nl if colon < 0 else colon + 1
+                if v < nl and buf[v] == 0x20:
+                    v += 1
+                n = name_end - pos
+                if n == 4 and buf.startswith(b"data", pos):
+                    if data is None:
+                        data = buf[v:nl]
+                    else:
+                        data += b"\n"
+                        data += buf[v:nl]
+                elif n == 5 and buf.startswith(b"event", pos):
+                    event = buf[v:nl].decode("utf-8", "replace") or "message"
+                elif n == 2 and buf.startswith(b"id", pos):
+                    if buf.find(b"\0", v, nl) < 0:
+                        self.last_event_id = buf[v:nl].decode("utf-8", "replace")
+                elif n == 5 and buf.startswith(b"retry", pos):
+                    if v < nl and buf[v:nl].isdigit():
+                        self.retry_ms = int(buf[v:nl])
+            pos = nl + 1
+        if data is not None:
+            out.append((event, bytes(data)))
+
+
+DIFY_SSE_READ_BYTES = 64 * 1024
+_json_decode = json.JSONDecoder().decode
+
+
+def _iter_sse_chunks(resp: requests.Response) -> Iterable[bytes]:
+    raw = resp.raw
+    if getattr(raw, "chunked", False):
+        # one item per HTTP chunk as soon as it arrives, whatever its size
+        yield from resp.iter_content(chunk_size=None)
+        return
+    read1 = getattr(raw, "read1", None)
+    if read1 is None:
+        yield from resp.iter_content(chunk_size=512)
+        return
+    while True:
+        b = read1(DIFY_SSE_READ_BYTES)
+        if not b:
+            return
+        yield b
+
+
+def dify_sse_events(parser: SseParser, chunk: bytes) -> Tuple[List[Dict[str, Any]], bool]:
+    # -> (decoded Dify events, True once "[DONE]" is seen)
+    out: List[Dict[str, Any]] = []
+    bad = ""
+    finished = False
+    n_bad = 0
+    for name, data in parser.feed(chunk):
+        if data == b"[DONE]":
+            finished = True
+            break
+        try:
+            ev = _json_decode(data.decode("utf-8"))
+        except ValueError:
+            ev = None
+        if not isinstance(ev, dict):
+            n_bad += 1
+            bad = data[:200].decode("utf-8", "replace")
+            continue
+        if name != "message" and "event" not in ev:
+            ev["event"] = name
+        out.append(ev)
+    if out or n_bad:
+        with _sse_guard:
+            _sse_stats["dify_events"] += len(out)
+            if n_bad:
+                _sse_stats["dify_bad_payloads"] += n_bad
+                _sse_stats["dify_last_bad"] = bad
+    return out, finished
+
+
+def iter_dify_sse(source: Any) -> Iterable[Dict[str, Any]]:
+    # source: a streamed requests.Response or an iterator of raw body chunks
+    parser = SseParser()
+    chunks = _iter_sse_chunks(source) if isinstance(source, requests.Response) else iter(source)
+    for chunk in chunks:
+        events, finished = dify_sse_events(parser, chunk)
+        yield from events
+        if finished:
+            return
+
+
+def dify_sse_stats() -> Dict[str, Any]:
+    with _sse_guard:
+        return dict(_sse_stats)
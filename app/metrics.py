@@ -0,0 +1,102 @@
+import bisect
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+# Minimal in-process registry for GET /metrics (Prometheus text format
+# 0.0.4). Histograms: a series is a list of bucket counts with the +Inf
+# overflow last and the running sum after it. observe() is one bisect and
+# two adds under the histogram's own lock, cheap enough for every CSV call
+# and path lock. Nothing here is per SSE delta. Gauges are callbacks that
+# read the owning module's state at scrape time, so they cost nothing
+# between scrapes.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+WAIT_BUCKETS = (0.00001, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 250, 500)
+
+_registry_guard = Lock()
+_registry: Dict[str, Dict[str, Any]] = {}
+
+
+def histogram(name: str, help_text: str, label_names: Iterable[str], buckets: Iterable[float]) -> Dict[str, Any]:
+    with _registry_guard:
+        h = _registry.get(name)
+        if h is None:
+            h = {
+                "name": name,
+                "help": help_text,
+                "labels": tuple(label_names),
+                "buckets": tuple(sorted(float(b) for b in buckets)),
+                "guard": Lock(),
+                "series": {},
+            }
+            _registry[name] = h
+        return h
+
+
+def gauge(name: str, help_text: str, label_names: Iterable[str], collect: Callable[[], Dict[Tuple[str, ...], float]]) -> None:
+    # collect() -> {label values: value}; counters that only grow are exposed the same way
+    with _registry_guard:
+        _registry[name] = {"name": name, "help": help_text, "labels": tuple(label_names), "collect": collect}
+
+
+def observe(h: Dict[str, Any], labels: Tuple[str, ...], value: float) -> None:
+    i = bisect.bisect_left(h["buckets"], value)
+    with h["guard"]:
+        s = h["series"].get(labels)
+        if s is None:
+            s = h["series"][labels] = [0] * (len(h["buckets"]) + 1) + [0.0]
+        s[i] += 1
+        s[-1] += value
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt(v: float) -> str:
+    return repr(float(v)) if v != int(v) else str(int(v))
+
+
+def _render_histogram(h: Dict[str, Any], out: List[str]) -> None:
+    with h["guard"]:
+        series = [(labels, list(s)) for labels, s in h["series"].items()]
+    name = h["name"]
+    out.append(f"# HELP {name} {h['help']}")
+    out.append(f"# TYPE {name} histogram")
+    les = [_fmt(b) for b in h["buckets"]] + ["+Inf"]
+    for labels, s in sorted(series):
+        pairs = ",".join(f'{k}="{_escape(str(v))}"' for k, v in zip(h["labels"], labels))
+        sep = "," if pairs else ""
+        seen = 0
+        for le, c in zip(les, s):
+            seen += c
+            out.append(f'{name}_bucket{{{pairs}{sep}le="{le}"}} {seen}')
+        lbl = f"{{{pairs}}}" if pairs else ""
+        out.append(f"{name}_sum{lbl} {repr(float(s[-1]))}")
+        out.append(f"{name}_count{lbl} {seen}")
+
+
+def _render_gauge(g: Dict[str, Any], out: List[str]) -> None:
+    try:
+        values = g["collect"]()
+    except Exception:
+        return
+    name = g["name"]
+    out.append(f"# HELP {name} {g['help']}")
+    out.append(f"# TYPE {name} gauge")
+    for labels, v in sorted(values.items()):
+        pairs = ",".join(f'{k}="{_escape(str(x))}"' for k, x in zip(g["labels"], labels))
+        out.append(f"{name}{{{pairs}}} {repr(float(v))}" if pairs else f"{name} {repr(float(v))}")
+
+
+def render_metrics() -> str:
+    with _registry_guard:
+        entries = sorted(_registry.values(), key=lambda h: h["name"])
+    out: List[str] = []
+    for h in entries:
+        if "collect" in h:
+            _render_gauge(h, out)
+        else:
+            _render_histogram(h, out)
+    return "\n".join(out) + "\n"
\ No newline at end of file
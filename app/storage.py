@@ -0,0 +1,483 @@
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from config import AppConfig
+
+from . import core
+
+
+class Storage(ABC):
+    name = ""
+
+    def __init__(self, cfg: AppConfig) -> None:
+        self.cfg = cfg
+
+    # users
+    @abstractmethod
+    def user_exists(self, user_id: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_user(self, user_id: str) -> Optional[Dict[str, str]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_user(self, u: Dict[str, str]) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_user(self, user_id: str, password: str) -> None:
+        raise NotImplementedError
+
+    # history
+    @abstractmethod
+    def append_history(self, user_id: str, role: str, model_key: str, thread_id: str, dify_cid: str, content: str) -> str:
+        raise NotImplementedError
+
+    @abstractmethod
+    def append_history_rows(self, user_id: str, rows: List[Dict[str, str]], fsync: bool = False) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_history(self, user_id: str, thread_id: str, limit: int, before: Optional[str] = None) -> List[Dict[str, str]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_history_all(self, user_id: str, thread_id: str) -> List[Dict[str, str]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_history(self, user_id: str, thread_id: str) -> Iterable[Dict[str, str]]:
+        raise NotImplementedError
+
+    # threads / dify conversation map
+    @abstractmethod
+    def upsert_thread(self, user_id: str, thread_id: str, preview: str, updated_at: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_threads(self, user_id: str, limit: int) -> List[Dict[str, str]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def rename_thread(self, user_id: str, thread_id: str, name: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_thread(self, user_id: str, thread_id: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_dify_cid(self, user_id: str, thread_id: str, model_key: str) -> str:
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_dify_cid(self, user_id: str, thread_id: str, model_key: str, dify_cid: str, updated_at: str) -> None:
+        raise NotImplementedError
+
+    # feedback state
+    @abstractmethod
+    def upsert_feedback_state(self, *, dir_path: str, **row: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_feedback_state(self, *, user_id: str, model_key: str, thread_id: str, bot_ts: str) -> Optional[Dict[str, str]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_feedback_state_for_user_thread(self, *, user_id: str, thread_id: str, model_key: Optional[str]) -> List[Dict[str, str]]:
+        raise NotImplementedError
+
+
+class CsvStorage(Storage):
+    name = "csv"
+
+    def user_exists(self, user_id: str) -> bool:
+        return core._csv_user_exists(self.cfg, user_id)
+
+    def load_user(self, user_id: str) -> Optional[Dict[str, str]]:
+        return core._csv_load_user(self.cfg, user_id)
+
+    def save_user(self, u: Dict[str, str]) -> None:
+        core._csv_save_user(self.cfg, u)
+
+    def create_user(self, user_id: str, password: str) -> None:
+        core._csv_create_user_files(self.cfg, user_id, password)
+
+    def append_history(self, user_id: str, role: str, model_key: str, thread_id: str, dify_cid: str, content: str) -> str:
+        return core._csv_append_history(self.cfg, user_id, role, model_key, thread_id, dify_cid, content)
+
+    def append_history_rows(self, user_id: str, rows: List[Dict[str, str]], fsync: bool = False) -> None:
+        core._csv_append_history_rows(self.cfg, user_id, rows, fsync=fsync)
+
+    def read_history(self, user_id: str, thread_id: str, limit: int, before: Optional[str] = None) -> List[Dict[str, str]]:
+        return core._csv_read_history(self.cfg, user_id, thread_id, limit=limit, before=before)
+
+    def read_history_all(self, user_id: str, thread_id: str) -> List[Dict[str, str]]:
+        return core._csv_read_history_all(self.cfg, user_id, thread_id)
+
+    def iter_history(self, user_id: str, thread_id: str) -> Iterable[Dict[str, str]]:
+        return core._csv_iter_history(self.cfg, user_id, thread_id)
+
+    def upsert_thread(self, user_id: str, thread_id: str, preview: str, updated_at: str) -> None:
+        core._csv_upsert_thread(self.cfg, user_id, thread_id, preview, updated_at)
+
+    def list_threads(self, user_id: str, limit: int) -> List[Dict[str, str]]:
+        return core._csv_list_threads(self.cfg, user_id, limit=limit)
+
+    def rename_thread(self, user_id: str, thread_id: str, name: str) -> bool:
+        return core._csv_rename_thread(self.cfg, user_id, thread_id, name)
+
+    def delete_thread(self, user_id: str, thread_id: str) -> bool:
+        return core._csv_delete_thread(self.cfg, user_id, thread_id)
+
+    def get_dify_cid(self, user_id: str, thread_id: str, model_key: str) -> str:
+        return core._csv_get_dify_cid(self.cfg, user_id, thread_id, model_key)
+
+    def set_dify_cid(self, user_id: str, thread_id: str, model_key: str, dify_cid: str, updated_at: str) -> None:
+        core._csv_set_dify_cid(self.cfg, user_id, thread_id, model_key, dify_cid, updated_at)
+
+    def upsert_feedback_state(self, *, dir_path: str, **row: str) -> None:
+        core.upsert_feedback_state_to_dir(dir_path=dir_path, **row)
+
+    def get_feedback_state(self, *, user_id: str, model_key: str, thread_id: str, bot_ts: str) -> Optional[Dict[str, str]]:
+        return core._csv_get_feedback_state(self.cfg, user_id=user_id, model_key=model_key, thread_id=thread_id, bot_ts=bot_ts)
+
+    def list_feedback_state_for_user_thread(self, *, user_id: str, thread_id: str, model_key: Optional[str]) -> List[Dict[str, str]]:
+        return core._csv_list_feedback_state_for_user_thread(self.cfg, user_id=user_id, thread_id=thread_id, model_key=model_key)
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id    TEXT PRIMARY KEY,
+    password   TEXT NOT NULL DEFAULT '',
+    model_key  TEXT NOT NULL DEFAULT '',
+    created_at TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS history (
+    id                   INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id              TEXT NOT NULL,
+    thread_id            TEXT NOT NULL,
+    timestamp            TEXT NOT NULL,
+    role                 TEXT NOT NULL,
+    model_key            TEXT NOT NULL,
+    dify_conversation_id TEXT NOT NULL DEFAULT '',
+    content              TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS history_by_thread ON history(user_id, thread_id, id);
+CREATE INDEX IF NOT EXISTS history_by_time ON history(user_id, timestamp);
+CREATE TABLE IF NOT EXISTS threads (
+    user_id    TEXT NOT NULL,
+    thread_id  TEXT NOT NULL,
+    name       TEXT NOT NULL DEFAULT '',
+    preview    TEXT NOT NULL DEFAULT '',
+    created_at TEXT NOT NULL DEFAULT '',
+    updated_at TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (user_id, thread_id)
+);
+CREATE INDEX IF NOT EXISTS threads_by_updated ON threads(user_id, updated_at);
+CREATE TABLE IF NOT EXISTS thread_map (
+    user_id              TEXT NOT NULL,
+    thread_id            TEXT NOT NULL,
+    model_key            TEXT NOT NULL,
+    dify_conversation_id TEXT NOT NULL DEFAULT '',
+    updated_at           TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (user_id, thread_id, model_key)
+);
+"""
+
+
+class SqliteStorage(Storage):
+    # Users, history, threads and the Dify map live in one local WAL-mode
+    # database. Feedback stays in the feedback_state shards and Markdown
+    # files of the feedback dirs (the NAS copy feeds the RAG ingest) and is
+    # read through the same in-memory shard index as the CSV backend: other
+    # hosts, spool merges and tools/ write those shards, so a copy in SQLite
+    # would go stale.
+    # Users that only exist as CSV are imported on first access.
+
+    name = "sqlite"
+
+    def __init__(self, cfg: AppConfig) -> None:
+        super().__init__(cfg)
+        self.path = cfg.sqlite_path
+        self._local = threading.local()
+        self._import_guard = threading.Lock()
+        self._prune_guard = threading.Lock()
+        self._pruned_on: Dict[str, str] = {}
+        core.ensure_dir(os.path.dirname(self.path))
+        self._conn().executescript(_SQLITE_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=OFF")
+            self._local.conn = conn
+        return conn
+
+    def _tx(self):
+        return _Transaction(self._conn())
+
+    # users
+
+    def _import_user_from_csv(self, user_id: str) -> bool:
+        if not core._csv_user_exists(self.cfg, user_id):
+            return False
+        with self._import_guard:
+            conn = self._conn()
+            if conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone():
+                return True
+            u = core._csv_load_user(self.cfg, user_id)
+            if not u:
+                return False
+            hist = list(core._csv_iter_history_rows(self.cfg, user_id))
+            threads = core._load_threads(self.cfg, user_id)
+            cmap = core._load_map(self.cfg, user_id)
+            with self._tx() as c:
+                c.execute(
+                    "INSERT INTO users(user_id, password, model_key, created_at) VALUES (?, ?, ?, ?)",
+                    (u["user_id"], u["password"], u["model_key"], u["created_at"]),
+                )
+                c.executemany(
+                    "INSERT INTO history(user_id, thread_id, timestamp, role, model_key, dify_conversation_id, content) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(
+                        user_id,
+                        (r.get("thread_id") or "").strip(),
+                        r.get("timestamp") or "",
+                        r.get("role") or "",
+                        r.get("model_key") or core.DEFAULT_MODEL_KEY,
+                        r.get("dify_conversation_id") or "",
+                        r.get("content") or "",
+                    ) for r in hist if (r.get("thread_id") or "").strip()],
+                )
+                c.executemany(
+                    "INSERT OR REPLACE INTO threads(user_id, thread_id, name, preview, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(user_id, r["thread_id"], r["name"], r["preview"], r["created_at"], r["updated_at"]) for r in threads],
+                )
+                c.executemany(
+                    "INSERT OR REPLACE INTO thread_map(user_id, thread_id, model_key, dify_conversation_id, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    [(user_id, r["thread_id"], r["model_key"], r["dify_conversation_id"], r["updated_at"]) for r in cmap],
+                )
+            return True
+
+    def user_exists(self, user_id: str) -> bool:
+        if self._conn().execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone():
+            return True
+        return self._import_user_from_csv(user_id)
+
+    def load_user(self, user_id: str) -> Optional[Dict[str, str]]:
+        row = self._conn().execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            if not self._import_user_from_csv(user_id):
+                return None
+            row = self._conn().execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                return None
+
+        mk = (row["model_key"] or core.DEFAULT_MODEL_KEY).strip() or core.DEFAULT_MODEL_KEY
+        if mk not in core.MODELS:
+            mk = core.DEFAULT_MODEL_KEY
+
+        return {
+            "user_id": row["user_id"],
+            "password": row["password"] or "",
+            "model_key": mk,
+            "created_at": row["created_at"] or datetime.now().isoformat(timespec="seconds"),
+        }
+
+    def save_user(self, u: Dict[str, str]) -> None:
+        self._conn().execute(
+            "INSERT INTO users(user_id, password, model_key, created_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET password = excluded.password, model_key = excluded.model_key, created_at = excluded.created_at",
+            (u["user_id"], u.get("password", ""), u.get("model_key", core.DEFAULT_MODEL_KEY), u.get("created_at", "")),
+        )
+
+    def create_user(self, user_id: str, password: str) -> None:
+        self.save_user({
+            "user_id": user_id,
+            "password": password,
+            "model_key": core.DEFAULT_MODEL_KEY,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+        })
+
+    # history
+
+    def _prune_history_14days(self, user_id: str) -> None:
+        # once per user and day; the day is claimed first so concurrent appends don't all run the DELETE
+        today = datetime.now().strftime("%Y-%m-%d")
+        with self._prune_guard:
+            if self._pruned_on.get(user_id) == today:
+                return
+            self._pruned_on[user_id] = today
+        cutoff = (datetime.now() - timedelta(days=14)).isoformat(timespec="seconds")
+        try:
+            self._conn().execute("DELETE FROM history WHERE user_id = ? AND timestamp < ?", (user_id, cutoff))
+        except sqlite3.Error:
+            with self._prune_guard:
+                if self._pruned_on.get(user_id) == today:
+                    del self._pruned_on[user_id]
+            raise
+
+    def append_history(self, user_id: str, role: str, model_key: str, thread_id: str, dify_cid: str, content: str) -> str:
+        ts = datetime.now().isoformat(timespec="seconds")
+        self._conn().execute(
+            "INSERT INTO history(user_id, thread_id, timestamp, role, model_key, dify_conversation_id, content) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, thread_id, ts, role, model_key, dify_cid or "", content),
+        )
+        self._prune_history_14days(user_id)
+        return ts
+
+    def append_history_rows(self, user_id: str, rows: List[Dict[str, str]], fsync: bool = False) -> None:
+        # WAL commits are already durable per transaction; fsync has no extra meaning here
+        with self._tx() as c:
+            c.executemany(
+                "INSERT INTO history(user_id, thread_id, timestamp, role, model_key, dify_conversation_id, content) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(
+                    user_id,
+                    r.get("thread_id") or "",
+                    r.get("timestamp") or "",
+                    r.get("role") or "",
+                    r.get("model_key") or core.DEFAULT_MODEL_KEY,
+                    r.get("dify_conversation_id") or "",
+                    r.get("content") or "",
+                ) for r in rows],
+            )
+        try:
+            self._prune_history_14days(user_id)
+        except sqlite3.Error:
+            # committed already; failing here would make the write-behind insert the rows again
+            pass
+
+    @staticmethod
+    def _history_items(rows: List[sqlite3.Row]) -> List[Dict[str, str]]:
+        return [{
+            "timestamp": r["timestamp"] or "",
+            "role": r["role"] or "",
+            "model_key": r["model_key"] or core.DEFAULT_MODEL_KEY,
+            "thread_id": r["thread_id"],
+            "content": r["content"] or "",
+        } for r in rows]
+
+    def read_history(self, user_id: str, thread_id: str, limit: int, before: Optional[str] = None) -> List[Dict[str, str]]:
+        cur = self._conn().execute(
+            "SELECT * FROM history WHERE user_id = ? AND thread_id = ? AND timestamp < ? ORDER BY id DESC",
+            (user_id, thread_id, before or "\uffff"),
+        )
+        try:
+            rows = core.history_tail(cur, max(0, int(limit)))
+        finally:
+            cur.close()
+        return self._history_items(rows)
+
+    def read_history_all(self, user_id: str, thread_id: str) -> List[Dict[str, str]]:
+        rows = self._conn().execute(
+            "SELECT * FROM history WHERE user_id = ? AND thread_id = ? ORDER BY id",
+            (user_id, thread_id),
+        ).fetchall()
+        return self._history_items(rows)
+
+    def iter_history(self, user_id: str, thread_id: str) -> Iterable[Dict[str, str]]:
+        cur = self._conn().execute(
+            "SELECT * FROM history WHERE user_id = ? AND thread_id = ? ORDER BY id",
+            (user_id, thread_id),
+        )
+        try:
+            while True:
+                rows = cur.fetchmany(500)
+                if not rows:
+                    break
+                yield from self._history_items(rows)
+        finally:
+            cur.close()
+
+    # threads / dify conversation map
+
+    def upsert_thread(self, user_id: str, thread_id: str, preview: str, updated_at: str) -> None:
+        self._conn().execute(
+            "INSERT INTO threads(user_id, thread_id, name, preview, created_at, updated_at) VALUES (?, ?, '', ?, ?, ?) "
+            "ON CONFLICT(user_id, thread_id) DO UPDATE SET "
+            "preview = CASE WHEN excluded.preview != '' AND trim(threads.preview) = '' THEN excluded.preview ELSE threads.preview END, "
+            "updated_at = excluded.updated_at",
+            (user_id, thread_id, preview or "", updated_at, updated_at),
+        )
+
+    def list_threads(self, user_id: str, limit: int) -> List[Dict[str, str]]:
+        rows = self._conn().execute(
+            "SELECT thread_id, name, preview, created_at, updated_at FROM threads WHERE user_id = ? ORDER BY updated_at DESC LIMIT ?",
+            (user_id, max(0, int(limit))),
+        ).fetchall()
+        return [{k: (r[k] or "") for k in core.THREAD_FIELDS} for r in rows]
+
+    def rename_thread(self, user_id: str, thread_id: str, name: str) -> bool:
+        name = (name or "").strip()
+        if not thread_id or not name:
+            return False
+        cur = self._conn().execute(
+            "UPDATE threads SET name = ?, preview = ?, updated_at = ? WHERE user_id = ? AND thread_id = ?",
+            (name, name[:20], datetime.now().isoformat(timespec="seconds"), user_id, thread_id),
+        )
+        return cur.rowcount > 0
+
+    def delete_thread(self, user_id: str, thread_id: str) -> bool:
+        if not thread_id:
+            return False
+        with self._tx() as c:
+            cur = c.execute("DELETE FROM threads WHERE user_id = ? AND thread_id = ?", (user_id, thread_id))
+            if cur.rowcount == 0:
+                return False
+            c.execute("DELETE FROM history WHERE user_id = ? AND thread_id = ?", (user_id, thread_id))
+            c.execute("DELETE FROM thread_map WHERE user_id = ? AND thread_id = ?", (user_id, thread_id))
+        return True
+
+    def get_dify_cid(self, user_id: str, thread_id: str, model_key: str) -> str:
+        row = self._conn().execute(
+            "SELECT dify_conversation_id FROM thread_map WHERE user_id = ? AND thread_id = ? AND model_key = ?",
+            (user_id, thread_id, model_key),
+        ).fetchone()
+        return (row["dify_conversation_id"] or "") if row else ""
+
+    def set_dify_cid(self, user_id: str, thread_id: str, model_key: str, dify_cid: str, updated_at: str) -> None:
+        self._conn().execute(
+            "INSERT INTO thread_map(user_id, thread_id, model_key, dify_conversation_id, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(user_id, thread_id, model_key) DO UPDATE SET "
+            "dify_conversation_id = excluded.dify_conversation_id, updated_at = excluded.updated_at",
+            (user_id, thread_id, model_key, dify_cid or "", updated_at),
+        )
+
+    # feedback state
+
+    def upsert_feedback_state(self, *, dir_path: str, **row: str) -> None:
+        core.upsert_feedback_state_to_dir(dir_path=dir_path, **row)
+
+    def get_feedback_state(self, *, user_id: str, model_key: str, thread_id: str, bot_ts: str) -> Optional[Dict[str, str]]:
+        return core._csv_get_feedback_state(self.cfg, user_id=user_id, model_key=model_key, thread_id=thread_id, bot_ts=bot_ts)
+
+    def list_feedback_state_for_user_thread(self, *, user_id: str, thread_id: str, model_key: Optional[str]) -> List[Dict[str, str]]:
+        return core._csv_list_feedback_state_for_user_thread(self.cfg, user_id=user_id, thread_id=thread_id, model_key=model_key)
+
+
+class _Transaction:
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        return False
+
+
+def create_storage(cfg: AppConfig) -> Storage:
+    if cfg.storage_backend == "sqlite":
+        return SqliteStorage(cfg)
+    return CsvStorage(cfg)
@@ -0,0 +1,16 @@
+import os
+
+from dotenv import load_dotenv
+
+from app.asgi import create_asgi_app
+
+load_dotenv()
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+app = create_asgi_app(BASE_DIR)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=5201)
\ No newline at end of file
@@ -25,12 +25,41 @@ class AppConfig:
 
     # Flask
     secret_key: str
+    admin_user_ids: str
+    metrics_token: str
+    asgi_wsgi_workers: int
 
     # Dify
     dify_api_base: str
+    dify_api_bases: str
     default_dify_api_key: str
+    dify_pool_size: int
+    dify_pool_warm: int
+    dify_connect_timeout_sec: int
+    dify_read_timeout_sec: int
+    dify_connect_retries: int
+    dify_endpoint_fail_threshold: int
+    dify_endpoint_cooldown_sec: int
+    dify_hedge: int
+    dify_hedge_min_ms: int
+    dify_hedge_default_ms: int
+    dify_hedge_min_samples: int
+    dify_max_inflight: int
+    dify_queue_max: int
+    dify_queue_timeout_sec: int
+    sse_coalesce_ms: int
+    sse_coalesce_bytes: int
+    sse_first_flush_bytes: int
+    sse_done_mode: str
+    answer_cache_models: str
+    answer_cache_ttl_sec: int
+    answer_cache_max_entries: int
+    chat_stream_buffer_frames: int
+    chat_stream_retain_sec: int
 
     # Storage
+    storage_backend: str
+    sqlite_path: str
     users_dir: str
     notice_path: str
 
@@ -42,7 +71,17 @@ class AppConfig:
 
     # Performance
     nas_check_ttl_sec: int
+    nas_backoff_max_sec: int
+    nas_sync_interval_sec: int
     md_rebuild_cooldown_sec: int
+    md_rebuild_workers: int
+    feedback_rebuild_workers: int
+    csv_cache_max_mb: int
+    journal_compact_rows: int
+    history_write_mode: str
+    history_batch_ms: int
+    post_turn_workers: int
+    post_turn_wait_sec: int
 
     def validate(self) -> list[str]:
         errors: list[str] = []
@@ -51,6 +90,12 @@ class AppConfig:
         if not self.dify_api_base:
             errors.append("DIFY_API_BASE is empty")
         # default key can be empty if all per-model keys are set
+        if self.storage_backend not in ("csv", "sqlite"):
+            errors.append(f"STORAGE_BACKEND must be csv or sqlite (got {self.storage_backend!r})")
+        if self.history_write_mode not in ("immediate", "batched", "fsync"):
+            errors.append(f"HISTORY_WRITE_MODE must be immediate, batched or fsync (got {self.history_write_mode!r})")
+        if self.sse_done_mode not in ("full", "digest"):
+            errors.append(f"SSE_DONE_MODE must be full or digest (got {self.sse_done_mode!r})")
         return errors
 
 
@@ -62,11 +107,46 @@ def load_config(base_dir: str) -> AppConfig:
 
     feedback_dir_local = os.path.join(base_dir, "_spool", "good_and_bad")
 
+    sqlite_path = _getenv("DB_PATH", "chat.db").strip() or "chat.db"
+    if not os.path.isabs(sqlite_path):
+        sqlite_path = os.path.join(base_dir, sqlite_path)
+
     return AppConfig(
         base_dir=base_dir,
         secret_key=_getenv("FLASK_SECRET_KEY", "dev-secret-change-me"),
+        admin_user_ids=_getenv("ADMIN_USER_IDS", ""),
+        # lets a scraper read /metrics with "Authorization: Bearer <token>"
+        metrics_token=_getenv("METRICS_TOKEN", "").strip(),
+        asgi_wsgi_workers=_getenv_int("ASGI_WSGI_WORKERS", 32),
         dify_api_base=_getenv("DIFY_API_BASE", "http://161.93.108.55:8890/v1").rstrip("/"),
+        # comma-separated, in order of preference; DIFY_API_BASES_<MODEL> overrides per model
+        dify_api_bases=_getenv("DIFY_API_BASES", "").strip(),
         default_dify_api_key=_getenv("DIFY_API_KEY", "").strip(),
+        dify_pool_size=_getenv_int("DIFY_POOL_SIZE", 8),
+        dify_pool_warm=_getenv_int("DIFY_POOL_WARM", 1),
+        dify_connect_timeout_sec=_getenv_int("DIFY_CONNECT_TIMEOUT_SEC", 5),
+        dify_read_timeout_sec=_getenv_int("DIFY_READ_TIMEOUT_SEC", 180),
+        dify_connect_retries=_getenv_int("DIFY_CONNECT_RETRIES", 2),
+        dify_endpoint_fail_threshold=_getenv_int("DIFY_ENDPOINT_FAIL_THRESHOLD", 3),
+        dify_endpoint_cooldown_sec=_getenv_int("DIFY_ENDPOINT_COOLDOWN_SEC", 30),
+        dify_hedge=_getenv_int("DIFY_HEDGE", 0),
+        dify_hedge_min_ms=_getenv_int("DIFY_HEDGE_MIN_MS", 300),
+        dify_hedge_default_ms=_getenv_int("DIFY_HEDGE_DEFAULT_MS", 3000),
+        dify_hedge_min_samples=_getenv_int("DIFY_HEDGE_MIN_SAMPLES", 20),
+        dify_max_inflight=_getenv_int("DIFY_MAX_INFLIGHT", 6),
+        dify_queue_max=_getenv_int("DIFY_QUEUE_MAX", 20),
+        dify_queue_timeout_sec=_getenv_int("DIFY_QUEUE_TIMEOUT_SEC", 90),
+        sse_coalesce_ms=_getenv_int("SSE_COALESCE_MS", 40),
+        sse_coalesce_bytes=_getenv_int("SSE_COALESCE_BYTES", 256),
+        sse_first_flush_bytes=_getenv_int("SSE_FIRST_FLUSH_BYTES", 1),
+        sse_done_mode=_getenv("SSE_DONE_MODE", "full").strip().lower() or "full",
+        answer_cache_models=_getenv("ANSWER_CACHE_MODELS", ""),
+        answer_cache_ttl_sec=_getenv_int("ANSWER_CACHE_TTL_SEC", 86400),
+        answer_cache_max_entries=_getenv_int("ANSWER_CACHE_MAX_ENTRIES", 500),
+        chat_stream_buffer_frames=_getenv_int("CHAT_STREAM_BUFFER_FRAMES", 1024),
+        chat_stream_retain_sec=_getenv_int("CHAT_STREAM_RETAIN_SEC", 120),
+        storage_backend=_getenv("STORAGE_BACKEND", "csv").strip().lower() or "csv",
+        sqlite_path=sqlite_path,
         users_dir=users_dir,
         notice_path=notice_path,
         feedback_dir_nas=_getenv("FEEDBACK_DIR_NAS", r"\\172.27.23.54\disk1\Chuppy\good_and_bad"),
@@ -74,5 +154,15 @@ def load_config(base_dir: str) -> AppConfig:
         backup_dir=_getenv("BACKUP_DIR", os.path.join(base_dir, "_backup")),
         backup_keep_days=_getenv_int("BACKUP_KEEP_DAYS", 30),
         nas_check_ttl_sec=_getenv_int("NAS_CHECK_TTL_SEC", 5),
+        nas_backoff_max_sec=_getenv_int("NAS_BACKOFF_MAX_SEC", 120),
+        nas_sync_interval_sec=_getenv_int("NAS_SYNC_INTERVAL_SEC", 30),
         md_rebuild_cooldown_sec=_getenv_int("MD_REBUILD_COOLDOWN_SEC", 10),
+        md_rebuild_workers=_getenv_int("MD_REBUILD_WORKERS", 2),
+        feedback_rebuild_workers=_getenv_int("FEEDBACK_REBUILD_WORKERS", 4),
+        csv_cache_max_mb=_getenv_int("CSV_CACHE_MAX_MB", 64),
+        journal_compact_rows=_getenv_int("JOURNAL_COMPACT_ROWS", 200),
+        history_write_mode=_getenv("HISTORY_WRITE_MODE", "immediate").strip().lower() or "immediate",
+        history_batch_ms=_getenv_int("HISTORY_BATCH_MS", 50),
+        post_turn_workers=_getenv_int("POST_TURN_WORKERS", 4),
+        post_turn_wait_sec=_getenv_int("POST_TURN_WAIT_SEC", 10),
     )
\ No newline at end of file
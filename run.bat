@@ -2,6 +2,7 @@
 cd /d C:\Users\PJ\python\venv\chut_gpt
 echo add venv...
 call .\Scripts\activate.bat
-echo Flask start...
-python app.py
+echo uvicorn start...
+rem asgi:app serves /api/chat/stream on the event loop; "python app.py" is the threaded fallback
+uvicorn asgi:app --host 0.0.0.0 --port 5201
 pause
\ No newline at end of file
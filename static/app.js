@@ -143,6 +143,7 @@
     chat.addEventListener("scroll", () => {
         const nearBottom = (chat.scrollHeight - (chat.scrollTop + chat.clientHeight)) < 40;
         stickToBottom = nearBottom;
+        if (chat.scrollTop < 80) loadOlderHistory();
     });
 
     let currentModelPill = document.getElementById("currentModelPill");
@@ -447,7 +448,7 @@
         bubble.appendChild(bar);
     }
 
-    function addMsg({ role, text, modelKey, timeISO, showModelTag, showTime, feedback }) {
+    function addMsg({ role, text, modelKey, timeISO, showModelTag, showTime, feedback, insertBefore }) {
         const row = document.createElement("div");
         row.className = `msg ${role}`;
 
@@ -487,8 +488,12 @@
         }
 
         row.appendChild(bubble);
-        chat.appendChild(row);
-        scrollToBottom(true);
+        if (insertBefore) {
+            chat.insertBefore(row, insertBefore);
+        } else {
+            chat.appendChild(row);
+            scrollToBottom(true);
+        }
         return { body, bubble, row, tsEl: ts };
     }
 
@@ -549,30 +554,36 @@
         }
     }
 
-    async function loadHistory() {
-        if (!activeThreadId) {
-            renderEmptyChat();
-            return;
-        }
-
-        const feedbackMap = await loadFeedbackStateMap({ threadId: activeThreadId, modelKey: currentModel });
+    // older messages are fetched page by page when the chat is scrolled to the top
+    const HISTORY_PAGE_SIZE = 50;
+    let historyCursor = null;
+    let historyLoadingOlder = false;
+    let historyFeedbackMap = new Map();
+    // bot rows above the first question of the oldest page so far; their question is on the next older page
+    let historyUnpaired = [];
 
+    async function fetchHistoryPage(threadId, before) {
         const url = new URL("/api/history", location.origin);
-        url.searchParams.set("thread_id", activeThreadId);
+        url.searchParams.set("thread_id", threadId);
+        url.searchParams.set("limit", String(HISTORY_PAGE_SIZE));
+        if (before) url.searchParams.set("before", before);
 
         const res = await apiFetch(url.toString());
         const data = await res.json().catch(() => ({}));
         if (!res.ok) throw new Error(data.error || "history error");
+        return data;
+    }
 
-        const items = data.items || [];
-        chat.innerHTML = "";
-
+    function renderHistoryItems(items, feedbackMap, insertBefore) {
         let lastUserText = "";
+        let seenUser = false;
+        const unpaired = [];
 
         for (const m of items) {
             const role = m.role === "user" ? "user" : "bot";
             if (role === "user") {
                 lastUserText = m.content || "";
+                seenUser = true;
                 addMsg({
                     role,
                     text: m.content,
@@ -580,7 +591,8 @@
                     timeISO: m.created_at,
                     showModelTag: false,
                     showTime: false,
-                    feedback: null
+                    feedback: null,
+                    insertBefore
                 });
                 continue;
             }
@@ -589,29 +601,86 @@
             const qText = lastUserText || "";
             const botTs = m.created_at || "";
             const initialKind = feedbackMap.get(botTs) || "none";
+            const feedback = {
+                threadId: m.thread_id,
+                modelKey: m.model_key || currentModel,
+                question: qText,
+                answer: botText,
+                botTs: botTs,
+                initialKind: initialKind
+            };
 
-            addMsg({
+            const { bubble } = addMsg({
                 role: "bot",
                 text: botText,
                 modelKey: m.model_key,
                 timeISO: botTs,
                 showModelTag: true,
                 showTime: true,
-                feedback: {
-                    threadId: m.thread_id,
-                    modelKey: m.model_key,
-                    question: qText,
-                    answer: botText,
-                    botTs: botTs,
-                    initialKind: initialKind
-                }
+                feedback,
+                insertBefore
             });
+            if (!seenUser) unpaired.push({ bubble, feedback });
+        }
+
+        // this page ends with the question the rows at the top of the newer page answered
+        if (!seenUser) {
+            historyUnpaired = historyUnpaired.concat(unpaired);
+            return;
+        }
+        for (const u of historyUnpaired) {
+            if (!lastUserText || !u.feedback.threadId || !u.feedback.answer || !u.feedback.botTs) continue;
+            attachFeedbackUI({ bubble: u.bubble, ...u.feedback, question: lastUserText });
         }
+        historyUnpaired = unpaired;
+    }
+
+    async function loadHistory() {
+        historyCursor = null;
+        if (!activeThreadId) {
+            renderEmptyChat();
+            return;
+        }
+
+        const threadId = activeThreadId;
+        historyFeedbackMap = await loadFeedbackStateMap({ threadId, modelKey: currentModel });
+        const data = await fetchHistoryPage(threadId, null);
+        if (threadId !== activeThreadId) return;
+
+        const items = data.items || [];
+        historyCursor = data.has_more ? data.next_before : null;
+        chat.innerHTML = "";
+        historyUnpaired = [];
+
+        renderHistoryItems(items, historyFeedbackMap, null);
 
         if (items.length === 0) renderEmptyChat();
         scrollToBottom(true);
     }
 
+    async function loadOlderHistory() {
+        if (!historyCursor || historyLoadingOlder || !activeThreadId) return;
+        historyLoadingOlder = true;
+        const threadId = activeThreadId;
+        try {
+            const data = await fetchHistoryPage(threadId, historyCursor);
+            if (threadId !== activeThreadId) return;
+
+            const items = data.items || [];
+            historyCursor = data.has_more ? data.next_before : null;
+            if (items.length === 0) return;
+
+            // keep the visible messages where they are while rows are added above them
+            const prevHeight = chat.scrollHeight;
+            renderHistoryItems(items, historyFeedbackMap, chat.firstChild);
+            chat.scrollTop += chat.scrollHeight - prevHeight;
+        } catch (e) {
+            showToast("過去の履歴の取得に失敗しました");
+        } finally {
+            historyLoadingOlder = false;
+        }
+    }
+
     function flashThread(threadId) {
         const el = convList.querySelector(`.conv-item[data-thread-id="${CSS.escape(threadId)}"]`);
         if (!el) return;
@@ -847,6 +916,14 @@
 
     cancelBtn.addEventListener("click", () => {
         if (currentAbortController) {
+            // 生成はサーバ側で続くので、止める指示も送る
+            if (activeThreadId) {
+                fetch("/api/chat/cancel", {
+                    method: "POST",
+                    headers: { "Content-Type": "application/json" },
+                    body: JSON.stringify({ thread_id: activeThreadId })
+                }).catch(() => { });
+            }
             currentAbortController.abort();
             showToast("取消しました");
         }
@@ -866,6 +943,7 @@
     function parseSseBlock(block) {
         const lines = block.split(/\r?\n/);
         const evLine = lines.find(l => l.startsWith("event:"));
+        const idLine = lines.find(l => l.startsWith("id:"));
         const dataLines = lines.filter(l => l.startsWith("data:"));
         if (dataLines.length === 0) return null;
 
@@ -874,7 +952,7 @@
 
         let ev;
         try { ev = JSON.parse(dataStr); } catch { return null; }
-        return { eventName, ev };
+        return { eventName, ev, id: idLine ? idLine.slice(3).trim() : "" };
     }
 
     function addThinkingGifOnlyRow() {
@@ -909,6 +987,22 @@
         return row;
     }
 
+    // meta(status=queued) の間だけ順番待ちの位置と目安時間を出す
+    function setQueueNote(row, ev) {
+        let note = row.querySelector(".queue-note");
+        if (ev.status !== "queued") {
+            if (note) note.remove();
+            return;
+        }
+        if (!note) {
+            note = document.createElement("div");
+            note.className = "queue-note";
+            row.appendChild(note);
+        }
+        const eta = (typeof ev.eta_sec === "number") ? `（目安 約${Math.max(1, Math.ceil(ev.eta_sec))}秒）` : "";
+        note.textContent = `順番待ち ${ev.position}番目${eta}`;
+    }
+
     // --------- P1-4: done後にloadHistoryしないための状態 ---------
     let streamingBot = null; // { row, bubble, body, tsEl, question, modelKey, threadId, answerAcc }
 
@@ -959,192 +1053,235 @@
         streamingBot = null;
     }
 
-    async function streamChat(message) {
-        if (!activeThreadId) setActiveThread(newThreadId());
-        stickToBottom = true;
+    // done may carry bytes/sha256 instead of the full answer (SSE_DONE_MODE=digest)
+    async function answerMatchesDigest(text, ev) {
+        if (typeof ev.bytes !== "number") return true;
+        const bytes = new TextEncoder().encode(text);
+        if (bytes.length !== ev.bytes) return false;
+        if (!ev.sha256 || !window.crypto?.subtle) return true;
+        const digest = await crypto.subtle.digest("SHA-256", bytes);
+        const hex = Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, "0")).join("");
+        return hex === ev.sha256;
+    }
 
-        addMsg({ role: "user", text: message, modelKey: "", timeISO: "", showModelTag: false, showTime: false, feedback: null });
+    const RESUME_RETRIES = 3;
 
-        const thinkingRow = addThinkingGifOnlyRow();
-        let res = null;
+    function resumeChatFetch(threadId, st) {
+        const headers = {};
+        if (st.lastEventId) headers["Last-Event-ID"] = st.lastEventId;
+        return apiFetch(`/api/chat/resume?thread_id=${encodeURIComponent(threadId)}`, {
+            headers,
+            signal: currentAbortController ? currentAbortController.signal : undefined
+        });
+    }
 
-        try {
-            currentAbortController = new AbortController();
+    function clearThinking(st) {
+        if (st.cleared) return;
+        st.thinkingRow.remove();
+        st.cleared = true;
+        ensureStreamingBotBubble(st.message, currentModel, activeThreadId);
+    }
 
-            res = await apiFetch("/api/chat/stream", {
-                method: "POST",
-                headers: { "Content-Type": "application/json" },
-                body: JSON.stringify({ message, thread_id: activeThreadId }),
-                signal: currentAbortController.signal
-            });
+    // true when done arrived; false when the stream ended without it
+    async function readChatStream(res, st) {
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder("utf-8");
+        let buf = "";
 
-            if (!res.ok) {
-                const t = await res.text();
-                throw new Error(t);
-            }
+        // 途中から再開する時は id なしなら最初から送り直されるので、受信済みの本文を捨てる
+        if (!st.lastEventId && streamingBot) streamingBot.answerAcc = "";
 
-            let cleared = false;
-            let gotDone = false;
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) return false;
 
-            const reader = res.body.getReader();
-            const decoder = new TextDecoder("utf-8");
-            let buf = "";
+            buf += decoder.decode(value, { stream: true });
+            const { blocks, rest } = splitSseBlocks(buf);
+            buf = rest;
 
-            while (true) {
-                const { value, done } = await reader.read();
-                if (done) break;
+            // one DOM write + scroll per network read, however many frames it carried
+            let dirty = false;
 
-                buf += decoder.decode(value, { stream: true });
-                const { blocks, rest } = splitSseBlocks(buf);
-                buf = rest;
+            for (const block of blocks) {
+                const parsed = parseSseBlock(block);
+                if (!parsed) continue;
 
-                for (const block of blocks) {
-                    const parsed = parseSseBlock(block);
-                    if (!parsed) continue;
+                const { eventName, ev } = parsed;
+                if (parsed.id) st.lastEventId = parsed.id;
 
-                    const { eventName, ev } = parsed;
+                if (eventName === "meta") {
+                    if (ev.thread_id) setActiveThread(ev.thread_id);
+                    if (!st.cleared) setQueueNote(st.thinkingRow, ev);
+                    continue;
+                }
 
-                    if (eventName === "meta") {
-                        if (ev.thread_id) setActiveThread(ev.thread_id);
-                        continue;
-                    }
+                if (eventName === "delta") {
+                    clearThinking(st);
+                    streamingBot.answerAcc += (ev.text || "");
+                    dirty = true;
 
-                    if (eventName === "delta") {
-                        if (!cleared) {
-                            thinkingRow.remove();
-                            cleared = true;
-                            ensureStreamingBotBubble(message, currentModel, activeThreadId);
-                        }
-
-                        const delta = (ev.text || "");
-                        streamingBot.answerAcc += delta;
-                        streamingBot.body.textContent = streamingBot.answerAcc;
-
-                        scrollToBottom();
-
-                    } else if (eventName === "replace") {
-                        if (!cleared) {
-                            thinkingRow.remove();
-                            cleared = true;
-                            ensureStreamingBotBubble(message, currentModel, activeThreadId);
-                        }
-
-                        streamingBot.answerAcc = (ev.text || "");
-                        streamingBot.body.textContent = streamingBot.answerAcc;
-
-                        scrollToBottom();
-
-                    } else if (eventName === "done") {
-                        gotDone = true;
-                        if (ev.thread_id) setActiveThread(ev.thread_id);
-
-                        // P1-4: ここでloadHistoryしない
-                        finalizeStreamingBot({
-                            botTs: ev.ts || "",
-                            answer: ev.answer || (streamingBot ? streamingBot.answerAcc : ""),
-                            modelKey: ev.model || currentModel,
-                            threadId: ev.thread_id || activeThreadId,
-                            question: message
-                        });
-
-                        // threadsだけ更新（一覧更新）
-                        await loadThreads();
-                        scrollToBottom(true);
-                        return;
+                } else if (eventName === "replace") {
+                    clearThinking(st);
+                    streamingBot.answerAcc = (ev.text || "");
+                    dirty = true;
 
-                    } else if (eventName === "error") {
-                        throw new Error(stringifyErrPayload(ev));
+                } else if (eventName === "done") {
+                    if (ev.thread_id) setActiveThread(ev.thread_id);
+
+                    const acc = streamingBot ? streamingBot.answerAcc : "";
+                    if (st.reloadOnDone || (!ev.answer && !(await answerMatchesDigest(acc, ev)))) {
+                        // 受信テキストが保存内容と一致しない時だけ履歴から取り直す
+                        streamingBot = null;
+                        await loadHistory();
+                        await loadThreads();
+                        return true;
                     }
+
+                    // P1-4: ここでloadHistoryしない
+                    finalizeStreamingBot({
+                        botTs: ev.ts || "",
+                        answer: ev.answer || acc,
+                        modelKey: ev.model || currentModel,
+                        threadId: ev.thread_id || activeThreadId,
+                        question: st.message
+                    });
+
+                    // threadsだけ更新（一覧更新）
+                    await loadThreads();
+                    scrollToBottom(true);
+                    return true;
+
+                } else if (eventName === "error") {
+                    throw new Error(stringifyErrPayload(ev));
                 }
             }
 
-            if (!gotDone) {
-                await loadThreads();
-                if (!cleared) {
-                    try { thinkingRow.remove(); } catch { }
-                }
-                streamingBot = null;
+            if (dirty && streamingBot) {
+                streamingBot.body.textContent = streamingBot.answerAcc;
+                scrollToBottom();
             }
-        } catch (err) {
-            if (err && (err.name === "AbortError" || String(err).includes("AbortError"))) {
-                try { thinkingRow.remove(); } catch { }
-                streamingBot = null;
-                return;
+        }
+    }
+
+    // 回線が切れても生成はサーバ側で続いているので、Last-Event-ID で続きから受け直す
+    async function followChat(res, st) {
+        try {
+            for (let attempt = 0; ; attempt++) {
+                try {
+                    if (await readChatStream(res, st)) return;
+                } catch (err) {
+                    if (!(err instanceof TypeError)) throw err;
+                }
+                if (attempt >= RESUME_RETRIES) break;
+
+                await new Promise(r => setTimeout(r, 500 * (attempt + 1)));
+                try {
+                    res = await resumeChatFetch(activeThreadId, st);
+                } catch (err) {
+                    if (err instanceof TypeError) continue;
+                    throw err;
+                }
+                if (res.status === 204) {
+                    // もう走っていない: 保存済みの回答を履歴から出す
+                    streamingBot = null;
+                    await loadHistory();
+                    await loadThreads();
+                    return;
+                }
+                if (!res.ok) break;
             }
 
-            try { thinkingRow.remove(); } catch { }
+            await loadThreads();
+            if (!st.cleared) {
+                try { st.thinkingRow.remove(); } catch { }
+            }
             streamingBot = null;
-
-            addMsg({
-                role: "bot",
-                text: "エラー: " + (err?.message || String(err)),
-                modelKey: currentModel,
-                timeISO: new Date().toISOString().slice(0, 19),
-                showModelTag: true,
-                showTime: true,
-                feedback: null
-            });
-            scrollToBottom(true);
+        } catch (err) {
+            showChatError(st, err);
         }
     }
 
-    function getMaxInputPx() {
-        const cs = window.getComputedStyle(input);
-        const lineH = parseFloat(cs.lineHeight) || 20;
-        const padTop = parseFloat(cs.paddingTop) || 0;
-        const padBottom = parseFloat(cs.paddingBottom) || 0;
-        const borderTop = parseFloat(cs.borderTopWidth) || 0;
-        const borderBottom = parseFloat(cs.borderBottomWidth) || 0;
-        return (lineH * 5) + padTop + padBottom + borderTop + borderBottom;
-    }
+    function showChatError(st, err) {
+        try { st.thinkingRow.remove(); } catch { }
+        streamingBot = null;
+        if (err && (err.name === "AbortError" || String(err).includes("AbortError"))) return;
 
-    function resizeInputToContent() {
-        input.style.height = "auto";
-        const maxPx = getMaxInputPx();
-        const next = Math.min(input.scrollHeight, maxPx);
-        input.style.height = `${next}px`;
-        input.style.overflowY = (input.scrollHeight > maxPx) ? "auto" : "hidden";
+        addMsg({
+            role: "bot",
+            text: "エラー: " + (err?.message || String(err)),
+            modelKey: currentModel,
+            timeISO: new Date().toISOString().slice(0, 19),
+            showModelTag: true,
+            showTime: true,
+            feedback: null
+        });
+        scrollToBottom(true);
     }
 
-    input.addEventListener("input", () => resizeInputToContent());
-
-    input.addEventListener("keydown", (e) => {
-        if (e.key !== "Enter") return;
-        if (e.shiftKey) return;
-        e.preventDefault();
-        if (send.disabled) return;
-        if (typeof form.requestSubmit === "function") form.requestSubmit();
-        else form.dispatchEvent(new Event("submit", { cancelable: true, bubbles: true }));
-    });
+    async function streamChat(message) {
+        if (!activeThreadId) setActiveThread(newThreadId());
+        stickToBottom = true;
 
-    form.addEventListener("submit", async (e) => {
-        e.preventDefault();
-        const message = input.value.trim();
-        if (!message) return;
+        addMsg({ role: "user", text: message, modelKey: "", timeISO: "", showModelTag: false, showTime: false, feedback: null });
 
-        lockComposerThinking();
+        const st = { message, thinkingRow: addThinkingGifOnlyRow(), cleared: false, lastEventId: "", reloadOnDone: false };
 
+        let res;
         try {
-            await streamChat(message);
-            input.value = "";
-            resizeInputToContent();
-        } finally {
-            unlockComposer();
-        }
-    });
+            currentAbortController = new AbortController();
 
-    function setSidebarOpen(open) {
-        document.body.classList.toggle("sidebar-open", !!open);
-        if (menuToggle) menuToggle.setAttribute("aria-expanded", open ? "true" : "false");
-        if (sidebarOverlay) sidebarOverlay.hidden = !open;
-    }
+            res = await apiFetch("/api/chat/stream", {
+                method: "POST",
+                headers: { "Content-Type": "application/json" },
+                body: JSON.stringify({ message, thread_id: activeThreadId }),
+                signal: currentAbortController.signal
+            });
 
-    function isMobile() {
-        return window.matchMedia && window.matchMedia("(max-width: 768px)").matches;
+            if (res.status === 409) {
+                // このスレッドはまだ生成中（別タブ等）: そちらの続きを表示する
+                st.reloadOnDone = true;
+                res = await resumeChatFetch(activeThreadId, st);
+            }
+            if (!res.ok) {
+                const t = await res.text();
+                throw new Error(t);
+            }
+        } catch (err) {
+            showChatError(st, err);
+            return;
+        }
+        if (res.status === 204) {
+            streamingBot = null;
+            await loadHistory();
+            return;
+        }
+        await followChat(res, st);
     }
 
-    function closeSidebarIfMobile() {
-        if (isMobile()) setSidebarOpen(false);
+    // 再読み込みした時に生成中のスレッドがあれば、続きから表示する
+    async function resumeActiveChat() {
+        if (!activeThreadId) return;
+        currentAbortController = new AbortController();
+        let res;
+        try {
+            res = await resumeChatFetch(activeThreadId, { lastEventId: "" });
+        } catch {
+            currentAbortController = null;
+            return;
+        }
+        if (res.status !== 200) {
+            currentAbortController = null;
+            return;
+        }
+
+        lockComposerThinking();
+        stickToBottom = true;
+        const st = { message: "", thinkingRow: addThinkingGifOnlyRow(), cleared: false, lastEventId: "", reloadOnDone: true };
+        try {
+            await followChat(res, st);
+        } finally {
+            unlockComposer();
+        }
     }
 
     if (menuToggle && sidebar && sidebarOverlay) {
@@ -1172,6 +1309,7 @@
             input.focus();
             resizeInputToContent();
             scrollToBottom(true);
+            resumeActiveChat();
         } catch (e) {
             chat.innerHTML = "";
             addMsg({
@@ -0,0 +1,124 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import load_config  # noqa: E402
+
+
+@pytest.fixture
+def make_cfg(tmp_path, monkeypatch):
+    # an AppConfig on a temp base_dir; keyword arguments are env overrides
+    def make(**env):
+        defaults = {
+            "FEEDBACK_DIR_NAS": str(tmp_path / "nas"),
+            "NAS_SYNC_INTERVAL_SEC": "0",
+            "DIFY_POOL_WARM": "0",
+            "HISTORY_WRITE_MODE": "immediate",
+            "POST_TURN_WORKERS": "0",
+        }
+        defaults.update(env)
+        for k, v in defaults.items():
+            monkeypatch.setenv(k, str(v))
+        return load_config(str(tmp_path))
+    return make
+
+
+@pytest.fixture
+def make_app(make_cfg, monkeypatch):
+    # the Flask app on a temp base_dir, without the process-wide background threads
+    import app as app_pkg
+
+    for name in ("start_nas_monitor", "start_nas_sync_worker", "start_md_scheduler", "start_dify_pools"):
+        monkeypatch.setattr(app_pkg, name, lambda cfg: None)
+
+    def make(**env):
+        return app_pkg.create_app(make_cfg(**env).base_dir)
+    return make
+
+
+@pytest.fixture
+def make_asgi(make_cfg, monkeypatch):
+    # make_asgi(**env) -> (ASGI app, cfg), with the same background threads patched out as make_app
+    import app as app_pkg
+    from app.asgi import create_asgi_app
+
+    for name in ("start_nas_monitor", "start_nas_sync_worker", "start_md_scheduler", "start_dify_pools"):
+        monkeypatch.setattr(app_pkg, name, lambda cfg: None)
+
+    def make(**env):
+        cfg = make_cfg(**env)
+        return create_asgi_app(cfg.base_dir), cfg
+    return make
+
+
+def session_cookie(cfg, user_id):
+    # the signed Flask session cookie value for a logged-in user
+    from flask import Flask
+    from flask.sessions import SecureCookieSessionInterface
+
+    f = Flask("cookie")
+    f.secret_key = cfg.secret_key
+    return SecureCookieSessionInterface().get_signing_serializer(f).dumps({"user_id": user_id})
+
+
+def sse_body(events):
+    return b"".join(b"data: " + json.dumps(ev).encode("utf-8") + b"\n\n" for ev in events)
+
+
+@pytest.fixture
+def fake_dify():
+    # fake_dify(handle) -> base URL; handle(req, body) writes the response
+    servers = []
+
+    def start(handle):
+        class H(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *a):
+                pass
+
+            def do_POST(self):
+                n = int(self.headers.get("Content-Length") or 0)
+                handle(self, json.loads(self.rfile.read(n) or b"{}"))
+
+        srv = ThreadingHTTPServer(("127.0.0.1", 0), H)
+        srv.daemon_threads = True
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        servers.append(srv)
+        return f"http://127.0.0.1:{srv.server_address[1]}/v1"
+
+    yield start
+    for srv in servers:
+        srv.shutdown()
+        srv.server_close()
+
+
+def send_chunked(req, events, stall_after=0.0):
+    req.send_response(200)
+    req.send_header("Content-Type", "text/event-stream")
+    req.send_header("Transfer-Encoding", "chunked")
+    req.end_headers()
+    for ev in events:
+        b = sse_body([ev])
+        req.wfile.write(b"%x\r\n%s\r\n" % (len(b), b))
+        req.wfile.flush()
+    if stall_after:
+        time.sleep(stall_after)
+    req.wfile.write(b"0\r\n\r\n")
+    req.wfile.flush()
+
+
+def wait_for(pred, timeout=5.0):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if pred():
+            return True
+        time.sleep(0.02)
+    return pred()
\ No newline at end of file
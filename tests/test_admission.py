@@ -0,0 +1,56 @@
+import threading
+
+import pytest
+
+from app import admission, chat_runs, core
+from conftest import wait_for
+
+
+@pytest.fixture
+def cfg(make_cfg, monkeypatch):
+    monkeypatch.setattr(admission, "_adm", {})
+    c = make_cfg(DIFY_MAX_INFLIGHT=1, DIFY_QUEUE_TIMEOUT_SEC=1, DIFY_API_BASE="http://127.0.0.1:9/v1")
+    core.create_user_files(c, "u1", "pw")
+    return c
+
+
+def events(run):
+    with run["cond"]:
+        frames, _, _ = chat_runs.chat_run_take_locked(run, 0)
+    return [f.split("event: ", 1)[1].split("\n", 1)[0] + ":" + f.rsplit("data: ", 1)[1].strip() for f in frames]
+
+
+def start(cfg, thread_id):
+    run = chat_runs.open_chat_run(cfg, "u1", thread_id)
+    t = threading.Thread(target=chat_runs._run_chat_turn, args=(cfg, run, "u1", "seisan", thread_id, "hello", "k"))
+    t.start()
+    return run, t
+
+
+def test_queue_timeout_leaves_no_user_row(cfg):
+    hog = admission.admission_enter(cfg, "seisan")
+    try:
+        run, t = start(cfg, "th1")
+        t.join(5)
+    finally:
+        admission.admission_leave(hog)
+
+    evs = events(run)
+    assert any('"status": "queued"' in e for e in evs)
+    assert "queue_timeout" in evs[-1]
+    assert core.read_history_all(cfg, "u1", "th1") == []
+    assert core.list_threads(cfg, "u1") == []
+
+
+def test_cancel_while_queued_leaves_no_user_row(cfg):
+    hog = admission.admission_enter(cfg, "seisan")
+    try:
+        run, t = start(cfg, "th2")
+        assert wait_for(lambda: any('"status": "queued"' in e for e in events(run)), timeout=2.0)
+        chat_runs.chat_run_cancel(run)
+        t.join(5)
+    finally:
+        admission.admission_leave(hog)
+
+    assert "cancelled" in events(run)[-1]
+    assert core.read_history_all(cfg, "u1", "th2") == []
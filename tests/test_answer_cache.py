@@ -0,0 +1,79 @@
+import threading
+
+import pytest
+
+from app import admission, chat_runs, core
+from conftest import sse_body
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(admission, "_adm", {})
+    monkeypatch.setattr(chat_runs, "_acache", chat_runs.OrderedDict())
+    monkeypatch.setattr(chat_runs, "_acache_lookups", {})
+    monkeypatch.setattr(chat_runs, "_acache_counters", {"stores": 0, "evictions": 0, "expired": 0, "invalidated": 0})
+
+
+@pytest.fixture
+def dify(fake_dify):
+    seen = []
+
+    def answer(req, body):
+        seen.append(body)
+        data = sse_body([
+            {"event": "message", "answer": "from dify", "conversation_id": "c-new"},
+            {"event": "message_end", "conversation_id": "c-new"},
+        ])
+        req.send_response(200)
+        req.send_header("Content-Type", "text/event-stream")
+        req.send_header("Content-Length", str(len(data)))
+        req.end_headers()
+        req.wfile.write(data)
+
+    return fake_dify(answer), seen
+
+
+def turn(cfg, thread_id, message):
+    run = chat_runs.open_chat_run(cfg, "u1", thread_id)
+    t = threading.Thread(target=chat_runs._run_chat_turn, args=(cfg, run, "u1", "seisan", thread_id, message, "k"))
+    t.start()
+    t.join(10)
+    with run["cond"]:
+        frames, _, _ = chat_runs.chat_run_take_locked(run, 0)
+    return "".join(frames)
+
+
+def test_follow_up_in_a_cache_served_thread_skips_the_cache(make_cfg, cache, dify):
+    base, seen = dify
+    cfg = make_cfg(DIFY_API_BASE=base, ANSWER_CACHE_MODELS="seisan")
+    core.create_user_files(cfg, "u1", "pw")
+    chat_runs.answer_cache_put(cfg, "seisan", "first question", "cached answer")
+    chat_runs.answer_cache_put(cfg, "seisan", "second question", "would be wrong here")
+
+    out = turn(cfg, "th", "first question")
+    assert '"cached": true' in out and "cached answer" in out
+    assert seen == []
+    assert core.get_dify_cid(cfg, "u1", "th", "seisan") == ""
+
+    before = chat_runs.answer_cache_stats()
+    out = turn(cfg, "th", "second question")
+    after = chat_runs.answer_cache_stats()
+
+    assert "from dify" in out and "would be wrong here" not in out
+    assert [b["query"] for b in seen] == ["second question"]
+    assert after["models"]["seisan"]["lookups"] == before["models"]["seisan"]["lookups"]
+    assert after["stores"] == before["stores"]
+
+
+def test_first_turn_answered_by_dify_is_stored(make_cfg, cache, dify):
+    base, seen = dify
+    cfg = make_cfg(DIFY_API_BASE=base, ANSWER_CACHE_MODELS="seisan")
+    core.create_user_files(cfg, "u1", "pw")
+
+    turn(cfg, "th1", "What is 5S?")
+    turn(cfg, "th1", "and 6S?")
+    assert len(seen) == 2
+    assert chat_runs.answer_cache_stats()["stores"] == 1
+
+    out = turn(cfg, "th2", "what is 5s")
+    assert '"cached": true' in out and len(seen) == 2
@@ -0,0 +1,81 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from app import admission, core
+from conftest import send_chunked, session_cookie
+
+
+@pytest.fixture
+def asgi(make_asgi, fake_dify, monkeypatch):
+    monkeypatch.setattr(admission, "_adm", {})
+    seen = []
+
+    def answer(req, body):
+        seen.append(body)
+        send_chunked(req, [
+            {"event": "message", "answer": "Hello, ", "conversation_id": "cid-9"},
+            {"event": "message", "answer": "world", "conversation_id": "cid-9"},
+            {"event": "message_end", "conversation_id": "cid-9"},
+        ])
+
+    app, cfg = make_asgi(DIFY_API_BASE=fake_dify(answer), DIFY_API_KEY="k")
+    core.create_user_files(cfg, "u1", "pw")
+    return app, cfg, seen
+
+
+def events(text):
+    out = []
+    for block in text.split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+        if "event" in fields:
+            out.append((fields["event"], json.loads(fields["data"])))
+    return out
+
+
+def call(app, cfg, requests):
+    # runs (method, url, json) requests in order on one client and returns the responses
+    async def go():
+        cookies = {"session": session_cookie(cfg, "u1")}
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://t", cookies=cookies) as client:
+            return [await client.request(m, url, json=body) for m, url, body in requests]
+    return asyncio.run(go())
+
+
+def test_stream_round_trip(asgi):
+    app, cfg, seen = asgi
+    stream, history, resume = call(app, cfg, [
+        ("POST", "/api/chat/stream", {"message": "hi", "thread_id": "th"}),
+        ("GET", "/api/history?thread_id=th", None),
+        ("GET", "/api/chat/resume?thread_id=th", None),
+    ])
+
+    assert stream.status_code == 200
+    assert stream.headers["content-type"].startswith("text/event-stream")
+    evs = events(stream.text)
+    assert evs[0][0] == "meta" and evs[0][1]["thread_id"] == "th"
+    assert "".join(d.get("text", "") for e, d in evs if e == "delta") == "Hello, world"
+    assert evs[-1][0] == "done"
+    assert [b["query"] for b in seen] == ["hi"]
+
+    # the Flask routes behind the ASGI app see the persisted turn
+    items = history.json()["items"]
+    assert [(i["role"], i["content"]) for i in items] == [("user", "hi"), ("bot", "Hello, world")]
+    assert core.get_dify_cid(cfg, "u1", "th", "seisan") == "cid-9"
+
+    # a finished run is still replayable until it expires
+    assert [e for e, _ in events(resume.text)][-1] == "done"
+
+
+def test_stream_needs_a_session(asgi):
+    app, cfg, seen = asgi
+
+    async def go():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://t") as client:
+            return await client.post("/api/chat/stream", json={"message": "hi"})
+
+    r = asyncio.run(go())
+    assert r.status_code == 401
+    assert seen == []
@@ -0,0 +1,185 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from app import admission, chat_runs, core, dify
+from conftest import send_chunked, session_cookie, sse_body, wait_for
+
+
+def parse(frames):
+    # -> [(id, event, data)] from raw SSE text
+    out = []
+    for block in "".join(frames).split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+        if "event" in fields:
+            out.append((fields.get("id", ""), fields["event"], json.loads(fields["data"])))
+    return out
+
+
+@pytest.fixture
+def run(make_cfg):
+    cfg = make_cfg(CHAT_STREAM_BUFFER_FRAMES=16)
+    r = chat_runs.open_chat_run(cfg, "u1", "th")
+    chat_runs.chat_run_push(r, ("meta", {"thread_id": "th"}))
+    for n in range(30):
+        chat_runs.chat_run_push(r, ("delta", {"text": f"{n},"}))
+    chat_runs.chat_run_close(r)
+    return r
+
+
+def take(run, after):
+    with run["cond"]:
+        frames, after, finished = chat_runs.chat_run_take_locked(run, after)
+    return parse(frames), finished
+
+
+FULL = "".join(f"{n}," for n in range(30))
+
+
+def test_resume_inside_the_ring_replays_only_missing_frames(run):
+    evs, finished = take(run, 25)
+    assert [e[1] for e in evs] == ["delta"] * 6
+    assert "".join(e[2]["text"] for e in evs) == "".join(f"{n}," for n in range(24, 30))
+    assert evs[0][0] == f"{run['id']}.26"
+    assert finished
+
+
+def test_resume_behind_the_ring_gets_one_replace_frame(run):
+    evs, _ = take(run, 5)
+    assert [e[1] for e in evs] == ["replace"]
+    assert evs[0][2]["text"] == FULL
+
+    evs, _ = take(run, 0)
+    assert [e[1] for e in evs] == ["meta", "replace"]
+    assert chat_runs.chat_runs_stats()["gaps"] >= 2
+
+
+def test_cursor_from_another_run_replays_from_the_start(run):
+    assert chat_runs.chat_run_cursor(run, f"{run['id']}.12") == 12
+    assert chat_runs.chat_run_cursor(run, "0123456789ab.12") == 0
+    assert chat_runs.chat_run_cursor(run, "garbage") == 0
+
+
+def test_one_run_per_thread_at_a_time(make_cfg):
+    cfg = make_cfg()
+    r = chat_runs.open_chat_run(cfg, "u1", "busy")
+    assert chat_runs.open_chat_run(cfg, "u1", "busy") is None
+    chat_runs.chat_run_close(r)
+    assert chat_runs.open_chat_run(cfg, "u1", "busy") is not None
+
+
+def test_client_drops_and_resumes_with_last_event_id(make_app, fake_dify):
+    pieces = [f"w{n} " for n in range(12)]
+
+    def slow_answer(req, body):
+        req.send_response(200)
+        req.send_header("Content-Type", "text/event-stream")
+        req.end_headers()
+        for p in pieces:
+            req.wfile.write(sse_body([{"event": "message", "answer": p, "conversation_id": "c1"}]))
+            req.wfile.flush()
+            time.sleep(0.05)
+        req.wfile.write(sse_body([{"event": "message_end", "conversation_id": "c1"}]))
+        req.wfile.flush()
+        req.close_connection = True
+
+    base = fake_dify(slow_answer)
+    app = make_app(DIFY_API_BASE=base, DIFY_API_KEY="k", SSE_COALESCE_MS=0, SSE_FIRST_FLUSH_BYTES=1)
+    cfg = app.config["APP_CFG"]
+    core.create_user_files(cfg, "u1", "pw")
+    client = app.test_client()
+    with client.session_transaction() as s:
+        s["user_id"] = "u1"
+
+    resp = client.post("/api/chat/stream", json={"message": "hi", "thread_id": "th-resume"}, buffered=False)
+    seen = []
+    for chunk in resp.response:
+        seen.append(chunk if isinstance(chunk, str) else chunk.decode("utf-8"))
+        if sum(1 for e in parse(seen) if e[1] == "delta") >= 3:
+            break
+    resp.close()
+    first = parse(seen)
+    last_id = [e[0] for e in first if e[0]][-1]
+
+    run = chat_runs.chat_run_for("u1", "th-resume")
+    assert wait_for(lambda: run["done"], timeout=5.0)
+
+    rest = parse([client.get("/api/chat/resume", query_string={"thread_id": "th-resume"},
+                             headers={"Last-Event-ID": last_id}).get_data(as_text=True)])
+    assert rest and rest[0][0] != last_id
+    text = "".join(e[2].get("text", "") for e in first + rest if e[1] == "delta")
+    assert text == "".join(pieces)
+    assert rest[-1][1] == "done"
+
+
+def stalled_dify(fake_dify, before_headers):
+    # Dify that stops sending for far longer than the test runs, well inside the read timeout
+    def handle(req, body):
+        if before_headers:
+            time.sleep(8)
+        send_chunked(req, [{"event": "message", "answer": "partial", "conversation_id": "c1"}], stall_after=8)
+    return fake_dify(handle)
+
+
+def pool_in_use(base):
+    return sum(s["in_use"] for s in dify.dify_pool_stats().values() if s["base"] == base)
+
+
+@pytest.mark.parametrize("before_headers", [False, True])
+def test_cancel_aborts_a_stalled_dify_read(make_cfg, fake_dify, monkeypatch, before_headers):
+    monkeypatch.setattr(admission, "_adm", {})
+    base = stalled_dify(fake_dify, before_headers)
+    cfg = make_cfg(DIFY_API_BASE=base, DIFY_READ_TIMEOUT_SEC=30, SSE_COALESCE_MS=0, SSE_FIRST_FLUSH_BYTES=1)
+    core.create_user_files(cfg, "u1", "pw")
+
+    run = chat_runs.start_chat_run(cfg, "u1", "seisan", "th", "hi", "k")
+    if before_headers:
+        assert wait_for(lambda: pool_in_use(base) == 1)
+    else:
+        assert wait_for(lambda: "partial" in run["text"])
+
+    t0 = time.monotonic()
+    chat_runs.chat_run_cancel(run)
+    assert wait_for(lambda: run["done"], timeout=2.0)
+    assert time.monotonic() - t0 < 2.0
+    assert admission.admission_stats()["seisan"]["in_flight"] == 0
+    assert wait_for(lambda: pool_in_use(base) == 0, timeout=2.0)
+
+    with run["cond"]:
+        frames, _, _ = chat_runs.chat_run_take_locked(run, 0)
+    last = parse(frames)[-1]
+    assert last[1] == "error" and last[2]["code"] == "cancelled"
+    # an aborted read is not an endpoint failure
+    eps = [e for e in dify.dify_endpoint_stats()["models"].get("seisan", []) if e["base"] == base]
+    assert all(e["errors"] == 0 for e in eps)
+
+
+def test_cancel_aborts_a_stalled_dify_read_on_asgi(make_asgi, fake_dify, monkeypatch):
+    monkeypatch.setattr(admission, "_adm", {})
+    base = stalled_dify(fake_dify, False)
+    app, cfg = make_asgi(DIFY_API_BASE=base, DIFY_API_KEY="k", DIFY_READ_TIMEOUT_SEC=30, SSE_COALESCE_MS=0, SSE_FIRST_FLUSH_BYTES=1)
+    core.create_user_files(cfg, "u1", "pw")
+
+    async def scenario():
+        cookies = {"session": session_cookie(cfg, "u1")}
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://t", cookies=cookies) as client:
+            stream = asyncio.ensure_future(client.post("/api/chat/stream", json={"message": "hi", "thread_id": "th"}))
+            for _ in range(250):
+                run = chat_runs.chat_run_for("u1", "th")
+                if run is not None and "partial" in run["text"]:
+                    break
+                await asyncio.sleep(0.02)
+            t0 = time.monotonic()
+            r = await client.post("/api/chat/cancel", json={"thread_id": "th"})
+            assert r.json()["running"] is True
+            resp = await asyncio.wait_for(stream, 2.0)
+            return resp, time.monotonic() - t0
+
+    resp, took = asyncio.run(scenario())
+    assert took < 2.0
+    events = parse([resp.text])
+    assert events[-1][1] == "error" and events[-1][2]["code"] == "cancelled"
+    assert admission.admission_stats()["seisan"]["in_flight"] == 0
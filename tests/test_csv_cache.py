@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from app import core
+
+FIELDS = ["a", "b"]
+
+
+@pytest.fixture
+def path(tmp_path):
+    p = str(tmp_path / "t.csv")
+    write(p, "a,b\n1,x\n")
+    return p
+
+
+def write(p, text, mtime_ns=None):
+    with open(p, "w", encoding="utf-8", newline="") as f:
+        f.write(text)
+    if mtime_ns is not None:
+        os.utime(p, ns=(mtime_ns, mtime_ns))
+
+
+def read(p):
+    return core.csv_read_dicts_cached(p, FIELDS)
+
+
+def test_unchanged_file_is_served_from_the_cache(path):
+    first = read(path)
+    before = core.csv_cache_stats()
+    assert read(path) is first
+    after = core.csv_cache_stats()
+    assert after["hits"] - before["hits"] == 1
+    assert after["misses"] == before["misses"]
+
+
+def test_same_size_rewrite_with_a_new_mtime_is_reread(path):
+    read(path)
+    mtime = os.stat(path).st_mtime_ns
+    write(path, "a,b\n2,y\n", mtime_ns=mtime + 1_000_000)
+    assert read(path) == [{"a": "2", "b": "y"}]
+
+
+def test_size_change_with_the_same_mtime_is_reread(path):
+    read(path)
+    mtime = os.stat(path).st_mtime_ns
+    write(path, "a,b\n1,x\n3,z\n", mtime_ns=mtime)
+    assert [r["a"] for r in read(path)] == ["1", "3"]
+
+
+def test_file_replaced_with_same_size_and_mtime_is_reread(path, tmp_path):
+    read(path)
+    st = os.stat(path)
+    other = str(tmp_path / "new.csv")
+    write(other, "a,b\n9,q\n", mtime_ns=st.st_mtime_ns)
+    os.replace(other, path)
+    assert os.stat(path).st_ino != st.st_ino
+    assert (os.stat(path).st_mtime_ns, os.stat(path).st_size) == (st.st_mtime_ns, st.st_size)
+    assert read(path) == [{"a": "9", "b": "q"}]
+
+
+def test_own_append_extends_the_cached_rows(path):
+    read(path)
+    core.csv_append_row(path, ["2", "y"])
+    before = core.csv_cache_stats()
+    assert read(path) == [{"a": "1", "b": "x"}, {"a": "2", "b": "y"}]
+    assert core.csv_cache_stats()["hits"] - before["hits"] == 1
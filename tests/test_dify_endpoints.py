@@ -0,0 +1,59 @@
+import time
+
+from app import dify
+from conftest import send_chunked, wait_for
+
+ANSWER = [
+    {"event": "message", "answer": "hi", "conversation_id": "c1"},
+    {"event": "message_end", "conversation_id": "c1"},
+]
+
+
+def _payload():
+    return {"inputs": {}, "query": "q", "response_mode": "streaming", "conversation_id": "", "user": "u"}
+
+
+def _in_use(base):
+    with dify._dify_guard:
+        pool = dify._dify_pools[(base, "seisan")]
+    with pool["cond"]:
+        return pool["in_use"]
+
+
+def test_hedge_loser_waiting_for_headers_is_cut_off(make_cfg, fake_dify):
+    def stalled(req, body):
+        time.sleep(5)
+        send_chunked(req, ANSWER)
+
+    slow = fake_dify(stalled)
+    fast = fake_dify(lambda req, body: send_chunked(req, ANSWER))
+    cfg = make_cfg(DIFY_API_BASES=f"{slow},{fast}", DIFY_HEDGE=1, DIFY_HEDGE_MIN_MS=100, DIFY_HEDGE_DEFAULT_MS=100, DIFY_POOL_SIZE=1)
+
+    t0 = time.monotonic()
+    with dify.dify_chat_stream(cfg, "seisan", "k", _payload()) as stream:
+        events = [ev["event"] for ev in dify.iter_dify_sse(stream["chunks"])]
+    assert stream["base"] == fast
+    assert events == ["message", "message_end"]
+
+    # the loser never saw response headers; its slot must come back long before the 5 s stall ends
+    assert wait_for(lambda: _in_use(slow) == 0, timeout=2.0)
+    assert time.monotonic() - t0 < 3.0
+    assert dify.dify_pool_stats()["seisan"]["orphaned"] == 0
+
+
+def test_failover_on_5xx(make_cfg, fake_dify):
+    def broken(req, body):
+        req.send_response(503)
+        req.send_header("Content-Length", "0")
+        req.end_headers()
+
+    bad = fake_dify(broken)
+    good = fake_dify(lambda req, body: send_chunked(req, ANSWER))
+    cfg = make_cfg(DIFY_API_BASES=f"{bad},{good}")
+
+    with dify.dify_chat_stream(cfg, "seisan", "k", _payload()) as stream:
+        assert [ev["event"] for ev in dify.iter_dify_sse(stream["chunks"])] == ["message", "message_end"]
+    assert stream["base"] == good
+    assert _in_use(bad) == 0
+    # the winner is drained and released on a "dify-release" thread
+    assert wait_for(lambda: _in_use(good) == 0, timeout=2.0)
\ No newline at end of file
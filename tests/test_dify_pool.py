@@ -0,0 +1,67 @@
+import threading
+import time
+
+import pytest
+
+from app import dify
+from conftest import sse_body
+
+
+@pytest.fixture
+def pool(make_cfg, fake_dify):
+    def answer(req, body):
+        data = sse_body([{"event": "message_end", "conversation_id": "c1"}])
+        req.send_response(200)
+        req.send_header("Content-Type", "text/event-stream")
+        req.send_header("Content-Length", str(len(data)))
+        req.end_headers()
+        req.wfile.write(data)
+
+    base = fake_dify(answer)
+    cfg = make_cfg(DIFY_API_BASE=base, DIFY_POOL_SIZE=1, DIFY_CONNECT_TIMEOUT_SEC=1)
+    return cfg, base, dify._dify_pool(cfg, "seisan", base)
+
+
+def test_acquire_gives_up_after_the_timeout(pool):
+    _, _, p = pool
+    dify._dify_pool_acquire(p, 1.0)
+    try:
+        t0 = time.monotonic()
+        with pytest.raises(TimeoutError, match="pool exhausted"):
+            dify._dify_pool_acquire(p, 0.2)
+        assert 0.15 <= time.monotonic() - t0 < 1.0
+        assert p["stats"]["wait_timeouts"] == 1
+        assert p["in_use"] == 1
+    finally:
+        dify._dify_pool_release(p)
+
+
+def test_waiter_gets_the_slot_when_it_is_released(pool):
+    _, _, p = pool
+    dify._dify_pool_acquire(p, 1.0)
+    threading.Timer(0.1, dify._dify_pool_release, args=(p,)).start()
+
+    dify._dify_pool_acquire(p, 2.0)
+    dify._dify_pool_release(p)
+
+    assert p["stats"]["waits"] == 1
+    assert p["stats"]["wait_timeouts"] == 0
+    assert p["stats"]["wait_ms_max"] >= 50
+    assert p["stats"]["peak_in_use"] == 1
+
+
+def test_turn_fails_fast_when_the_pool_stays_full(pool):
+    cfg, base, p = pool
+    dify._dify_pool_acquire(p, 1.0)
+    try:
+        t0 = time.monotonic()
+        with pytest.raises(TimeoutError):
+            with dify.dify_chat_stream(cfg, "seisan", "k", {"query": "hi"}):
+                pass
+        assert time.monotonic() - t0 < cfg.dify_connect_timeout_sec + 1.0
+    finally:
+        dify._dify_pool_release(p)
+
+    with dify.dify_chat_stream(cfg, "seisan", "k", {"query": "hi"}) as stream:
+        assert b"message_end" in b"".join(stream["chunks"])
+    assert stream["base"] == base
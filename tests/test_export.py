@@ -0,0 +1,32 @@
+import io
+import zipfile
+
+from app import core
+
+
+def test_account_zip_streams_only_non_empty_chunks(make_cfg):
+    cfg = make_cfg()
+    core.create_user_files(cfg, "u1", "pw")
+    for n in range(3):
+        tid = core.create_new_thread_id()
+        ts = core.append_history(cfg, "u1", "user", "seisan", tid, "", f"question {n}")
+        core.upsert_thread(cfg, "u1", tid, f"question {n}", ts)
+
+    chunks = list(core.iter_account_export_zip(cfg, "u1", "csv"))
+
+    assert chunks and all(chunks)
+    with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as zf:
+        names = zf.namelist()
+        assert len(names) == 3
+        assert all("question" in zf.read(n).decode("utf-8") for n in names)
+
+
+def test_account_zip_without_threads_is_a_valid_empty_archive(make_cfg):
+    cfg = make_cfg()
+    core.create_user_files(cfg, "u1", "pw")
+
+    chunks = list(core.iter_account_export_zip(cfg, "u1", "csv"))
+
+    assert chunks and all(chunks)
+    with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as zf:
+        assert zf.namelist() == []
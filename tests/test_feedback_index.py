@@ -0,0 +1,148 @@
+import csv
+import os
+import time
+
+import pytest
+
+from app import core
+from tools import backup_rotate
+
+
+@pytest.fixture
+def spool_dir(make_cfg):
+    return make_cfg().feedback_dir_local
+
+
+def put(dir_path, bot_ts, kind="good", saved_at="2026-10-01T10:00:00"):
+    core.upsert_feedback_state_to_dir(
+        dir_path=dir_path,
+        user_id="u1",
+        model_key="m1",
+        thread_id="t1",
+        bot_ts=bot_ts,
+        kind=kind,
+        saved_at=saved_at,
+        question="q",
+        answer="a",
+    )
+
+
+def key(bot_ts):
+    return core._feedback_key("u1", "m1", "t1", bot_ts)
+
+
+def settle(dir_path):
+    # pretend the last write to the shard directory happened a while ago
+    d = core.feedback_shard_dir(dir_path)
+    old = time.time() - 60
+    os.utime(d, (old, old))
+
+
+def count_scans(monkeypatch):
+    calls = []
+    real = core._feedback_shards
+
+    def counting(dir_path):
+        calls.append(dir_path)
+        return real(dir_path)
+
+    monkeypatch.setattr(core, "_feedback_shards", counting)
+    return calls
+
+
+def test_settled_directory_is_not_rescanned(spool_dir, monkeypatch):
+    put(spool_dir, "b1")
+    settle(spool_dir)
+    scans = count_scans(monkeypatch)
+
+    for _ in range(5):
+        assert core._feedback_rows_by_key(spool_dir, key("b1"))[0]["kind"] == "good"
+
+    assert len(scans) == 1
+
+
+def test_own_write_is_visible_without_reread(spool_dir, monkeypatch):
+    put(spool_dir, "b1")
+    core._feedback_rows_by_key(spool_dir, key("b1"))
+    reads = []
+    real = core._read_feedback_csv
+    monkeypatch.setattr(core, "_read_feedback_csv", lambda p: reads.append(p) or real(p))
+
+    put(spool_dir, "b2", kind="bad")
+
+    assert core._feedback_rows_by_key(spool_dir, key("b2"))[0]["kind"] == "bad"
+    assert reads == []
+
+
+def test_shard_written_by_another_process_is_picked_up(spool_dir):
+    put(spool_dir, "b1")
+    settle(spool_dir)
+    assert core._feedback_rows_by_key(spool_dir, key("b2")) == []
+
+    # another host drops a shard: tmp file plus rename, as csv_write_dicts_atomic does
+    shard = core.feedback_shard_path(spool_dir, "m1", "202609")
+    row = {"user_id": "u1", "model_key": "m1", "thread_id": "t1", "bot_ts": "b2",
+           "kind": "bad", "saved_at": "2026-09-30T10:00:00", "question": "q", "answer": "a"}
+    with open(shard + ".tmp", "w", encoding="utf-8", newline="") as f:
+        f.write(",".join(core.FEEDBACK_FIELDS) + "\r\n" + ",".join(row[k] for k in core.FEEDBACK_FIELDS) + "\r\n")
+    os.replace(shard + ".tmp", shard)
+
+    assert core._feedback_rows_by_key(spool_dir, key("b2"))[0]["kind"] == "bad"
+    assert {r["bot_ts"] for r in core._feedback_thread_rows(spool_dir, "u1", "t1")} == {"b1", "b2"}
+
+
+def test_backstop_rescan_after_interval(spool_dir, monkeypatch):
+    put(spool_dir, "b1")
+    settle(spool_dir)
+    core._feedback_rows_by_key(spool_dir, key("b1"))
+    scans = count_scans(monkeypatch)
+    monkeypatch.setattr(core, "FEEDBACK_INDEX_RESCAN_SEC", 0.0)
+
+    core._feedback_rows_by_key(spool_dir, key("b1"))
+
+    assert len(scans) == 1
+
+
+
+def shard_keys(dir_path, ym):
+    return [r["bot_ts"] for r in core._read_feedback_csv(core.feedback_shard_path(dir_path, "m1", ym))]
+
+
+def test_resave_in_a_later_month_moves_the_key_between_shards(spool_dir):
+    put(spool_dir, "b1", saved_at="2026-09-30T23:00:00")
+    put(spool_dir, "b2", saved_at="2026-09-30T23:30:00")
+    put(spool_dir, "b1", kind="bad", saved_at="2026-10-01T09:00:00")
+
+    assert shard_keys(spool_dir, "202609") == ["b2"]
+    assert shard_keys(spool_dir, "202610") == ["b1"]
+    assert core._feedback_rows_by_key(spool_dir, key("b1"))[0]["kind"] == "bad"
+
+    put(spool_dir, "b2", kind="none", saved_at="2026-10-01T09:30:00")
+    assert shard_keys(spool_dir, "202609") == []
+    assert core._feedback_rows_by_key(spool_dir, key("b2")) == []
+
+
+def test_legacy_state_file_is_split_into_shards(spool_dir, tmp_path):
+    legacy = core.feedback_state_csv_path(spool_dir)
+    os.makedirs(spool_dir, exist_ok=True)
+    with open(legacy, "w", encoding="utf-8", newline="") as f:
+        w = csv.DictWriter(f, fieldnames=core.FEEDBACK_FIELDS)
+        w.writeheader()
+        for bot_ts, saved_at in [("b1", "2026-09-01T10:00:00"), ("b2", "2026-10-01T10:00:00")]:
+            w.writerow({"user_id": "u1", "model_key": "m1", "thread_id": "t1", "bot_ts": bot_ts,
+                        "kind": "good", "saved_at": saved_at, "question": "q", "answer": "a"})
+
+    backup_dir = str(tmp_path / "_backup")
+    core.ensure_feedback_state_csv(spool_dir, backup_dir)
+
+    assert not os.path.exists(legacy)
+    assert not [n for n in os.listdir(spool_dir) if ".migrated_" in n]
+    (folder,) = os.listdir(backup_dir)
+    assert folder.startswith("migrated_")
+    (label,) = os.listdir(os.path.join(backup_dir, folder, "feedback"))
+    assert label.endswith("good_and_bad")
+    assert os.path.exists(os.path.join(backup_dir, folder, "feedback", label, core.FEEDBACK_STATE_NAME))
+    assert backup_rotate.rotate_old(backup_dir, keep_days=-1) == [os.path.join(backup_dir, folder)]
+    assert shard_keys(spool_dir, "202609") == ["b1"]
+    assert shard_keys(spool_dir, "202610") == ["b2"]
+    assert {r["bot_ts"] for r in core._feedback_thread_rows(spool_dir, "u1", "t1")} == {"b1", "b2"}
@@ -0,0 +1,57 @@
+from app import core
+
+MONTH = "202610"
+
+
+def save(d, bot_ts, kind, saved_at, prev=None):
+    prev_kind, prev_saved_at = prev or ("none", "")
+    row = {"user_id": "u1", "model_key": "m1", "thread_id": "t1", "bot_ts": bot_ts,
+           "question": f"q {bot_ts}", "answer": f"a {bot_ts}"}
+    core.upsert_feedback_state_to_dir(dir_path=d, kind=kind, saved_at=saved_at, **row)
+    core.update_feedback_md(dir_path=d, prev_kind=prev_kind, prev_saved_at=prev_saved_at, kind=kind, saved_at=saved_at, **row)
+
+
+def order(d, kind):
+    # the bot_ts of each chunk, top to bottom
+    with open(core._feedback_md_path(d, "m1", kind, MONTH), encoding="utf-8") as f:
+        return [line[2:].strip() for line in f if line.startswith("q ")]
+
+
+def assert_matches_full_render(d, kind):
+    p = core._feedback_md_path(d, "m1", kind, MONTH)
+    with open(p, "rb") as f:
+        incremental = f.read()
+    spans = core._md_index_get_locked(p)
+    for key, (s, e) in spans.items():
+        assert incremental[s:e].startswith(b"***\n")
+        assert key.rsplit("||", 1)[1].encode() in incremental[s:e]
+    core._render_md_file_locked(d, "m1", kind, MONTH)
+    with open(p, "rb") as f:
+        assert f.read() == incremental
+
+
+def test_new_feedback_goes_to_the_head(make_cfg):
+    d = make_cfg().feedback_dir_local
+    save(d, "b1", "good", "2026-10-01T10:00:00")
+    save(d, "b2", "good", "2026-10-02T10:00:00")
+    save(d, "b3", "good", "2026-10-03T10:00:00")
+
+    assert order(d, "good") == ["b3", "b2", "b1"]
+    assert_matches_full_render(d, "good")
+
+
+def test_resave_and_kind_change_keep_newest_first(make_cfg):
+    d = make_cfg().feedback_dir_local
+    save(d, "b1", "good", "2026-10-01T10:00:00")
+    save(d, "b2", "good", "2026-10-02T10:00:00")
+    save(d, "b3", "good", "2026-10-03T10:00:00")
+
+    save(d, "b1", "good", "2026-10-04T10:00:00", prev=("good", "2026-10-01T10:00:00"))
+    assert order(d, "good") == ["b1", "b3", "b2"]
+    assert_matches_full_render(d, "good")
+
+    save(d, "b3", "bad", "2026-10-05T10:00:00", prev=("good", "2026-10-03T10:00:00"))
+    assert order(d, "good") == ["b1", "b2"]
+    assert order(d, "bad") == ["b3"]
+    assert_matches_full_render(d, "good")
+    assert_matches_full_render(d, "bad")
@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+from app import core
+from conftest import wait_for
+
+
+@pytest.fixture
+def app(make_app, monkeypatch):
+    monkeypatch.setattr(core, "_rebuild_jobs", core.OrderedDict())
+    a = make_app()
+    cfg = a.config["APP_CFG"]
+    core.create_user_files(cfg, "u1", "pw")
+    for bot_ts, saved_at in [("b1", "2026-09-01T10:00:00"), ("b2", "2026-10-01T10:00:00")]:
+        core.upsert_feedback_state_to_dir(
+            dir_path=cfg.feedback_dir_local, user_id="u1", model_key="seisan", thread_id="t1", bot_ts=bot_ts,
+            kind="good", saved_at=saved_at, question="q", answer="a",
+        )
+    return a
+
+
+@pytest.fixture
+def client(app):
+    c = app.test_client()
+    with c.session_transaction() as s:
+        s["user_id"] = "u1"
+    return c
+
+
+def finished(client, url):
+    out = {}
+
+    def check():
+        out.update(client.get(url).get_json())
+        return out["state"] in ("done", "error")
+    assert wait_for(check)
+    return out
+
+
+def test_full_rebuild_runs_as_a_job_with_a_status_url(app, client):
+    r = client.post("/api/feedback/rebuild", json={"target": "local"})
+    assert r.status_code == 202
+    body = r.get_json()
+    assert body["status_url"] == f"/api/feedback/rebuild/{body['job_id']}"
+    assert body["job"]["state"] in ("queued", "running", "done")
+
+    job = finished(client, body["status_url"])
+    assert job["state"] == "done"
+    assert (job["total"], job["done"], job["errors"]) == (2, 2, [])
+    assert job["rebuilt"] == [{"model_key": "seisan", "months": ["202609", "202610"]}]
+    assert job["finished_at"] and job["duration_ms"] >= 0
+
+
+def test_a_running_job_is_reused_for_the_same_target(app, client, monkeypatch):
+    gate = threading.Event()
+    real = core._render_md_partition
+
+    def held(*a):
+        gate.wait(5)
+        return real(*a)
+
+    monkeypatch.setattr(core, "_render_md_partition", held)
+    first = client.post("/api/feedback/rebuild", json={"target": "local"}).get_json()
+    again = client.post("/api/feedback/rebuild", json={"target": "local", "yyyymm": "all"}).get_json()
+    other = client.post("/api/feedback/rebuild", json={"target": "local", "model_key": "seisan"}).get_json()
+    gate.set()
+
+    assert again["job_id"] == first["job_id"]
+    assert other["job_id"] != first["job_id"]
+    assert finished(client, first["status_url"])["state"] == "done"
+    finished(client, other["status_url"])
+
+
+def test_partition_errors_are_reported(app, client, monkeypatch):
+    def broken(d, mk, ym, rows):
+        if ym == "202609":
+            raise OSError("disk full")
+
+    monkeypatch.setattr(core, "_render_md_partition", broken)
+    body = client.post("/api/feedback/rebuild", json={"target": "local"}).get_json()
+    job = finished(client, body["status_url"])
+
+    assert job["state"] == "error"
+    assert job["errors"] == ["seisan 202609: disk full"]
+    assert job["rebuilt"] == [{"model_key": "seisan", "months": ["202610"]}]
+
+
+def test_status_needs_a_session_and_a_known_job(app, client):
+    assert client.get("/api/feedback/rebuild/nope").status_code == 404
+    assert app.test_client().get("/api/feedback/rebuild/nope").status_code == 401
@@ -0,0 +1,106 @@
+import csv
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import core
+from tools import backup_rotate
+
+
+def write_legacy(cfg, user_id, rows):
+    with open(core.history_csv_path(cfg, user_id), "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(core.HISTORY_FIELDS)
+        for r in rows:
+            w.writerow([r.get(k, "") for k in core.HISTORY_FIELDS])
+
+
+def test_migration_moves_the_legacy_file_into_the_backup_dir(make_cfg):
+    cfg = make_cfg()
+    core.create_user_files(cfg, "u1", "pw")
+    day1 = datetime.now().replace(hour=10, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    day2 = day1 + timedelta(days=1)
+    write_legacy(cfg, "u1", [
+        {"timestamp": day1.isoformat(), "role": "user", "model_key": "seisan", "thread_id": "th", "content": "q1"},
+        {"timestamp": day2.isoformat(), "role": "bot", "model_key": "seisan", "thread_id": "th", "content": "a1"},
+    ])
+
+    report = core.migrate_history_to_segments(cfg, "u1")
+
+    assert report == {"rows": 2, "segments": 2}
+    assert [r["content"] for r in core.read_history_all(cfg, "u1", "th")] == ["q1", "a1"]
+    assert not os.path.exists(core.history_csv_path(cfg, "u1"))
+    assert not [n for n in os.listdir(core.user_dir(cfg, "u1")) if ".migrated_" in n]
+
+    (folder,) = os.listdir(cfg.backup_dir)
+    assert folder.startswith("migrated_")
+    assert os.path.exists(os.path.join(cfg.backup_dir, folder, "users", "u1", "history.csv"))
+    # backup_rotate recognises the folder by the date in its name
+    assert backup_rotate.rotate_old(cfg.backup_dir, keep_days=-1) == [os.path.join(cfg.backup_dir, folder)]
+
+
+def test_legacy_rows_merge_into_existing_segments_and_undated_rows_use_the_file_date(make_cfg):
+    cfg = make_cfg()
+    core.create_user_files(cfg, "u1", "pw")
+    day = (datetime.now() - timedelta(days=2)).replace(hour=9, minute=0, second=0, microsecond=0)
+    core.storage_for(cfg).append_history_rows("u1", [
+        {"thread_id": "th", "timestamp": (day + timedelta(hours=1)).isoformat(), "role": "user", "model_key": "seisan", "content": "already segmented"},
+    ])
+    write_legacy(cfg, "u1", [
+        {"timestamp": day.isoformat(), "role": "user", "model_key": "seisan", "thread_id": "th", "content": "legacy"},
+        {"timestamp": "", "role": "user", "model_key": "seisan", "thread_id": "th", "content": "undated"},
+    ])
+    mtime = (day - timedelta(days=1)).timestamp()
+    os.utime(core.history_csv_path(cfg, "u1"), (mtime, mtime))
+
+    core.ensure_all_user_csv(cfg, "u1")
+
+    segs = {ymd: [r["content"] for r in core.csv_read_dicts_cached(path, core.HISTORY_FIELDS)]
+            for ymd, path in core._history_segments(cfg, "u1")}
+    assert segs == {
+        (day - timedelta(days=1)).strftime("%Y%m%d"): ["undated"],
+        day.strftime("%Y%m%d"): ["legacy", "already segmented"],
+    }
+    # the merged segment's .idx still answers keyed reads
+    path = core.history_segment_path(cfg, "u1", day.strftime("%Y%m%d"))
+    assert len(core.csv_read_rows_by_key(path, core.HISTORY_FIELDS, "thread_id", "th")) == 2
+
+
+@pytest.fixture
+def aged_segments(make_cfg, monkeypatch):
+    monkeypatch.setattr(core, "_history_pruned_on", {})
+    cfg = make_cfg()
+    core.create_user_files(cfg, "u1", "pw")
+    now = datetime.now()
+    days = {n: (now - timedelta(days=n)).strftime("%Y%m%d") for n in (20, 15, 14, 13, 0)}
+    for n, ymd in days.items():
+        path = core.history_segment_path(cfg, "u1", ymd)
+        core.ensure_csv_file(path, core.HISTORY_FIELDS)
+        core.csv_append_rows(path, [[now.isoformat(), "user", "seisan", "th", "", f"d{n}"]], index=("thread_id", 3))
+        core.csv_read_rows_by_key(path, core.HISTORY_FIELDS, "thread_id", "th")
+    return cfg, days
+
+
+def test_segments_older_than_14_days_are_dropped_with_their_index(aged_segments):
+    cfg, days = aged_segments
+    core.prune_history_14days(cfg, "u1")
+
+    assert [ymd for ymd, _ in core._history_segments(cfg, "u1")] == [days[14], days[13], days[0]]
+    left = set(os.listdir(core.history_dir_path(cfg, "u1")))
+    assert not {f"{days[20]}.idx", f"{days[15]}.idx"} & left
+    assert f"{days[14]}.idx" in left
+
+
+def test_pruning_runs_once_per_day(aged_segments):
+    cfg, days = aged_segments
+    core.prune_history_14days(cfg, "u1")
+    # a segment that shows up later the same day is left for tomorrow's pass
+    late = core.history_segment_path(cfg, "u1", days[20])
+    core.ensure_csv_file(late, core.HISTORY_FIELDS)
+    core.prune_history_14days(cfg, "u1")
+    assert os.path.exists(late)
+
+    core._history_pruned_on.clear()
+    core.prune_history_14days(cfg, "u1")
+    assert not os.path.exists(late)
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import core
+from app.metrics import render_metrics
+
+
+@pytest.fixture
+def cfg(make_cfg):
+    # a long batch window keeps the background writer out of the way; the tests flush by hand
+    c = make_cfg(HISTORY_WRITE_MODE="batched", HISTORY_BATCH_MS=600000)
+    core.create_user_files(c, "u1", "pw")
+    return c
+
+
+def row(ts, content):
+    return {"timestamp": ts, "role": "user", "model_key": "seisan", "thread_id": "th",
+            "dify_conversation_id": "", "content": content}
+
+
+def stored(cfg):
+    return [r["content"] for r in core.storage_for(cfg).read_history_all("u1", "th")]
+
+
+def test_failed_day_is_retried_without_duplicating_committed_rows(cfg, monkeypatch):
+    today = datetime.now().replace(microsecond=0)
+    yesterday = today - timedelta(days=1)
+    for ts, content in [(yesterday, "a"), (yesterday, "b"), (today, "c")]:
+        core._enqueue_history_row(cfg, "u1", row(ts.isoformat(), content))
+
+    st = core.storage_for(cfg)
+    real = st.append_history_rows
+    failures = [1]
+
+    def flaky(user_id, rows, fsync=False):
+        if failures and rows[0]["content"] == "c":
+            failures.pop()
+            raise OSError("disk full")
+        return real(user_id, rows, fsync=fsync)
+
+    monkeypatch.setattr(st, "append_history_rows", flaky)
+    errors = core.history_writer_stats()["errors"]
+
+    core._flush_history_user(cfg, "u1")
+    assert stored(cfg) == ["a", "b"]
+    assert [r["content"] for r in core.read_history_all(cfg, "u1", "th")] == ["a", "b", "c"]
+    stats = core.history_writer_stats()
+    assert stats["errors"] == errors + 1
+    assert stats["queue_depth"] == 1
+    text = render_metrics()
+    assert "chutgpt_history_queue_depth 1.0" in text
+    assert f"chutgpt_history_write_errors_total {float(errors + 1)}" in text
+
+    core._flush_history_user(cfg, "u1")
+    assert stored(cfg) == ["a", "b", "c"]
+    assert core.history_writer_stats()["queue_depth"] == 0
+
+
+def test_rows_enqueued_during_a_flush_stay_queued(cfg, monkeypatch):
+    now = datetime.now().replace(microsecond=0).isoformat()
+    core._enqueue_history_row(cfg, "u1", row(now, "a"))
+    st = core.storage_for(cfg)
+    real = st.append_history_rows
+
+    def racing(user_id, rows, fsync=False):
+        core._enqueue_history_row(cfg, "u1", row(now, "late"))
+        return real(user_id, rows, fsync=fsync)
+
+    monkeypatch.setattr(st, "append_history_rows", racing)
+    core._flush_history_user(cfg, "u1")
+    monkeypatch.setattr(st, "append_history_rows", real)
+
+    assert stored(cfg) == ["a"]
+    assert [r["content"] for r in core.read_history_all(cfg, "u1", "th")] == ["a", "late"]
+    core._flush_history_user(cfg, "u1")
+    assert stored(cfg) == ["a", "late"]
+
+
+def test_restarting_the_writer_does_not_stack_exit_handlers(cfg, monkeypatch):
+    registered = []
+    monkeypatch.setattr(core.atexit, "register", registered.append)
+    for n in range(3):
+        # as if the previous writer thread had died
+        monkeypatch.setattr(core, "_hw_thread", None)
+        core._enqueue_history_row(cfg, "u1", row(datetime.now().isoformat(timespec="seconds"), f"r{n}"))
+    core.drain_history_writer()
+
+    assert registered == []
+    assert stored(cfg) == ["r0", "r1", "r2"]
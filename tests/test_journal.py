@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+from app import core
+from conftest import wait_for
+
+
+@pytest.fixture
+def cfg(make_cfg):
+    c = make_cfg(JOURNAL_COMPACT_ROWS=1000)
+    core.create_user_files(c, "u1", "pw")
+    return c
+
+
+def threads(cfg):
+    return {t["thread_id"]: (t["name"], t["preview"], t["updated_at"]) for t in core._csv_list_threads(cfg, "u1", limit=100)}
+
+
+def journal_rows(cfg):
+    jp = core._journal_path(core.threads_csv_path(cfg, "u1"))
+    return core.csv_read_dicts_cached(jp, ["op"] + core.THREAD_FIELDS) if os.path.exists(jp) else []
+
+
+def test_ops_are_journaled_and_folded_on_read(cfg):
+    core._csv_upsert_thread(cfg, "u1", "a", "first", "2026-10-01T10:00:00")
+    core._csv_upsert_thread(cfg, "u1", "b", "second", "2026-10-01T10:01:00")
+    core._csv_upsert_thread(cfg, "u1", "a", "ignored", "2026-10-01T10:02:00")
+    assert core._csv_rename_thread(cfg, "u1", "b", "named")
+    assert core._csv_delete_thread(cfg, "u1", "a")
+
+    assert [r["op"] for r in journal_rows(cfg)] == ["upsert", "upsert", "upsert", "rename", "delete"]
+    assert core.csv_read_dicts_cached(core.threads_csv_path(cfg, "u1"), core.THREAD_FIELDS) == []
+    assert list(threads(cfg)) == ["b"]
+    # a rename also replaces the preview, as it always has
+    assert threads(cfg)["b"][:2] == ("named", "named")
+
+
+def test_replaying_a_journal_over_its_own_snapshot_is_harmless(cfg):
+    core._csv_upsert_thread(cfg, "u1", "a", "first", "2026-10-01T10:00:00")
+    core._csv_delete_thread(cfg, "u1", "a")
+    core._csv_upsert_thread(cfg, "u1", "a", "again", "2026-10-01T10:05:00")
+    core._csv_upsert_thread(cfg, "u1", "b", "second", "2026-10-01T10:01:00")
+    core._csv_rename_thread(cfg, "u1", "b", "named")
+    before = threads(cfg)
+
+    # a compaction that died after rewriting the snapshot but before truncating the journal
+    path = core.threads_csv_path(cfg, "u1")
+    snapshot = core.csv_read_dicts_cached(path, core.THREAD_FIELDS)
+    core.csv_write_dicts_atomic(path, core.THREAD_FIELDS, core._fold_threads(snapshot, journal_rows(cfg)))
+
+    assert journal_rows(cfg)
+    assert threads(cfg) == before
+
+
+def test_journal_is_compacted_after_the_threshold(make_cfg):
+    cfg = make_cfg(JOURNAL_COMPACT_ROWS=5)
+    core.create_user_files(cfg, "u1", "pw")
+    for n in range(5):
+        core._csv_upsert_thread(cfg, "u1", f"t{n}", f"p{n}", f"2026-10-01T10:0{n}:00")
+
+    assert wait_for(lambda: journal_rows(cfg) == [], timeout=2.0)
+    snapshot = core.csv_read_dicts_cached(core.threads_csv_path(cfg, "u1"), core.THREAD_FIELDS)
+    assert sorted(r["thread_id"] for r in snapshot) == [f"t{n}" for n in range(5)]
+    assert len(threads(cfg)) == 5
+
+    core._csv_set_dify_cid(cfg, "u1", "t1", "seisan", "cid-1", "2026-10-01T11:00:00")
+    assert core._csv_get_dify_cid(cfg, "u1", "t1", "seisan") == "cid-1"
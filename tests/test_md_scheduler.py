@@ -0,0 +1,86 @@
+import json
+import os
+
+import pytest
+
+from app import core
+
+
+@pytest.fixture
+def sched(tmp_path, monkeypatch):
+    # scheduler state on a temp md_dirty.json, with no scheduler thread draining it
+    monkeypatch.setattr(core, "_md_dirty", {})
+    monkeypatch.setattr(core, "_md_running", {})
+    monkeypatch.setattr(core, "_md_sched_thread", None)
+    monkeypatch.setattr(core, "_md_sched_stats", dict(core._md_sched_stats))
+    monkeypatch.setattr(core, "_md_debounce_sec", 10.0)
+    monkeypatch.setattr(core, "_md_dirty_file", str(tmp_path / "_spool" / "md_dirty.json"))
+    monkeypatch.setattr(core, "_md_scheduler_loop", lambda workers: None)
+    return tmp_path
+
+
+def saved():
+    with open(core._md_dirty_file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_marks_are_debounced_and_capped(sched):
+    with core._md_sched_cond:
+        core._md_mark_locked("d", "m1", {"202610"}, 1000.0)
+        assert core._md_dirty[("d", "m1")]["due"] == 1010.0
+
+        # every new mark pushes the rebuild out by one window...
+        core._md_mark_locked("d", "m1", {"202609"}, 1005.0)
+        assert core._md_dirty[("d", "m1")]["due"] == 1015.0
+
+        # ...but never past six windows after the first one
+        for t in range(1010, 1100, 5):
+            core._md_mark_locked("d", "m1", {"202610"}, float(t))
+        assert core._md_dirty[("d", "m1")]["due"] == 1060.0
+        assert core._md_dirty[("d", "m1")]["months"] == {"202609", "202610"}
+
+
+def test_dirty_and_running_months_are_persisted(sched):
+    core.mark_dirty_month("d", "m1", "2026-10")
+    core.mark_dirty_month("d", "m2", "202609")
+    core.mark_dirty_month("d", "m2", "")
+    assert saved() == [
+        {"dir": "d", "model_key": "m1", "months": ["202610"]},
+        {"dir": "d", "model_key": "m2", "months": ["202609"]},
+    ]
+
+    with core._md_sched_cond:
+        core._md_running[("d", "m1")] = core._md_dirty.pop(("d", "m1"))["months"]
+    core.mark_dirty_month("d", "m1", "202611")
+    assert saved()[0] == {"dir": "d", "model_key": "m1", "months": ["202610", "202611"]}
+
+
+def test_failed_rebuild_is_marked_again(sched, monkeypatch):
+    def broken(d, mk, months):
+        raise OSError("share went away")
+
+    monkeypatch.setattr(core, "rebuild_feedback_md_for_model_months_in_dir", broken)
+    with core._md_sched_cond:
+        core._md_running[("d", "m1")] = {"202610"}
+    core._md_rebuild_job(("d", "m1"), {"202610"})
+
+    assert ("d", "m1") not in core._md_running
+    assert core._md_dirty[("d", "m1")]["months"] == {"202610"}
+    assert saved() == [{"dir": "d", "model_key": "m1", "months": ["202610"]}]
+    assert core.md_rebuild_stats()["errors"] == 1
+
+
+def test_restart_picks_up_the_saved_months(sched, make_cfg):
+    cfg = make_cfg(MD_REBUILD_COOLDOWN_SEC=3)
+    path = os.path.join(cfg.base_dir, "_spool", "md_dirty.json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump([{"dir": "d", "model_key": "m1", "months": ["202609", "202610"]}, {"bogus": 1}], f)
+
+    core.start_md_scheduler(cfg)
+    core._md_sched_thread.join(5)
+
+    assert core._md_dirty_file == path
+    assert core._md_debounce_sec == 3.0
+    assert core._md_dirty[("d", "m1")]["months"] == {"202609", "202610"}
+    assert core.md_rebuild_stats()["pending_months"] == 2
@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+
+import pytest
+
+from app import core
+
+
+@pytest.fixture
+def cfg(make_cfg, monkeypatch):
+    c = make_cfg()
+    monkeypatch.setattr(core, "_nas_state", {"ok": True, "checked_at": time.time(), "latency_ms": 0.0, "failures": 0})
+    return c
+
+
+def spool(cfg, bot_ts, kind="good", saved_at="2026-10-01T10:00:00", dir_path=None):
+    core.upsert_feedback_state(
+        cfg,
+        dir_path=dir_path or cfg.feedback_dir_local,
+        user_id="u1",
+        model_key="m1",
+        thread_id="t1",
+        bot_ts=bot_ts,
+        kind=kind,
+        saved_at=saved_at,
+        question="q " + bot_ts,
+        answer="a " + bot_ts,
+    )
+
+
+def lookup(cfg, bot_ts):
+    return core.get_feedback_state(cfg, user_id="u1", model_key="m1", thread_id="t1", bot_ts=bot_ts)
+
+
+def test_spool_is_merged_into_nas(cfg):
+    spool(cfg, "b1")
+    spool(cfg, "b2", kind="bad")
+
+    report = core.sync_local_spool_to_nas_if_possible(cfg)
+
+    assert report["moved_csv"] and not report["errors"]
+    assert report["merged_rows"] == 2
+    assert core.spool_backlog(cfg) == 0
+    nas = {r["bot_ts"]: r["kind"] for r in core._load_feedback_state_from(cfg.feedback_dir_nas)}
+    assert nas == {"b1": "good", "b2": "bad"}
+    assert [n for n in os.listdir(cfg.feedback_dir_local) if ".bak_" in n] == []
+
+
+def test_failed_merge_restores_spool_and_keeps_newer_rows(cfg, monkeypatch):
+    spool(cfg, "b1", saved_at="2026-10-01T10:00:00")
+    real = core._feedback_upsert_rows
+    entered = threading.Event()
+    release = threading.Event()
+
+    def flaky(dir_path, rows, **kw):
+        if dir_path == cfg.feedback_dir_nas:
+            entered.set()
+            release.wait(5)
+            raise OSError("nas went away")
+        return real(dir_path, rows, **kw)
+
+    monkeypatch.setattr(core, "_feedback_upsert_rows", flaky)
+    out = {}
+    t = threading.Thread(target=lambda: out.update(core.sync_local_spool_to_nas_if_possible(cfg)))
+    t.start()
+    assert entered.wait(5)
+    # newer feedback lands in the fresh spool while the merge is running
+    spool(cfg, "b1", kind="bad", saved_at="2026-10-01T11:00:00")
+    release.set()
+    t.join(5)
+
+    assert out["errors"] and not out["moved_csv"]
+    rows = core._load_feedback_state_from(cfg.feedback_dir_local)
+    assert [(r["bot_ts"], r["kind"]) for r in rows] == [("b1", "bad")]
+    assert [n for n in os.listdir(cfg.feedback_dir_local) if ".bak_" in n] == []
+
+
+def test_spool_lock_is_not_held_during_nas_merge(cfg, monkeypatch):
+    spool(cfg, "b1")
+    real = core._feedback_upsert_rows
+    entered = threading.Event()
+    release = threading.Event()
+
+    def slow(dir_path, rows, **kw):
+        if dir_path == cfg.feedback_dir_nas:
+            entered.set()
+            release.wait(5)
+        return real(dir_path, rows, **kw)
+
+    monkeypatch.setattr(core, "_feedback_upsert_rows", slow)
+    t = threading.Thread(target=core.sync_local_spool_to_nas_if_possible, args=(cfg,))
+    t.start()
+    try:
+        assert entered.wait(5)
+        t0 = time.monotonic()
+        spool(cfg, "b2")
+        assert time.monotonic() - t0 < 1.0
+        # the snapshot stays visible to lookups until it reaches the NAS
+        assert lookup(cfg, "b1")["kind"] == "good"
+        assert lookup(cfg, "b2")["kind"] == "good"
+    finally:
+        release.set()
+        t.join(5)
+
+    assert {r["bot_ts"] for r in core._load_feedback_state_from(cfg.feedback_dir_nas)} == {"b1"}
+    assert {r["bot_ts"] for r in core._load_feedback_state_from(cfg.feedback_dir_local)} == {"b2"}
+
+
+def test_delete_during_merge_is_not_resurrected(cfg, monkeypatch):
+    spool(cfg, "b1")
+    real = core._feedback_upsert_rows
+    entered = threading.Event()
+    release = threading.Event()
+
+    def slow(dir_path, rows, **kw):
+        if dir_path == cfg.feedback_dir_nas and not entered.is_set():
+            entered.set()
+            release.wait(5)
+        return real(dir_path, rows, **kw)
+
+    monkeypatch.setattr(core, "_feedback_upsert_rows", slow)
+    t = threading.Thread(target=core.sync_local_spool_to_nas_if_possible, args=(cfg,))
+    t.start()
+    try:
+        assert entered.wait(5)
+        spool(cfg, "b1", kind="none", saved_at="2026-10-01T12:00:00", dir_path=cfg.feedback_dir_nas)
+        assert lookup(cfg, "b1") is None
+    finally:
+        release.set()
+        t.join(5)
+
+    assert lookup(cfg, "b1") is None
+    assert core._load_feedback_state_from(cfg.feedback_dir_nas) == []
+
+
+
+def test_lookups_do_not_touch_nas_while_it_is_down(cfg, monkeypatch):
+    spool(cfg, "b1", dir_path=cfg.feedback_dir_nas)
+    spool(cfg, "b2")
+    monkeypatch.setattr(core, "_nas_state", {"ok": False, "checked_at": time.time(), "latency_ms": 0.0, "failures": 1})
+    nas = os.path.abspath(cfg.feedback_dir_nas)
+
+    def guard(fn):
+        def wrapped(path, *a, **kw):
+            assert not os.path.abspath(path).startswith(nas), f"NAS touched: {path}"
+            return fn(path, *a, **kw)
+        return wrapped
+
+    monkeypatch.setattr(os, "stat", guard(os.stat))
+    monkeypatch.setattr(os, "listdir", guard(os.listdir))
+    monkeypatch.setattr(os.path, "isdir", guard(os.path.isdir))
+
+    assert lookup(cfg, "b1") is None
+    assert lookup(cfg, "b2")["kind"] == "good"
+    assert [r["bot_ts"] for r in core.load_feedback_state_merged(cfg)] == ["b2"]
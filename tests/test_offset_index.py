@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+from app import core
+
+FIELDS = ["k", "v"]
+
+
+@pytest.fixture
+def path(tmp_path):
+    p = str(tmp_path / "t.csv")
+    core.ensure_csv_file(p, FIELDS)
+    core.csv_append_rows(p, [["a", "1"], ["b", "2"]], index=("k", 0))
+    # the first keyed read builds the sidecar; later indexed appends extend it
+    core.csv_read_rows_by_key(p, FIELDS, "k", "a")
+    core.csv_append_rows(p, [["a", "3,\nwith a newline"]], index=("k", 0))
+    return p
+
+
+def by_key(p, key):
+    return [r["v"] for r in core.csv_read_rows_by_key(p, FIELDS, "k", key)]
+
+
+def idx_end(p):
+    with open(core._offset_index_path(p), encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    return max([int(lines[0].split("\t")[3])] + [int(line.rsplit("\t", 1)[1]) for line in lines[1:]])
+
+
+def test_appends_keep_the_sidecar_in_step(path):
+    assert by_key(path, "a") == ["1", "3,\nwith a newline"]
+    assert by_key(path, "b") == ["2"]
+    assert idx_end(path) == os.path.getsize(path)
+
+
+def test_write_behind_the_index_is_picked_up(path):
+    by_key(path, "a")
+    # another writer (or an older version) appends without updating the .idx
+    with open(path, "a", encoding="utf-8", newline="") as f:
+        f.write("a,4\r\n")
+
+    assert by_key(path, "a") == ["1", "3,\nwith a newline", "4"]
+    assert idx_end(path) == os.path.getsize(path)
+
+
+@pytest.mark.parametrize("cut", [1, 8])
+def test_truncated_index_is_rebuilt(path, cut):
+    ip = core._offset_index_path(path)
+    with open(ip, "rb+") as f:
+        f.truncate(os.path.getsize(ip) - cut)
+    core._offset_index_forget(os.path.abspath(path))
+
+    assert by_key(path, "a") == ["1", "3,\nwith a newline"]
+    assert idx_end(path) == os.path.getsize(path)
+
+
+def test_index_of_a_replaced_file_is_not_trusted(path, tmp_path):
+    by_key(path, "a")
+    other = str(tmp_path / "other.csv")
+    core.ensure_csv_file(other, FIELDS)
+    core.csv_append_rows(other, [["b", "1"], ["a", "2"], ["b", "3,\nwith a newline"]])
+    assert os.path.getsize(other) == os.path.getsize(path)
+    os.replace(other, path)
+    core._offset_index_forget(os.path.abspath(path))
+
+    assert by_key(path, "a") == ["2"]
+    assert by_key(path, "b") == ["1", "3,\nwith a newline"]
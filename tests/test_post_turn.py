@@ -0,0 +1,114 @@
+import json
+import logging
+import time
+
+import pytest
+
+from app import admission, core
+from conftest import sse_body
+
+
+@pytest.fixture
+def app(make_app, fake_dify, monkeypatch):
+    monkeypatch.setattr(admission, "_adm", {})
+    monkeypatch.setattr(core, "POST_TURN_RETRY_SEC", 0.01)
+
+    def answer(req, body):
+        data = sse_body([
+            {"event": "message", "answer": "the answer", "conversation_id": "cid-1"},
+            {"event": "message_end", "conversation_id": "cid-1"},
+        ])
+        req.send_response(200)
+        req.send_header("Content-Type", "text/event-stream")
+        req.send_header("Content-Length", str(len(data)))
+        req.end_headers()
+        req.wfile.write(data)
+
+    a = make_app(DIFY_API_BASE=fake_dify(answer), DIFY_API_KEY="k", POST_TURN_WORKERS=2)
+    core.create_user_files(a.config["APP_CFG"], "u1", "pw")
+    return a
+
+
+def chat(client, thread_id):
+    body = client.post("/api/chat/stream", json={"message": "hi", "thread_id": thread_id}).get_data(as_text=True)
+    for block in body.split("\n\n"):
+        if "event: done" in block:
+            return json.loads(block.split("data: ", 1)[1])
+    raise AssertionError(body)
+
+
+def login(app):
+    client = app.test_client()
+    with client.session_transaction() as s:
+        s["user_id"] = "u1"
+    return client
+
+
+def test_history_right_after_done_has_the_bot_row(app, monkeypatch):
+    cfg = app.config["APP_CFG"]
+    st = core.storage_for(cfg)
+    real = st.set_dify_cid
+
+    def slow(*a):
+        time.sleep(0.3)
+        return real(*a)
+
+    # keep the persist job running after done has gone out
+    monkeypatch.setattr(st, "set_dify_cid", slow)
+    client = login(app)
+
+    done = chat(client, "th")
+    items = client.get("/api/history", query_string={"thread_id": "th"}).get_json()["items"]
+
+    assert [(i["role"], i["content"]) for i in items] == [("user", "hi"), ("bot", "the answer")]
+    assert items[-1]["created_at"] == done["ts"]
+    assert core.get_dify_cid(cfg, "u1", "th", "seisan") == "cid-1"
+
+
+def test_failed_persist_is_retried_without_duplicating_the_bot_row(app, monkeypatch, caplog):
+    cfg = app.config["APP_CFG"]
+    st = core.storage_for(cfg)
+    real = st.set_dify_cid
+    failures = [1, 1]
+
+    def flaky(*a):
+        if failures:
+            failures.pop()
+            raise OSError("share went away")
+        return real(*a)
+
+    monkeypatch.setattr(st, "set_dify_cid", flaky)
+    before = core.post_turn_stats()
+    client = login(app)
+
+    with caplog.at_level(logging.WARNING, logger="app.core"):
+        chat(client, "th")
+        core.wait_post_turn(cfg, "u1")
+
+    after = core.post_turn_stats()
+    assert [i["role"] for i in core.read_history_all(cfg, "u1", "th")] == ["user", "bot"]
+    assert core.get_dify_cid(cfg, "u1", "th", "seisan") == "cid-1"
+    assert after["retries"] - before["retries"] == 2
+    assert after["dropped"] == before["dropped"]
+    assert sum("retrying" in r.getMessage() for r in caplog.records) == 2
+
+
+def test_persist_that_keeps_failing_is_logged_when_dropped(app, monkeypatch, caplog):
+    cfg = app.config["APP_CFG"]
+    st = core.storage_for(cfg)
+
+    def broken(*a):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(st, "set_dify_cid", broken)
+    before = core.post_turn_stats()
+    client = login(app)
+
+    with caplog.at_level(logging.WARNING, logger="app.core"):
+        chat(client, "th")
+        core.wait_post_turn(cfg, "u1")
+
+    after = core.post_turn_stats()
+    assert after["dropped"] - before["dropped"] == 1
+    assert after["retries"] - before["retries"] == core.POST_TURN_RETRIES
+    assert any(r.levelno == logging.ERROR and "dropped" in r.getMessage() for r in caplog.records)
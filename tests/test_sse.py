@@ -0,0 +1,183 @@
+import hashlib
+import json
+import threading
+import time
+
+import pytest
+
+from app import chat_runs, core, dify
+from conftest import send_chunked, wait_for
+
+STREAM = (
+    "\ufeffdata: {\"event\": \"message\", \"answer\": \"\u3042\"}\r\n\r\n"
+    ": keep-alive\n\n"
+    "event: ping\rid: 7\rretry: 1500\rdata: a\rdata: b\r\r"
+    "data: {\"event\": \"message_end\"}\n\n"
+).encode("utf-8")
+
+EXPECTED = [
+    ("message", "{\"event\": \"message\", \"answer\": \"\u3042\"}".encode("utf-8")),
+    ("ping", b"a\nb"),
+    ("message", b"{\"event\": \"message_end\"}"),
+]
+
+
+def _feed_all(parser, pieces):
+    out = []
+    for p in pieces:
+        out.extend(parser.feed(p))
+    return out
+
+
+def test_parser_whole_stream():
+    p = dify.SseParser()
+    assert p.feed(STREAM) == EXPECTED
+    assert p.last_event_id == "7"
+    assert p.retry_ms == 1500
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 64])
+def test_parser_split_at_every_boundary(size):
+    # splits land inside the BOM, a multi-byte character, CRLF pairs and the blank-line separator
+    pieces = [STREAM[i:i + size] for i in range(0, len(STREAM), size)]
+    assert _feed_all(dify.SseParser(), pieces) == EXPECTED
+
+
+def test_parser_every_two_way_split():
+    for i in range(len(STREAM) + 1):
+        assert _feed_all(dify.SseParser(), [STREAM[:i], STREAM[i:]]) == EXPECTED, i
+
+
+def test_parser_holds_incomplete_event():
+    p = dify.SseParser()
+    assert p.feed(b"data: {\"a\": 1}\n") == []
+    assert p.feed(b"\n") == [("message", b"{\"a\": 1}")]
+
+
+def test_dify_events_done_and_bad_payload():
+    p = dify.SseParser()
+    events, finished = dify.dify_sse_events(p, b"data: not json\n\ndata: {\"answer\": \"x\"}\n\ndata: [DONE]\n\n")
+    assert [ev["answer"] for ev in events] == ["x"]
+    assert finished
+
+
+def test_message_end_is_not_held_back_by_a_stalled_body():
+    release = threading.Event()
+
+    def source():
+        yield b"data: " + json.dumps({"event": "message", "answer": "hi"}).encode() + b"\n\n"
+        yield b"data: " + json.dumps({"event": "message_end"}).encode() + b"\n\n"
+        release.wait(5)
+        yield b"data: " + json.dumps({"event": "tts_message_end"}).encode() + b"\n\n"
+
+    t0 = time.monotonic()
+    seen = []
+    for ev in dify.iter_dify_sse(source()):
+        seen.append(ev["event"])
+        if ev["event"] == "message_end":
+            break
+    release.set()
+    assert seen == ["message", "message_end"]
+    assert time.monotonic() - t0 < 1.0
+
+
+def test_trailing_events_after_message_end_are_delivered():
+    body = b"".join(
+        b"data: " + json.dumps({"event": e}).encode() + b"\n\n" for e in ("message_end", "tts_message_end")
+    )
+    assert [ev["event"] for ev in dify.iter_dify_sse([body])] == ["message_end", "tts_message_end"]
+
+
+def test_stream_context_exits_while_dify_keeps_the_body_open(make_cfg, fake_dify):
+    answer = [{"event": "message", "answer": "hi", "conversation_id": "c1"}, {"event": "message_end", "conversation_id": "c1"}]
+    base = fake_dify(lambda req, body: send_chunked(req, answer, stall_after=5))
+    cfg = make_cfg(DIFY_API_BASE=base)
+    payload = {"inputs": {}, "query": "q", "response_mode": "streaming", "conversation_id": "", "user": "u"}
+
+    t0 = time.monotonic()
+    with dify.dify_chat_stream(cfg, "seisan", "k", payload) as stream:
+        for ev in dify.iter_dify_sse(stream["chunks"]):
+            if ev["event"] == "message_end":
+                break
+    assert time.monotonic() - t0 < 1.0
+
+    pool = dify._dify_pools[(base, "seisan")]
+    # released in the background once the drain budget runs out
+    assert wait_for(lambda: pool["in_use"] == 0, timeout=dify.DIFY_DRAIN_SEC + 2.0)
+
+
+@pytest.fixture
+def new_turn(make_cfg):
+    def make(**env):
+        cfg = make_cfg(**env)
+        core.create_user_files(cfg, "u1", "pw")
+        return chat_runs.begin_chat_turn(cfg, "u1", "seisan", "th", "hi")
+    return make
+
+
+def feed(turn, *answers):
+    # -> the delta texts flushed by each message event
+    out = []
+    for a in answers:
+        frames, status = chat_runs.chat_turn_event(turn, {"event": "message", "answer": a})
+        assert status == ""
+        out.append([d["text"] for e, d in frames if e == "delta"])
+    return out
+
+
+def test_first_frame_and_later_frames_flush_at_their_own_sizes(new_turn):
+    turn = new_turn(SSE_FIRST_FLUSH_BYTES=4, SSE_COALESCE_BYTES=10, SSE_COALESCE_MS=60000)
+    assert feed(turn, "ab", "cd", "efghi", "jklmn", "op") == [[], ["abcd"], [], ["efghijklmn"], []]
+
+    frames, status = chat_runs.chat_turn_event(turn, {"event": "message_end", "metadata": {"usage": {"completion_tokens": 7}}})
+    assert (frames, status) == ([("delta", {"text": "op"})], "end")
+    assert turn["answer"] == "abcdefghijklmnop"
+    assert (turn["deltas_in"], turn["delta_frames"], turn["completion_tokens"]) == (5, 3, 7)
+
+
+def test_thresholds_count_utf8_bytes(new_turn):
+    turn = new_turn(SSE_FIRST_FLUSH_BYTES=6, SSE_COALESCE_BYTES=6, SSE_COALESCE_MS=60000)
+    # two three-byte characters reach six bytes
+    assert feed(turn, "\u3042", "\u3044") == [[], ["\u3042\u3044"]]
+
+
+def test_pending_text_is_flushed_once_the_window_has_passed(new_turn):
+    turn = new_turn(SSE_FIRST_FLUSH_BYTES=100, SSE_COALESCE_BYTES=100, SSE_COALESCE_MS=50)
+    assert chat_runs.chat_turn_flush_timeout(turn) is None
+    assert feed(turn, "a") == [[]]
+    since = turn["pending_since"]
+    assert chat_runs.chat_turn_flush_timeout(turn, now=since + 0.01) == pytest.approx(0.04)
+    assert chat_runs.chat_turn_flush_timeout(turn, now=since + 1.0) == 0.0
+
+    # the WSGI path sees the window on the next event, the ASGI path flushes on the timer
+    turn["pending_since"] -= 1.0
+    assert feed(turn, "b") == [["ab"]]
+    assert feed(turn, "c") == [[]]
+    assert chat_runs.chat_turn_flush(turn) == [("delta", {"text": "c"})]
+    assert chat_runs.chat_turn_flush(turn) == []
+
+
+def test_replace_drops_the_pending_text(new_turn):
+    turn = new_turn(SSE_FIRST_FLUSH_BYTES=100, SSE_COALESCE_MS=60000)
+    feed(turn, "draft")
+    frames, _ = chat_runs.chat_turn_event(turn, {"event": "message_replace", "answer": "final"})
+    assert frames == [("replace", {"text": "final"})]
+    assert chat_runs.chat_turn_flush(turn) == []
+    assert turn["answer"] == "final"
+
+
+@pytest.mark.parametrize("mode", ["full", "digest"])
+def test_done_carries_the_answer_or_its_digest(new_turn, mode):
+    turn = new_turn(SSE_DONE_MODE=mode)
+    feed(turn, "\u3053\u3093\u306b\u3061\u306f", " world")
+    done = chat_runs.chat_done_payload(turn, "2026-10-17T10:00:00")
+
+    assert (done["thread_id"], done["model"], done["ts"]) == ("th", "seisan", "2026-10-17T10:00:00")
+    body = turn["answer"].encode("utf-8")
+    if mode == "digest":
+        assert "answer" not in done
+        assert done["bytes"] == len(body) == 21
+        assert done["sha256"] == hashlib.sha256(body).hexdigest()
+    else:
+        assert done["answer"] == turn["answer"]
+        assert "sha256" not in done
@@ -0,0 +1,72 @@
+import pytest
+
+from app import chat_runs, core, dify
+
+REMOTE = {"REMOTE_ADDR": "10.0.0.5"}
+
+
+@pytest.fixture
+def client(make_app, monkeypatch):
+    app = make_app(ADMIN_USER_IDS="admin", METRICS_TOKEN="scrape-me")
+    monkeypatch.setitem(core._hw_stats, "last_error", "u1: [Errno 28] No space left: '/srv/chat/users/u1/history.csv'")
+    monkeypatch.setitem(dify._sse_stats, "dify_last_bad", '{"answer": "secret')
+    return app.test_client()
+
+
+def login(client, uid):
+    with client.session_transaction() as s:
+        s["user_id"] = uid
+
+
+def test_stats_rejects_remote_non_admins(client):
+    assert client.get("/stats", environ_base=REMOTE).status_code == 403
+    login(client, "u1")
+    assert client.get("/stats", environ_base=REMOTE).status_code == 403
+
+
+def test_stats_behind_a_proxy_is_not_treated_as_local(client):
+    assert client.get("/stats", headers={"X-Forwarded-For": "10.0.0.5"}).status_code == 403
+
+
+def test_stats_for_admins_and_localhost_is_redacted(client):
+    login(client, "admin")
+    for resp in (client.get("/stats", environ_base=REMOTE), client.get("/stats")):
+        assert resp.status_code == 200
+        body = resp.get_json()
+        assert body["history_writer"]["last_error"] == "[redacted]"
+        assert body["sse"]["dify_last_bad"] == "[redacted]"
+        assert "u1" not in resp.get_data(as_text=True)
+        assert "secret" not in resp.get_data(as_text=True)
+
+
+def test_metrics_carry_no_user_data(client):
+    login(client, "u1")
+    client.get("/api/threads", environ_base=REMOTE)
+    text = client.get("/metrics", environ_base=REMOTE, headers={"Authorization": "Bearer scrape-me"}).get_data(as_text=True)
+    assert "u1" not in text
+    assert "secret" not in text
+
+
+def test_metrics_need_an_operator_or_the_scrape_token(client):
+    assert client.get("/metrics", environ_base=REMOTE).status_code == 403
+    assert client.get("/metrics", environ_base=REMOTE, headers={"Authorization": "Bearer wrong"}).status_code == 403
+    assert client.get("/metrics", environ_base=REMOTE, headers={"Authorization": "Bearer scrape-me"}).status_code == 200
+    assert client.get("/metrics").status_code == 200
+    login(client, "u1")
+    assert client.get("/metrics", environ_base=REMOTE).status_code == 403
+    login(client, "admin")
+    assert client.get("/metrics", environ_base=REMOTE).status_code == 200
+
+
+def test_sse_responses_stay_out_of_the_route_histogram(client, make_cfg):
+    run = chat_runs.open_chat_run(make_cfg(), "u1", "th-metrics")
+    chat_runs.chat_run_push(run, ("meta", {"thread_id": "th-metrics"}))
+    chat_runs.chat_run_close(run)
+    login(client, "u1")
+    resp = client.get("/api/chat/resume", query_string={"thread_id": "th-metrics"})
+    assert resp.mimetype == "text/event-stream"
+    client.get("/api/threads")
+
+    text = client.get("/metrics").get_data(as_text=True)
+    assert 'route="/api/threads"' in text
+    assert not [line for line in text.splitlines() if 'route="/api/chat/resume"' in line and 'status="200"' in line]
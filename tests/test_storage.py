@@ -0,0 +1,73 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import core
+from app.storage import CsvStorage, SqliteStorage, Storage
+
+
+def test_storage_interface_is_abstract(make_cfg):
+    cfg = make_cfg()
+    with pytest.raises(TypeError):
+        Storage(cfg)
+
+    class Partial(Storage):
+        def user_exists(self, user_id):
+            return False
+
+    with pytest.raises(TypeError):
+        Partial(cfg)
+    assert CsvStorage(cfg).name == "csv"
+
+
+def test_sqlite_prune_runs_once_per_user_and_day(make_cfg):
+    st = SqliteStorage(make_cfg(STORAGE_BACKEND="sqlite"))
+    old = (datetime.now() - timedelta(days=20)).isoformat(timespec="seconds")
+    st.append_history_rows("u1", [{"thread_id": "th", "timestamp": old, "role": "user", "content": "old"}])
+    assert st.read_history_all("u1", "th") == []
+
+    # connections are per thread; trace every one of them
+    deletes = []
+    real_conn = st._conn
+
+    def traced():
+        c = real_conn()
+        c.set_trace_callback(lambda sql: sql.startswith("DELETE FROM history") and deletes.append(sql))
+        return c
+
+    st._conn = traced
+    st._pruned_on.clear()
+    barrier = threading.Barrier(8)
+
+    def append(n):
+        barrier.wait()
+        st.append_history("u1", "user", "seisan", "th", "", f"m{n}")
+
+    ts = [threading.Thread(target=append, args=(n,)) for n in range(8)]
+    [t.start() for t in ts]
+    [t.join() for t in ts]
+
+    assert len(deletes) == 1
+    assert len(st.read_history_all("u1", "th")) == 8
+
+
+def test_sqlite_feedback_reads_see_writes_made_outside_this_backend(make_cfg, monkeypatch):
+    cfg = make_cfg(STORAGE_BACKEND="sqlite")
+    row = dict(user_id="u1", model_key="m1", thread_id="t1", saved_at="2026-10-01T10:00:00", question="q", answer="a")
+
+    def nas(ok):
+        monkeypatch.setattr(core, "_nas_state", {"ok": ok, "checked_at": time.time(), "latency_ms": 0.0, "failures": 0})
+
+    nas(False)
+    core.upsert_feedback_state(cfg, dir_path=cfg.feedback_dir_local, bot_ts="b1", kind="good", **row)
+    assert core.get_feedback_state(cfg, user_id="u1", model_key="m1", thread_id="t1", bot_ts="b2") is None
+
+    # another host (or tools/) writes straight into the NAS shards
+    core.upsert_feedback_state_to_dir(dir_path=cfg.feedback_dir_nas, bot_ts="b2", kind="bad", **row)
+    nas(True)
+
+    assert core.get_feedback_state(cfg, user_id="u1", model_key="m1", thread_id="t1", bot_ts="b2")["kind"] == "bad"
+    rows = core.list_feedback_state_for_user_thread(cfg, user_id="u1", thread_id="t1", model_key=None)
+    assert sorted((r["bot_ts"], r["kind"]) for r in rows) == [("b1", "good"), ("b2", "bad")]
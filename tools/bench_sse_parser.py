@@ -0,0 +1,87 @@
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+import requests
+from urllib3.response import HTTPResponse
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from app.dify import iter_dify_sse  # noqa: E402
+
+
+def legacy_iter_dify_sse(resp: requests.Response):
+    # the line-based reader iter_dify_sse replaced, kept here as the baseline
+    for raw in resp.iter_lines(decode_unicode=True):
+        s = (raw or "").strip()
+        if not s.startswith("data:"):
+            continue
+        payload = s[len("data:"):].strip()
+        if payload == "[DONE]":
+            break
+        try:
+            ev = json.loads(payload)
+        except Exception:
+            continue
+        yield ev
+
+
+def dify_body(tokens: int) -> bytes:
+    # Dify-shaped stream: one message event per token, then message_end
+    parts = []
+    for i in range(tokens):
+        ev = {
+            "event": "message",
+            "conversation_id": "5b2f0c1e-6a51-4f0e-9a4a-0d9b7c1e2f3a",
+            "message_id": "9d4e8b0a-1c2d-4e5f-8a9b-0c1d2e3f4a5b",
+            "created_at": 1760000000,
+            "answer": "生産" if i % 3 else " token",
+        }
+        parts.append("data: " + json.dumps(ev, ensure_ascii=False) + "\n\n")
+    parts.append("data: " + json.dumps({"event": "message_end", "conversation_id": "5b2f0c1e-6a51-4f0e-9a4a-0d9b7c1e2f3a"}) + "\n\n")
+    return "".join(parts).encode("utf-8")
+
+
+def make_response(body: bytes) -> requests.Response:
+    r = requests.Response()
+    r.status_code = 200
+    r.encoding = "utf-8"
+    r.raw = HTTPResponse(body=io.BytesIO(body), preload_content=False, headers={"Content-Type": "text/event-stream"})
+    return r
+
+
+def measure(fn, body: bytes, tokens: int, rounds: int) -> float:
+    best = None
+    for _ in range(rounds):
+        r = make_response(body)
+        t0 = time.process_time()
+        n = sum(1 for ev in fn(r) if ev.get("event") == "message")
+        dt = time.process_time() - t0
+        if n != tokens:
+            raise SystemExit(f"{fn.__name__}: parsed {n} of {tokens} tokens")
+        best = dt if best is None else min(best, dt)
+    return best * 1e6 / tokens
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="CPU time per token: line-based Dify SSE reader vs the byte-level parser")
+    ap.add_argument("--tokens", type=int, default=20000)
+    ap.add_argument("--rounds", type=int, default=5)
+    args = ap.parse_args()
+
+    body = dify_body(args.tokens)
+    old = measure(legacy_iter_dify_sse, body, args.tokens, args.rounds)
+    new = measure(iter_dify_sse, body, args.tokens, args.rounds)
+    print(f"tokens={args.tokens} body={len(body)} bytes, best of {args.rounds}")
+    print(f"  iter_lines (legacy)  {old:8.2f} us/token")
+    print(f"  SseParser            {new:8.2f} us/token  ({old / new:.2f}x)")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
\ No newline at end of file
@@ -0,0 +1,42 @@
+import argparse
+import os
+import sys
+
+from dotenv import load_dotenv
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from config import load_config  # noqa: E402
+from app.core import feedback_state_csv_path, migrate_feedback_state_to_shards  # noqa: E402
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Split feedback_state.csv into per-model, per-month shards under feedback_state/")
+    ap.add_argument("--base-dir", default=BASE_DIR)
+    ap.add_argument("--dir", action="append", default=None, help="feedback dir to migrate (default: local spool and NAS)")
+    args = ap.parse_args()
+
+    load_dotenv()
+    cfg = load_config(args.base_dir)
+
+    dirs = args.dir or [cfg.feedback_dir_local, cfg.feedback_dir_nas]
+
+    failed = 0
+    for d in dirs:
+        if not os.path.exists(feedback_state_csv_path(d)):
+            print(f"SKIP: {d}: no feedback_state.csv")
+            continue
+        try:
+            report = migrate_feedback_state_to_shards(d, cfg.backup_dir)
+            print(f"OK: {d}: {report['rows']} rows -> {report['shards']} shards")
+        except Exception as e:
+            failed += 1
+            print(f"NG: {d}: {e}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
\ No newline at end of file
@@ -0,0 +1,47 @@
+import argparse
+import os
+import sys
+
+from dotenv import load_dotenv
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from config import load_config  # noqa: E402
+from app.core import ID7_RE, history_csv_path, migrate_history_to_segments  # noqa: E402
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Split users/<id>/history.csv into per-day segments under users/<id>/history/")
+    ap.add_argument("--base-dir", default=BASE_DIR)
+    ap.add_argument("--user", default=None, help="migrate only this user id")
+    args = ap.parse_args()
+
+    load_dotenv()
+    cfg = load_config(args.base_dir)
+
+    if args.user:
+        user_ids = [args.user]
+    else:
+        try:
+            user_ids = sorted(n for n in os.listdir(cfg.users_dir) if ID7_RE.match(n))
+        except OSError:
+            user_ids = []
+
+    failed = 0
+    for uid in user_ids:
+        if not os.path.exists(history_csv_path(cfg, uid)):
+            continue
+        try:
+            report = migrate_history_to_segments(cfg, uid)
+            print(f"OK: {uid}: {report['rows']} rows -> {report['segments']} segments")
+        except Exception as e:
+            failed += 1
+            print(f"NG: {uid}: {e}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
\ No newline at end of file
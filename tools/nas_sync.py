@@ -9,17 +9,27 @@ if BASE_DIR not in sys.path:
     sys.path.insert(0, BASE_DIR)
 
 from config import load_config  # noqa: E402
-from app.core import sync_local_spool_to_nas_if_possible  # noqa: E402
+from app.core import nas_sync_loop, sync_local_spool_to_nas_if_possible  # noqa: E402
 
 
 def main() -> int:
     ap = argparse.ArgumentParser(description="Sync local _spool/good_and_bad to NAS if available")
     ap.add_argument("--base-dir", default=BASE_DIR)
+    ap.add_argument("--daemon", action="store_true", help="keep running and sync whenever the NAS is reachable and the spool is not empty")
+    ap.add_argument("--interval", type=int, default=None, help="seconds between checks in --daemon mode (default: NAS_SYNC_INTERVAL_SEC or 30)")
     args = ap.parse_args()
 
     load_dotenv()
     cfg = load_config(args.base_dir)
 
+    if args.daemon:
+        interval = args.interval or cfg.nas_sync_interval_sec or 30
+        try:
+            nas_sync_loop(cfg, interval, on_report=print)
+        except KeyboardInterrupt:
+            pass
+        return 0
+
     report = sync_local_spool_to_nas_if_possible(cfg)
     print(report)
 